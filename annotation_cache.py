@@ -0,0 +1,79 @@
+"""Process-wide LRU cache of the parsed annotation files, shared by all the annotation objects"""
+
+import threading
+from collections import OrderedDict
+
+from pylluminator.utils import get_logger
+
+LOGGER = get_logger()
+
+
+class AnnotationCache:
+    """Bounded least-recently-used cache of parsed annotations, keyed by (kind, array type, genome version...).
+
+    Cached dataframes are shared between all the objects that ask for them : they must not be modified in place.
+
+    :ivar max_size: maximum number of annotations kept in memory
+    :vartype max_size: int
+
+    :ivar hits: number of annotations found in the cache
+    :vartype hits: int
+
+    :ivar misses: number of annotations that had to be loaded
+    :vartype misses: int
+    """
+
+    def __init__(self, max_size: int = 5):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, loader):
+        """Get the annotation of the key from the cache, or load it with `loader()` and cache it. None values (failed
+        or unsupported annotations) are not cached.
+
+        :param key: identifier of the annotation, e.g. (kind, array_type, genome_version)
+        :type key: tuple
+
+        :param loader: function without parameter returning the annotation
+        :type loader: Callable
+
+        :return: the annotation"""
+
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                LOGGER.debug(f'annotation cache hit for {key}')
+                return self._entries[key]
+            self.misses += 1
+
+        value = loader()
+        if value is None or self.max_size <= 0:
+            return value
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                LOGGER.debug(f'annotation cache full, evicting {evicted_key}')
+
+        return value
+
+    def stats(self) -> dict:
+        """Hits, misses and size of the cache"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'max_size': self.max_size}
+
+    def clear(self) -> None:
+        """Remove all the annotations from the cache and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+ANNOTATION_CACHE = AnnotationCache()
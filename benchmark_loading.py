@@ -0,0 +1,95 @@
+"""Compare the loading time and memory of the probe_infos files in csv.zip and parquet formats"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from columnar import has_pyarrow, read_parquet, write_parquet
+from instrumentation import peak_rss
+
+CATEGORY_COLUMNS = ['type', 'probe_type', 'channel', 'chromosome']
+INTEGER_COLUMNS = ['address_a', 'address_b', 'start', 'end']
+
+
+def load_csv(filepath: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Load a probe_infos.csv(.zip) file the way pylluminator does, and set the same dtypes as the parquet file"""
+    usecols = None if columns is None else ['illumina_id'] + columns
+    df = pd.read_csv(filepath, dtype={'chromosome': 'category'}, usecols=usecols)
+    df = df.set_index('illumina_id')
+    for col in df.columns:
+        if col in CATEGORY_COLUMNS:
+            df[col] = df[col].astype('category')
+        elif col in INTEGER_COLUMNS:
+            df[col] = df[col].astype('Int64')
+    return df
+
+
+def load_parquet(filepath: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """Load a probe_infos.parquet file"""
+    return read_parquet(filepath, columns=columns)
+
+
+def measure(loader: str, filepath: str, columns: list[str] | None = None) -> dict:
+    """Load a file in this (fresh) process, and measure the loading time and the memory it needed"""
+    load = load_csv if loader == 'csv' else load_parquet
+    rss_before = peak_rss(reset=True)
+    start = time.perf_counter()
+    df = load(filepath, columns)
+    duration = time.perf_counter() - start
+    rss_after = peak_rss()
+    return {'loader': loader, 'file': filepath, 'rows': len(df), 'columns': len(df.columns),
+            'seconds': round(duration, 3), 'peak_rss_mb': round((rss_after - rss_before) / 1024, 1),
+            'frame_mb': round(df.memory_usage(deep=True).sum() / 1024 ** 2, 1)}
+
+
+def run_benchmark(csv_file: str, parquet_file: str, columns: list[str] | None = None, repeat: int = 3) -> list[dict]:
+    """Measure each loader `repeat` times, each time in a new process so that the memory measures are independent, and
+    keep the fastest run"""
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for loader, filepath in [('csv', csv_file), ('parquet', parquet_file)]:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(measure, loader, filepath, columns).result())
+        results.append(min(runs, key=lambda run: run['seconds']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='*', help='probe_infos.csv.zip files. Default: all the versioned annotations')
+    parser.add_argument('--columns', nargs='+', default=None, help='only load these columns')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per loader, the fastest is kept')
+    parser.add_argument('--output', default=None, help='save the results in this json file')
+    args = parser.parse_args()
+
+    if not has_pyarrow():
+        raise SystemExit('pyarrow is needed to run this benchmark')
+
+    files = args.files if len(args.files) > 0 else sorted(glob.glob('annotations/*/*/probe_infos.csv.zip'))
+    all_results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for csv_file in files:
+            parquet_file = csv_file.replace('.csv.zip', '.parquet').replace('.csv', '.parquet')
+            if not os.path.exists(parquet_file):
+                # no parquet file was generated yet, convert the csv file
+                parquet_file = os.path.join(tmp_dir, f'{len(all_results)}.parquet')
+                write_parquet(load_csv(csv_file), parquet_file)
+            csv_result, parquet_result = run_benchmark(csv_file, parquet_file, args.columns, args.repeat)
+            all_results += [csv_result, parquet_result]
+            print(f'{csv_file} ({csv_result["rows"]} rows, {csv_result["columns"]} columns)')
+            for result, size in [(csv_result, os.path.getsize(csv_file)), (parquet_result, os.path.getsize(parquet_file))]:
+                print(f'    {result["loader"]:<8} {size / 1024 ** 2:>7.1f} MB on disk  {result["seconds"]:>7.3f} s  '
+                      f'peak RSS +{result["peak_rss_mb"]} MB  dataframe {result["frame_mb"]} MB')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2)
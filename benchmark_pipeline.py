@@ -0,0 +1,363 @@
+"""Benchmark the annotation pipeline on synthetic SeSAMe and Illumina files, without network access : time and peak memory
+of each stage (SeSAMe annotations, probe infos, Illumina annotations, comparison, update_data) for several array sizes.
+Results are saved with the commit they were measured on, and can be compared with a previous run to catch regressions"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.annotations import ArrayType, GenomeVersion
+from pylluminator.utils import convert_to_path, get_resource_folder
+
+from download_cache import DownloadCache, configure_cache, file_checksum
+from instrumentation import RECORDER
+from normalization import DTYPE_POLICIES
+from provenance import git_revision
+
+# number of probes of each benchmark size. 930k is the size of EPIC v2, 2m is a stress case
+SIZES = {'27k': 27_578, '450k': 485_577, '930k': 937_690, '2m': 2_000_000}
+DEFAULT_SIZES = ['27k', '450k', '930k']
+
+# the synthetic files are stored in the download cache under the links of this combination, so that the pipeline reads
+# them exactly like downloaded files
+ARRAY_TYPE = ArrayType.HUMAN_EPIC_V2
+GENOME_VERSION = GenomeVersion.HG38
+
+CHROMOSOMES = [str(i) for i in range(1, 23)] + ['X', 'Y']
+MASK_REASONS = ['M_mapping', 'M_nonuniq', 'M_SNPcommon_5pt', 'M_1baseSwitchSNPcommon_5pt', 'M_2extBase_SNPcommon_5pt']
+
+RESULTS_DIR = 'benchmark_results'
+
+# smaller differences between two runs are considered as noise, whatever the threshold
+MIN_DIFFERENCE = {'seconds': 0.1, 'peak_rss_mb': 20}
+
+
+def synthetic_probes(n: int, seed: int = 0) -> pd.DataFrame:
+    """Design and position of n synthetic probes (about 15% type I, 1% CpH and 0.1% SNP probes), shared by the SeSAMe
+    and Illumina files"""
+    rng = np.random.default_rng(seed)
+    idxs = np.arange(n)
+    prefixes = np.where(idxs % 1000 == 1, 'rs', np.where(idxs % 100 == 2, 'ch', 'cg'))
+    names = pd.Series(prefixes, dtype=object) + pd.Series(idxs).map('{:08d}'.format)
+    is_type_i = rng.random(n) < 0.15
+    starts = rng.integers(10_000, 150_000_000, n)
+    return pd.DataFrame({
+        'name': names,
+        'probe_id': names + pd.Series(rng.choice(['_TC11', '_TC21', '_BC11', '_BC21'], n), dtype=object),
+        'type': np.where(is_type_i, 'I', 'II'),
+        'address_a': 10_000_000 + idxs,
+        'address_b': pd.Series(40_000_000 + idxs, dtype='Int64').where(is_type_i),
+        'channel': pd.Series(rng.choice(['R', 'G'], n)).where(is_type_i),
+        'chromosome': rng.choice(CHROMOSOMES, n),
+        'start': starts,
+        'end': starts + np.where(prefixes == 'cg', 2, 1),
+        'strand': rng.choice(['+', '-'], n)})
+
+
+def random_sequences(rng: np.random.Generator, pool_size: int, length: int) -> np.ndarray:
+    """Pool of random DNA sequences"""
+    bases = rng.choice(list('ACGT'), (pool_size, length))
+    return np.array([''.join(sequence) for sequence in bases], dtype=object)
+
+
+def write_sesame_files(probes: pd.DataFrame, paths: dict[str, str], seed: int = 0) -> None:
+    """Write SeSAMe-like manifest, mask, gene (tsv.gz) and CGI knowledgebase (gz) files. `paths` gives the path of each
+    file by kind of annotation, as in `sesame_annotations.LINKS`"""
+    rng = np.random.default_rng(seed)
+    n = len(probes)
+    sequences = random_sequences(rng, 5000, 50)
+    is_type_i = (probes['type'] == 'I').to_numpy()
+    chromosomes = 'chr' + pd.Series(probes['chromosome'], dtype=object)
+    gzip_options = {'method': 'gzip', 'compresslevel': 1}
+
+    manifest = pd.DataFrame({
+        'CpG_chrm': chromosomes, 'CpG_beg': probes['start'], 'CpG_end': probes['end'],
+        'address_A': probes['address_a'], 'address_B': probes['address_b'], 'target': 'CG',
+        'nextBase': pd.Series(rng.choice(['A', 'T', 'C', 'G'], n)).where(is_type_i), 'channel': probes['channel'],
+        'Probe_ID': probes['probe_id'], 'mapFlag_A': 0, 'mapChrm_A': chromosomes, 'mapPos_A': probes['start'] - 50,
+        'mapQ_A': 60, 'mapCigar_A': '50M', 'AlleleA_ProbeSeq': rng.choice(sequences, n),
+        'mapFlag_B': pd.Series(0, index=probes.index).where(is_type_i), 'mapChrm_B': chromosomes.where(is_type_i),
+        'mapPos_B': (probes['start'] - 50).where(is_type_i), 'mapQ_B': pd.Series(60, index=probes.index).where(is_type_i),
+        'mapCigar_B': pd.Series('50M', index=probes.index).where(is_type_i),
+        'AlleleB_ProbeSeq': pd.Series(rng.choice(sequences, n)).where(is_type_i),
+        'wDecoy_chrm': chromosomes, 'wDecoy_pos': probes['start'] - 50, 'wDecoy_qual': 60, 'posMatch': True,
+        'MASK_mapping': False, 'MASK_typeINextBaseSwitch': False, 'MASK_rmsk15': False, 'MASK_sub40_copy': False,
+        'MASK_extBase': False, 'MASK_general': False, 'designType': probes['type'], 'probe_strand': probes['strand']})
+    manifest.to_csv(paths['manifest'], sep='\t', index=False, na_rep='NA', compression=gzip_options)
+
+    # 20% of masked probes, with one or two distinct reasons listed in the order of MASK_REASONS like SeSAMe does
+    masked = rng.random(n) < 0.2
+    reasons = np.array(MASK_REASONS, dtype=object)
+    first_reasons, second_reasons = rng.integers(0, len(reasons), n), rng.integers(0, len(reasons), n)
+    has_two_reasons = (rng.random(n) < 0.3) & (first_reasons != second_reasons)
+    mask_uniq = pd.Series(np.where(has_two_reasons,
+                                   reasons[np.minimum(first_reasons, second_reasons)] + ','
+                                   + reasons[np.maximum(first_reasons, second_reasons)],
+                                   reasons[first_reasons]), dtype=object).where(masked)
+    mask = pd.DataFrame({'Probe_ID': probes['probe_id'], 'M_mapping': False, 'M_nonuniq': False,
+                         'M_SNPcommon_5pt': False, 'mask': masked, 'mask_uniq': mask_uniq})
+    mask.to_csv(paths['mask'], sep='\t', index=False, na_rep='NA', compression=gzip_options)
+
+    # two thirds of the probes overlap one or two genes
+    genes = pd.Series([f'GENE{i}' for i in range(20_000)], dtype=object)
+    first_genes = genes.to_numpy()[rng.integers(0, len(genes), n)]
+    second_genes = genes.to_numpy()[rng.integers(0, len(genes), n)]
+    genes_uniq = pd.Series(np.where(rng.random(n) < 0.5, first_genes + ';' + second_genes, first_genes)) \
+        .where(rng.random(n) < 0.66)
+    gene = pd.DataFrame({'CpG_chrm': chromosomes, 'CpG_beg': probes['start'], 'CpG_end': probes['end'],
+                         'probe_strand': probes['strand'], 'Probe_ID': probes['probe_id'], 'genesUniq': genes_uniq,
+                         'geneNames': genes_uniq, 'transcriptTypes': 'protein_coding',
+                         'transcriptIDs': 'ENST' + pd.Series(np.arange(n)).map('{:011d}'.format),
+                         'distToTSS': rng.integers(-5000, 5000, n)})
+    gene.to_csv(paths['gene'], sep='\t', index=False, na_rep='NA', compression=gzip_options)
+
+    # knowledgebase : one row per (probe, feature), some probes are in several features
+    relations = pd.Series(rng.choice(['CGI;Island', 'CGI;Shore', 'CGI;Shelf', 'CGI;OpenSea'], n), dtype=object)
+    in_two = rng.random(n) < 0.1
+    cgi = pd.DataFrame({'Probe_ID': pd.concat([probes['probe_id'], probes['probe_id'][in_two]]),
+                        'Knowledgebase': pd.concat([relations, pd.Series('CGI;Shore', index=relations.index)[in_two]])})
+    cgi.to_csv(paths['island_relation'], sep='\t', index=False, compression=gzip_options)
+
+
+def write_illumina_manifest(probes: pd.DataFrame, path: str, member: str | None = None, seed: int = 0) -> None:
+    """Write an Illumina-like sectioned manifest ([Heading], [Assay] and [Controls] sections), zipped in `member` if it's
+    set. 0.5% of the probes have a different position than in the SeSAMe files."""
+    rng = np.random.default_rng(seed)
+    n = len(probes)
+    sequences = random_sequences(rng, 5000, 50)
+    is_type_i = (probes['type'] == 'I').to_numpy()
+    moved = rng.random(n) < 0.005
+    assay = pd.DataFrame({
+        'IlmnID': probes['probe_id'], 'Name': probes['name'],
+        'AddressA_ID': probes['address_a'], 'AlleleA_ProbeSeq': rng.choice(sequences, n),
+        'AddressB_ID': probes['address_b'], 'AlleleB_ProbeSeq': pd.Series(rng.choice(sequences, n)).where(is_type_i),
+        'Infinium_Design_Type': probes['type'],
+        'Next_Base': pd.Series(rng.choice(['A', 'T', 'C', 'G'], n)).where(is_type_i),
+        'Color_Channel': probes['channel'].map({'R': 'Red', 'G': 'Grn'}),
+        'Forward_Sequence': rng.choice(sequences, n) + '[CG]' + rng.choice(sequences, n),
+        'Genome_Build': 'GRCh38', 'CHR': 'chr' + pd.Series(probes['chromosome'], dtype=object),
+        'MAPINFO': np.where(moved, probes['start'] + rng.integers(1, 100, n), probes['start']),
+        'SourceSeq': rng.choice(sequences, n), 'Strand_FR': np.where(probes['strand'] == '+', 'F', 'R'),
+        'UCSC_RefGene_Name': pd.Series([f'GENE{i}' for i in rng.integers(0, 20_000, n)]).where(rng.random(n) < 0.6),
+        'UCSC_RefGene_Group': pd.Series(rng.choice(['TSS200', 'TSS1500', 'Body', '5UTR', '3UTR'], n)),
+        'Relation_to_UCSC_CpG_Island': pd.Series(rng.choice(['Island', 'N_Shore', 'S_Shelf'], n)).where(rng.random(n) < 0.5)})
+
+    csv_path = path if member is None else path + '.csv'
+    with open(csv_path, 'w') as f:
+        f.write('Illumina, Inc.,,,\n[Heading],,,\nDescriptor File Name,synthetic,,\nAssay Format,Infinium HD Methylation,,\n')
+        f.write(f'Loci Count,{n},,\n[Assay],,,\n')
+        assay.to_csv(f, index=False)
+        f.write('[Controls],,,\n')
+        for i in range(600):
+            f.write(f'{90_000_000 + i},STAINING,Red,DNP (High),\n')
+    if member is not None:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            archive.write(csv_path, member)
+        os.remove(csv_path)
+
+
+def generate_files(n: int, data_dir: str, seed: int = 0) -> str:
+    """Write the synthetic files of n probes in a download cache, under the links of ARRAY_TYPE and GENOME_VERSION.
+    Files already generated in `data_dir` are reused.
+
+    :return: the folder of the download cache
+    :rtype: str"""
+
+    from illumina_annotations import MANIFEST_FILES
+    from sesame_annotations import LINKS
+
+    cache_dir = os.path.join(data_dir, f'{n}_probes')
+    cache = DownloadCache(cache_dir)
+    urls = {kind: LINKS[kind][GENOME_VERSION][ARRAY_TYPE] for kind in ['manifest', 'mask', 'gene', 'island_relation']}
+    illumina_member, urls['illumina'] = MANIFEST_FILES[ARRAY_TYPE]
+    if all(cache.is_cached(url) for url in urls.values()):
+        return cache_dir
+
+    print(f'generating synthetic files of {n} probes in {cache_dir}')
+    paths = {kind: str(cache.path(url)) for kind, url in urls.items()}
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    probes = synthetic_probes(n, seed)
+    write_sesame_files(probes, paths, seed)
+    write_illumina_manifest(probes, paths['illumina'], illumina_member if urls['illumina'].endswith('.zip') else None,
+                            seed)
+    for url in urls.values():
+        cache.save_metadata(url, file_checksum(cache.path(url)))
+    return cache_dir
+
+
+def run_pipeline(cache_dir: str, jobs: int | None = 1, chunksize: int | None = None,
+                 dtype_policy: str = 'default') -> list[dict]:
+    """Run the stages of the pipeline on the synthetic files of a download cache, in this (fresh) process. The pipeline
+    modules are imported here so that their import is not counted in the memory of the first stage.
+
+    :return: the measures of each stage, and of the stages recorded by the pipeline itself (with a depth > 0)
+    :rtype: list[dict]"""
+
+    from compare_manifests import COMPARED_COLUMNS
+    from illumina_annotations import IlluminaAnnotations, MANIFEST_FILES
+    from manifest_diff import diff_probe_infos
+    from sesame_annotations import SesameAnnotations
+    from update_data import update_data
+    from validation import read_gaps, read_seq_lengths, validate_probe_infos
+
+    configure_cache(offline=True, cache_dir=cache_dir)
+    RECORDER.start_task(None)
+
+    anno = SesameAnnotations(ARRAY_TYPE, GENOME_VERSION, chunksize=chunksize, dtype_policy=dtype_policy)
+    for kind in ['manifest', 'mask', 'gene', 'island_relation']:
+        RECORDER.run(f'sesame_{kind}', getattr, anno, kind)
+    probe_infos = RECORDER.run('sesame_probe_infos', anno.make_pylluminator_probe_info)
+
+    # the Illumina manifest is extracted in the pylluminator data folder : don't run if a real manifest is already there,
+    # and remove the synthetic one afterward
+    extracted_file = convert_to_path(get_resource_folder('tmp')).joinpath(MANIFEST_FILES[ARRAY_TYPE][0])
+    if os.path.exists(extracted_file):
+        print(f'{extracted_file} exists, skipping the Illumina and comparison stages')
+    else:
+        created_dirs = [parent for parent in extracted_file.parents if not os.path.exists(parent)]
+        try:
+            illumina = RECORDER.run('illumina_annotations', IlluminaAnnotations, ARRAY_TYPE, GENOME_VERSION, anno.mask,
+                                    dtype_policy)
+        finally:
+            if os.path.exists(extracted_file):
+                os.remove(extracted_file)
+            for created_dir in created_dirs:
+                if os.path.isdir(created_dir) and len(os.listdir(created_dir)) == 0:
+                    os.rmdir(created_dir)
+        RECORDER.run('compare', diff_probe_infos, probe_infos, illumina.probe_infos, COMPARED_COLUMNS, 'sesame', 'illumina')
+
+    # genome info files are read relatively to the working directory, like in create_manifest.py
+    RECORDER.run('validate', validate_probe_infos, probe_infos, read_seq_lengths(GENOME_VERSION),
+                 read_gaps(GENOME_VERSION))
+
+    # update_data writes the versioned files relatively to the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            output_dir = f'_generated_data/annotations/{GENOME_VERSION}/{ARRAY_TYPE}'
+            os.makedirs(output_dir)
+            RECORDER.run('write_csv', probe_infos.to_csv, f'{output_dir}/probe_infos.csv')
+            RECORDER.run('update_data', update_data, jobs, '_generated_data', 'data_index.json')
+            RECORDER.run('update_data_unchanged', update_data, jobs, '_generated_data', 'data_index.json')
+        finally:
+            os.chdir(cwd)
+
+    return [{key: value for key, value in record.items() if key != 'task'} for record in RECORDER.finish_task()]
+
+
+def run_benchmark(sizes: list[str], data_dir: str, jobs: int | None = 1, chunksize: int | None = None,
+                  dtype_policy: str = 'default') -> list[dict]:
+    """Generate the synthetic files of each size and run the pipeline on them, each time in a new process so that the
+    memory measures are independent"""
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        n = SIZES[size] if size in SIZES else int(size)
+        cache_dir = generate_files(n, data_dir)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            stages = executor.submit(run_pipeline, cache_dir, jobs, chunksize, dtype_policy).result()
+        results += [{'size': size, 'probes': n, **stage} for stage in stages]
+        print_results([result for result in results if result['size'] == size])
+    return results
+
+
+def print_results(results: list[dict]) -> None:
+    """Print the measures of a run, one line per stage, nested stages indented below their parent"""
+    print(f'{results[0]["size"]} ({results[0]["probes"]} probes)')
+    for result in results:
+        detail = result.get('kind', result.get('annotation', result.get('format', '')))
+        name = '  ' * result['depth'] + result['stage'] + (f' ({detail})' if detail else '')
+        print(f'    {name:<40} {result["seconds"]:>8.3f} s  cpu {result["cpu_seconds"]:>8.3f} s  '
+              f'peak RSS {result["peak_rss_mb"]:>8.1f} MB (+{result["peak_rss_increase_mb"]} MB)')
+
+
+def save_results(results: list[dict], output: str | None = None) -> str:
+    """Save the results with the commit and environment they were measured in.
+
+    :param output: path of the json file. Default: None, `benchmark_results/pipeline_<commit>.json`
+    :type output: str | None
+
+    :return: the path of the json file
+    :rtype: str"""
+
+    commit, dirty = git_revision()
+    if output is None:
+        output = os.path.join(RESULTS_DIR, f'pipeline_{commit[:10] if commit else time.strftime("%Y%m%d_%H%M%S")}'
+                                           f'{"_dirty" if dirty else ""}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    report = {'commit': commit, 'dirty': dirty, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return output
+
+
+def compare_results(previous: dict, current: dict, threshold: float = 0.25) -> list[str]:
+    """List the stages that are slower or use more memory than in a previous run by more than `threshold` (relative
+    difference), ignoring differences smaller than MIN_DIFFERENCE. Only the top-level stages are compared."""
+    previous_stages = {(result['size'], result['stage']): result for result in previous['results']
+                       if result.get('depth', 0) == 0}
+    regressions = []
+    for result in current['results']:
+        if result.get('depth', 0) > 0:
+            continue
+        previous_result = previous_stages.get((result['size'], result['stage']))
+        if previous_result is None:
+            continue
+        for metric, min_difference in MIN_DIFFERENCE.items():
+            old, new = previous_result[metric], result[metric]
+            if new - old > max(min_difference, threshold * old):
+                regressions.append(f'{result["size"]} {result["stage"]} {metric}: {old} -> {new} '
+                                   f'(+{(new - old) / old if old > 0 else float("inf"):.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help=f'sizes to benchmark, among {", ".join(SIZES)} or a number of probes. '
+                             f'Default: {" ".join(DEFAULT_SIZES)}')
+    parser.add_argument('--data-dir', default=None,
+                        help='folder where the synthetic files are generated and reused in the next runs. Default: a '
+                             'temporary folder')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes of update_data. Default: 1')
+    parser.add_argument('--chunksize', type=int, default=None, help='stream the SeSAMe files by chunks of this size')
+    parser.add_argument('--dtypes', choices=DTYPE_POLICIES, default='default', help='dtype policy of the probe infos')
+    parser.add_argument('--output', default=None,
+                        help=f'json file where the results are saved. Default: {RESULTS_DIR}/pipeline_<commit>.json')
+    parser.add_argument('--compare', metavar='PREVIOUS', default=None,
+                        help='results of a previous run : list the regressions, and exit with an error if there are any')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative difference considered as a regression. Default: 0.25')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        all_results = run_benchmark(args.sizes, args.data_dir or tmp_dir, args.jobs, args.chunksize,
+                                    args.dtypes)
+    results_file = save_results(all_results, args.output)
+    print(f'results saved in {results_file}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous_report = json.load(f)
+        with open(results_file) as f:
+            current_report = json.load(f)
+        found = compare_results(previous_report, current_report, args.threshold)
+        print(f'{len(found)} regression(s) since {previous_report["commit"]}')
+        for regression in found:
+            print(f'    {regression}')
+        if len(found) > 0:
+            sys.exit(1)
@@ -0,0 +1,106 @@
+"""Columnar (Parquet) version of the generated annotation files, loaded without parsing text and with their dtypes"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# pyarrow is optional : without it, only the csv files are generated
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# zstd pages are decompressed when they are read, even from a memory-mapped file. Uncompressed files are about 2.5 times
+# bigger for a 25% faster full load, most of the load time being the conversion of the strings to python objects
+PARQUET_COMPRESSION = 'zstd'
+
+# position of each row in the written dataframe, stored with the rows so that the file is read back in the same order
+# even though its rows are grouped by chromosome
+ROW_ORDER_COLUMN = '__row_order__'
+
+
+def has_pyarrow() -> bool:
+    """Check if pyarrow is installed, i.e. if parquet files can be written and read"""
+    return pa is not None
+
+
+def _check_pyarrow() -> None:
+    if not has_pyarrow():
+        raise ImportError('pyarrow is needed to read and write parquet files, install it with `pip install pyarrow`')
+
+
+def write_parquet(df: pd.DataFrame, filepath: str | os.PathLike, row_group_column: str = 'chromosome',
+                  compression: str | None = PARQUET_COMPRESSION) -> None:
+    """Write a dataframe as a parquet file with one row group per value of `row_group_column`, so that a reader
+    filtering on this column only decodes the matching row groups. The index is stored as a column and restored when
+    the file is read, categories are dictionary-encoded and nullable integers keep their type. The position of each row
+    in `df` is stored in ROW_ORDER_COLUMN, so that `read_parquet` returns the rows in the order of `df` (e.g. sorted by
+    probe ID like the csv file) and not grouped by chromosome.
+
+    :param df: dataframe to write
+    :type df: pandas.DataFrame
+
+    :param filepath: path of the parquet file
+    :type filepath: str | os.PathLike
+
+    :param row_group_column: column used to split the row groups, rows are grouped by value in the file (and sorted by
+        value if the column is a category). Default: 'chromosome'
+    :type row_group_column: str
+
+    :param compression: compression of the column chunks, None to write them uncompressed. Default: PARQUET_COMPRESSION
+    :type compression: str | None"""
+
+    _check_pyarrow()
+
+    schema = pa.Schema.from_pandas(df, preserve_index=True)
+    # rows of each group, in their order in df
+    group_ids = df.groupby(row_group_column, observed=True, dropna=False, sort=True).ngroup().to_numpy()
+    order = np.argsort(group_ids, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(group_ids[order])) + 1) if len(df) > 0 else []
+    with pq.ParquetWriter(str(filepath), schema.append(pa.field(ROW_ORDER_COLUMN, pa.int32())),
+                          compression=compression or 'none') as writer:
+        for rows in groups:
+            table = pa.Table.from_pandas(df.iloc[rows], schema=schema, preserve_index=True)
+            table = table.append_column(ROW_ORDER_COLUMN, pa.array(rows, type=pa.int32()))
+            writer.write_table(table, row_group_size=len(rows))
+
+
+def read_parquet(filepath: str | os.PathLike, columns: list[str] | None = None,
+                 chromosomes: list[str] | None = None) -> pd.DataFrame:
+    """Read a parquet file written by `write_parquet`, with its rows in the order of the written dataframe. Only the
+    selected columns and chromosomes (row groups) are read and decoded. The file is memory-mapped, but compressed pages
+    (see PARQUET_COMPRESSION) are still decompressed in memory.
+
+    :param filepath: path of the parquet file
+    :type filepath: str | os.PathLike
+
+    :param columns: columns to read, the index is always read. Default: None, read all the columns
+    :type columns: list[str] | None
+
+    :param chromosomes: only read the probes of these chromosomes. Default: None, read all the probes
+    :type chromosomes: list[str] | None
+
+    :return: the dataframe, with its index and dtypes
+    :rtype: pandas.DataFrame"""
+
+    _check_pyarrow()
+
+    schema = pq.read_schema(str(filepath))
+    if columns is not None:
+        # the index is stored as a regular column, that pyarrow only reads if it's selected
+        index_columns = [col for col in schema.pandas_metadata['index_columns'] if isinstance(col, str)]
+        columns = index_columns + list(columns) + ([ROW_ORDER_COLUMN] if ROW_ORDER_COLUMN in schema.names else [])
+
+    filters = None if chromosomes is None else [('chromosome', 'in', list(chromosomes))]
+    table = pq.read_table(str(filepath), columns=columns, filters=filters, memory_map=True)
+    # files written without the row order are read in the order of their row groups
+    if ROW_ORDER_COLUMN not in table.column_names:
+        return table.to_pandas()
+    row_order = table.column(ROW_ORDER_COLUMN).to_numpy()
+    df = table.remove_column(table.schema.get_field_index(ROW_ORDER_COLUMN)).to_pandas()
+    if np.all(row_order[1:] > row_order[:-1]):
+        return df
+    return df.iloc[np.argsort(row_order, kind='stable')]
@@ -1,53 +1,119 @@
-"""Create manifests for every combination of Array Type * Genome version from Illumina or SeSAMe annotation"""
+"""Compare the manifests built from Illumina and SeSAMe annotation for every combination of Array Type * Genome version,
+or compare the versioned annotations with a previous release"""
 
 import os.path
+from functools import partial
 
 from pylluminator.annotations import ArrayType, GenomeVersion
 from pylluminator.utils import get_logger
 
+from annotation_cache import ANNOTATION_CACHE
 from illumina_annotations import IlluminaAnnotations
+from download_cache import configure_cache
+from instrumentation import RECORDER
+from manifest_diff import diff_probe_infos, format_diff, save_diff, load_versioned_probe_infos
+from prefetch import get_links
+from scheduler import get_parser, get_combinations, run_all, write_summary
 from sesame_annotations import SesameAnnotations
+from validation import format_violations, read_gaps, read_seq_lengths, validate_probe_infos
 import pandas as pd
 
 LOGGER = get_logger()
 
 root_dir = '_generated_data/annotations'
-os.makedirs(root_dir, exist_ok=True)
+
+# columns compared between SeSAMe and Illumina manifests
+COMPARED_COLUMNS = ['chromosome', 'end', 'start', 'type', 'channel', 'address_a', 'address_b', 'probe_type', 'strand']
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
-for at in ArrayType:
-    for gv in GenomeVersion:
-        if at.is_human() != gv.is_human():
-            continue
-
-        # create manifest
-        LOGGER.info(f'\n------------------- {gv} {at}')
-        anno_illu = IlluminaAnnotations(at, gv)
-        anno_sesame = SesameAnnotations(at, gv)
-
-        # compare manifests
-        print('--------------------------------------------------------------------')
-        if anno_sesame.manifest is not None and anno_illu.manifest is not None:
-            if anno_sesame.manifest.equals(anno_illu.manifest):
-                print(f'similar for {at} {gv}')
-            else:
-                print(f'different for {at} {gv}')
-                joined = anno_sesame.probe_infos.join(anno_illu.probe_infos, lsuffix='_s', rsuffix='_i')
-                print(f'missing {joined['probe_id_s'].isna().sum()} probes in sesame')
-                print(f'missing {joined['probe_id_i'].isna().sum()} probes in illumina')
-                common_probes = joined.dropna(subset=['probe_id_s', 'probe_id_i'])
-                print(f'{len(common_probes)} common probes out of {len(joined)}')
-                for col in ['chromosome', 'end', 'start', 'type', 'channel', 'address_a', 'address_b', 'probe_type', 'strand']:
-                    common_probes[f'{col}_i'] = common_probes[f'{col}_i'].astype('str')
-                    common_probes[f'{col}_s'] = common_probes[f'{col}_s'].astype('str')
-                    diff = common_probes[common_probes[f'{col}_i'] != common_probes[f'{col}_s']]
-                    if len(diff) > 0:
-                        print(f'{len(diff)} different rows in col {col}')
-                        print(diff[[f'{col}_i', f'{col}_s']])
-        else:
-            if anno_sesame.manifest is None:
-                print(f'missing sesame manifest for {at} {gv}')
-            if anno_illu.manifest is None:
-                print(f'missing illumina manifest for {at} {gv}')
+
+def summarize(report: dict) -> dict:
+    """Counts of a diff report, for the build summary"""
+    return {'similar': report['identical'], 'changed_probes': report['rows']['changed'],
+            f'missing_in_{report["left"]}': report[f'missing_in_{report["left"]}'],
+            f'missing_in_{report["right"]}': report[f'missing_in_{report["right"]}']}
+
+
+def compare_manifests(at: ArrayType, gv: GenomeVersion, output_dir: str | None = None,
+                      output_format: str = 'json', dtype_policy: str = 'default') -> dict | None:
+    """Build the SeSAMe and Illumina manifests of one array type and genome version, and report their differences.
+    `dtype_policy` sets the dtypes of both manifests in memory, see `normalization.apply_dtype_policy`"""
+
+    # create manifest - the mask is the same for both, the annotation cache makes sure it's only parsed once
+    LOGGER.info(f'\n------------------- {gv} {at}')
+    anno_sesame = SesameAnnotations(at, gv, dtype_policy=dtype_policy)
+    anno_illu = IlluminaAnnotations(at, gv, dtype_policy=dtype_policy)
+    LOGGER.debug(f'annotation cache : {ANNOTATION_CACHE.stats()}')
+
+    # compare manifests
+    if anno_sesame.manifest is None or anno_illu.manifest is None:
+        if anno_sesame.manifest is None:
+            LOGGER.warning(f'missing sesame manifest for {at} {gv}')
+        if anno_illu.manifest is None:
+            LOGGER.warning(f'missing illumina manifest for {at} {gv}')
+        return None
+
+    with RECORDER.stage('compare', rows_in=len(anno_sesame.probe_infos) + len(anno_illu.probe_infos)):
+        report, mismatches = diff_probe_infos(anno_sesame.probe_infos, anno_illu.probe_infos, COMPARED_COLUMNS,
+                                              'sesame', 'illumina')
+    LOGGER.info(f'{"similar" if report["identical"] else "different"} for {at} {gv}\n{format_diff(report)}')
+    if output_dir is not None:
+        save_diff(report, mismatches, f'{output_dir}/{gv}_{at}.sesame_illumina', output_format)
+
+    # check both manifests against the genome info, e.g. probes the liftover couldn't place
+    validations = {}
+    seq_lengths, gaps = read_seq_lengths(gv), read_gaps(gv)
+    for name, probe_infos in [('sesame', anno_sesame.probe_infos), ('illumina', anno_illu.probe_infos)]:
+        with RECORDER.stage('validate', rows_in=len(probe_infos), manifest=name):
+            validations[name] = validate_probe_infos(probe_infos, seq_lengths, gaps)
+        if len(validations[name]['violations']) > 0:
+            LOGGER.warning(f'{gv} {at} {name} manifest violations :\n{format_violations(validations[name])}')
+    return {**summarize(report), 'validation': validations}
+
+
+def compare_releases(at: ArrayType, gv: GenomeVersion, revision: str, output_dir: str | None = None,
+                     output_format: str = 'json') -> dict | None:
+    """Compare the versioned probe_infos file of one array type and genome version with its version at a git
+    revision"""
+
+    filepath = f'annotations/{gv}/{at}/probe_infos.csv.zip'
+    old = load_versioned_probe_infos(filepath, revision)
+    new = load_versioned_probe_infos(filepath)
+    if old is None or new is None:
+        if old is not None or new is not None:
+            LOGGER.info(f'{filepath} {"added" if old is None else "removed"} since {revision}')
+        return None
+
+    with RECORDER.stage('compare', rows_in=len(old) + len(new)):
+        report, mismatches = diff_probe_infos(old, new, left_name='old', right_name='new')
+    LOGGER.info(f'{filepath} : {"unchanged" if report["identical"] else "changed"} since {revision}\n'
+                f'{format_diff(report)}')
+    if output_dir is not None:
+        save_diff(report, mismatches, f'{output_dir}/{gv}_{at}.release', output_format)
+    return summarize(report)
+
+
+if __name__ == '__main__':
+    parser = get_parser(__doc__, 'compare_summary.json')
+    parser.add_argument('--release', metavar='REVISION', default=None,
+                        help='compare the versioned annotations with their version at this git revision (e.g. HEAD, '
+                             'a tag) instead of comparing SeSAMe and Illumina manifests')
+    parser.add_argument('--output', default=None, help='folder where the diff reports are saved. Default: not saved')
+    parser.add_argument('--format', choices=['json', 'parquet'], default='json',
+                        help='json: report with counts and sample rows. parquet: also save all the differences')
+    args = parser.parse_args()
+    combinations = get_combinations()
+    if args.release is not None:
+        compare = partial(compare_releases, revision=args.release, output_dir=args.output, output_format=args.format)
+        results = run_all(compare, combinations, args.jobs, profile_dir=args.profile)
+    else:
+        os.makedirs(root_dir, exist_ok=True)
+        links = {(at, gv): get_links(at, gv, illumina=True) for at, gv in combinations}
+        compare = partial(compare_manifests, output_dir=args.output, output_format=args.format,
+                          dtype_policy=args.dtypes)
+        results = run_all(compare, combinations, args.jobs, initializer=configure_cache,
+                          initargs=(args.offline, args.revalidate), links=links, max_downloads=args.downloads,
+                          profile_dir=args.profile)
+    write_summary(results, args.summary)
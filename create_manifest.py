@@ -1,33 +1,199 @@
 """Create manifests for every combination of Array Type * Genome version from Illumina or SeSAMe annotation"""
 
+import glob
 import os.path
+from functools import partial
 
 from pylluminator.annotations import ArrayType, GenomeVersion
 from pylluminator.utils import get_logger
 
+from annotation_cache import ANNOTATION_CACHE
+from columnar import has_pyarrow, read_parquet, write_parquet
+from download_cache import configure_cache
+from instrumentation import RECORDER, file_size
+from manifest_diff import read_probe_infos_csv
+from normalization import default_dtypes
+from position_index import PositionIndex, read_cytobands
+from prefetch import get_links
+from probe_catalog import read_catalog_metadata, write_catalog
+from probe_tables import write_probe_tables
+from provenance import input_records, is_up_to_date, make_provenance, write_provenance
+from scheduler import get_parser, get_combinations, run_all, write_summary
 from sesame_annotations import SesameAnnotations
+from term_index import TermBitset, count_decoding_errors, encode_probe_infos, save_encoded
+from validation import format_violations, read_gaps, read_seq_lengths, validate_probe_infos
 import pandas as pd
 
 LOGGER = get_logger()
 
 root_dir = '_generated_data/annotations'
-os.makedirs(root_dir, exist_ok=True)
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 1000)
 
-for at in ArrayType:
-    for gv in GenomeVersion:
-        if at.is_human() != gv.is_human():
-            continue
-        LOGGER.info(f'\n------------------- {gv} {at}')
-        anno_sesame = SesameAnnotations(at, gv)
 
-        if anno_sesame.manifest is None:
+def write_stage(output_format: str, probe_infos: pd.DataFrame, write, *filepaths: str) -> list[str]:
+    """Run `write()` as a recorded write stage, with the total size of the files it writes
+
+    :return: the written files
+    :rtype: list[str]"""
+    with RECORDER.stage('write', rows_in=len(probe_infos), format=output_format) as record:
+        write()
+        record['bytes_written'] = sum(file_size(filepath) or 0 for filepath in filepaths)
+    return list(filepaths)
+
+
+def build_manifest(at: ArrayType, gv: GenomeVersion, chunksize: int | None = None, probe_tables=False,
+                   strict=False, force=False, dtype_policy: str = 'default', positions=False,
+                   parquet=False) -> dict | None:
+    """Create the probe_infos file of one array type and genome version from SeSAMe annotation. If `probe_tables` is
+    True, also write its normalized version (probes.csv and addresses.csv). If `positions` is True, also save the
+    position index of the probes (probe_infos.positions.npy and .json, see `position_index`). If `parquet` is True and
+    pyarrow is installed, also write probe_infos.parquet (see `columnar.write_parquet`).
+
+    Probe infos are validated against the genome info files before being written (see `validation`), the report is
+    added to the build summary. If `strict` is True, the build fails instead of writing probe infos with violations.
+    `dtype_policy` sets the dtypes of the probe infos in memory (see `normalization.apply_dtype_policy`), the written
+    files are the same with all the policies, so it's not a parameter of the provenance.
+
+    The inputs (SeSAMe files and genome info files), pipeline version and parameters of the build are recorded in
+    provenance.json, with the written files. Unless `force` is True, a combination whose provenance didn't change is
+    not built again."""
+    LOGGER.info(f'\n------------------- {gv} {at}')
+    current_dir = f'{root_dir}/{gv}/{at}/'
+    inputs = input_records(get_links(at, gv), glob.glob(f'genome_info/{gv}/*'))
+    provenance = None if inputs is None else \
+        make_provenance(inputs, {'chunksize': chunksize, 'probe_tables': probe_tables, 'strict': strict,
+                                 'positions': positions, 'parquet': parquet})
+    previous = None if force or provenance is None else is_up_to_date(current_dir, provenance)
+    if previous is not None:
+        LOGGER.info(f'{gv} {at} : inputs unchanged since the build of {previous["built_at"]}, skipping')
+        return {**previous['details'], 'unchanged': True}
+
+    anno_sesame = SesameAnnotations(at, gv, chunksize=chunksize, dtype_policy=dtype_policy)
+
+    if anno_sesame.manifest is None:
+        return None
+    os.makedirs(current_dir, exist_ok=True)
+
+    if anno_sesame.probe_infos is None:
+        return None
+
+    probe_infos = anno_sesame.probe_infos
+    with RECORDER.stage('validate', rows_in=len(probe_infos)) as record:
+        # the position index counts the probes in gaps, and is saved below if requested
+        position_index = PositionIndex.from_probe_infos(probe_infos, read_cytobands(gv))
+        validation = validate_probe_infos(probe_infos, read_seq_lengths(gv), read_gaps(gv), position_index)
+        record['violations'] = sum(violation['count'] for violation in validation['violations'].values())
+    if len(validation['violations']) > 0:
+        LOGGER.warning(f'{gv} {at} probe infos violations :\n{format_violations(validation)}')
+        if strict:
+            raise ValueError(f'{len(validation["violations"])} validation check(s) failed for {gv} {at}')
+    LOGGER.info(f'saving {current_dir}/probe_infos.csv')
+    outputs = write_stage('csv', probe_infos, lambda: probe_infos.to_csv(f'{current_dir}/probe_infos.csv'),
+                          f'{current_dir}/probe_infos.csv')
+    if parquet and has_pyarrow():
+        LOGGER.info(f'saving {current_dir}/probe_infos.parquet')
+        # the parquet file keeps the column types : write it with the default ones, whatever the dtype policy
+        outputs += write_stage('parquet', probe_infos,
+                               lambda: write_parquet(default_dtypes(probe_infos), f'{current_dir}/probe_infos.parquet'),
+                               f'{current_dir}/probe_infos.parquet')
+    elif parquet:
+        LOGGER.info('pyarrow is not installed, skipping probe_infos.parquet')
+    with RECORDER.stage('normalize', rows_in=len(probe_infos), kind='terms'):
+        encoded = encode_probe_infos(probe_infos)
+        # bitsets only keep the order of the terms if all the probes list them in the same order
+        decoding_errors = {column: count_decoding_errors(probe_infos[column], encoded_column)
+                           for column, encoded_column in encoded.items() if isinstance(encoded_column, TermBitset)}
+    for column, nb_errors in decoding_errors.items():
+        if nb_errors > 0:
+            LOGGER.warning(f'{gv} {at} : {nb_errors} {column} values are not decoded back from their encoding')
+    LOGGER.info(f'saving {current_dir}/probe_infos.terms.npz')
+    outputs += write_stage('terms', probe_infos,
+                           lambda: save_encoded(encoded, probe_infos.index, f'{current_dir}/probe_infos.terms.npz'),
+                           f'{current_dir}/probe_infos.terms.npz')
+    if positions:
+        LOGGER.info(f'saving {current_dir}/probe_infos.positions.npy and .json')
+        outputs += write_stage('positions', probe_infos,
+                               lambda: position_index.save(f'{current_dir}/probe_infos.positions'),
+                               f'{current_dir}/probe_infos.positions.npy', f'{current_dir}/probe_infos.positions.json')
+    if probe_tables:
+        LOGGER.info(f'saving {current_dir}/probes.csv and addresses.csv')
+        outputs += write_stage('probe_tables', probe_infos, lambda: write_probe_tables(probe_infos, current_dir),
+                               f'{current_dir}/probes.csv', f'{current_dir}/addresses.csv')
+    LOGGER.debug(f'annotation cache : {ANNOTATION_CACHE.stats()}')
+    details = {'rows': len(probe_infos), 'output': f'{current_dir}probe_infos.csv', 'validation': validation}
+    if sum(decoding_errors.values()) > 0:
+        details['decoding_errors'] = decoding_errors
+    if anno_sesame.gene_agreement is not None:
+        details['gene_agreement'] = anno_sesame.gene_agreement
+    if provenance is not None:
+        write_provenance(current_dir, provenance, outputs, details)
+    return details
+
+
+def build_catalogs(results: list[dict]) -> None:
+    """Write the probe catalog of each genome version from the probe_infos files of its array types built successfully,
+    see `probe_catalog.write_catalog`"""
+    built = {}
+    for result in results:
+        if result['status'] == 'ok':
+            built.setdefault(result['genome_version'], []).append(result)
+
+    for gv, gv_results in built.items():
+        array_types = [result['array_type'] for result in gv_results]
+        catalog_metadata = read_catalog_metadata(f'{root_dir}/{gv}')
+        if all(result['details'].get('unchanged') for result in gv_results) and catalog_metadata is not None \
+                and list(catalog_metadata['arrays']) == array_types:
+            LOGGER.info(f'{gv} probe catalog : no array type changed, skipping')
             continue
-        current_dir = f'{root_dir}/{gv}/{at}/'
-        os.makedirs(current_dir, exist_ok=True)
+        RECORDER.start_task(f'{gv}_catalog')
+        probe_infos = {}
+        for at in array_types:
+            current_dir = f'{root_dir}/{gv}/{at}'
+            parquet_file = f'{current_dir}/probe_infos.parquet'
+            with RECORDER.stage('parse', kind='probe_infos', array_type=at) as record:
+                probe_infos[at] = read_parquet(parquet_file) if has_pyarrow() and os.path.exists(parquet_file) \
+                    else read_probe_infos_csv(f'{current_dir}/probe_infos.csv')
+                record['rows_out'] = len(probe_infos[at])
+        nb_rows = sum(len(df) for df in probe_infos.values())
+        LOGGER.info(f'saving the probe catalog of {gv} ({", ".join(array_types)})')
+        with RECORDER.stage('write', rows_in=nb_rows, format='catalog') as record:
+            filepaths = write_catalog(probe_infos, f'{root_dir}/{gv}')
+            record['bytes_written'] = sum(file_size(filepath) or 0 for filepath in filepaths)
+        stages = RECORDER.finish_task()
+        LOGGER.info(f'{gv} probe catalog : {nb_rows} probe infos rows in {len(array_types)} array types, '
+                    f'{stages[-1]["bytes_written"] / 1e6:.1f} MB written in {sum(s["seconds"] for s in stages):.1f}s')
+
 
-        if anno_sesame.probe_infos is not None:
-            LOGGER.info(f'saving {current_dir}/probe_infos.csv')
-            anno_sesame.probe_infos.to_csv(f'{current_dir}/probe_infos.csv')
+if __name__ == '__main__':
+    parser = get_parser(__doc__)
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='stream the SeSAMe files by chunks of this number of rows to limit memory usage')
+    parser.add_argument('--probe-tables', action='store_true',
+                        help='also write probe_infos as a probe table and an address table, without type I duplicates')
+    parser.add_argument('--strict', action='store_true',
+                        help='fail the combinations whose probe infos break a validation check instead of writing them')
+    parser.add_argument('--force', action='store_true',
+                        help='build all the combinations, even the ones whose inputs didn\'t change since the last build')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write probe_infos.parquet, with the column types and a row group per chromosome '
+                             '(requires pyarrow)')
+    parser.add_argument('--positions', action='store_true',
+                        help='also save the position index of the probes (probe_infos.positions.npy and .json)')
+    parser.add_argument('--catalog', action='store_true',
+                        help='also write a probe catalog per genome version, shared by its array types, and a thin '
+                             'table per array type, in addition to the probe_infos files')
+    args = parser.parse_args()
+    os.makedirs(root_dir, exist_ok=True)
+    combinations = get_combinations()
+    links = {(at, gv): get_links(at, gv) for at, gv in combinations}
+    build = partial(build_manifest, chunksize=args.chunksize, probe_tables=args.probe_tables,
+                    strict=args.strict, force=args.force, dtype_policy=args.dtypes, positions=args.positions,
+                    parquet=args.parquet)
+    results = run_all(build, combinations, args.jobs, initializer=configure_cache,
+                      initargs=(args.offline, args.revalidate), links=links, max_downloads=args.downloads,
+                      profile_dir=args.profile)
+    write_summary(results, args.summary)
+    if args.catalog:
+        build_catalogs(results)
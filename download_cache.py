@@ -0,0 +1,202 @@
+"""Cache of the downloaded annotation files, keyed by URL, with integrity metadata and an offline mode"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from pylluminator.utils import get_resource_folder, convert_to_path, get_logger
+
+from instrumentation import RECORDER, file_size
+
+LOGGER = get_logger()
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def url_key(url: str) -> str:
+    """Name of the cache entry of an url"""
+    return hashlib.sha256(url.encode()).hexdigest()[:16]
+
+
+def file_checksum(filepath: str | os.PathLike) -> str:
+    """Sha256 of a file content, read by chunks"""
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class DownloadCache:
+    """Files downloaded from an url are stored in `<cache_dir>/<url key>/<url basename>`, next to a `metadata.json` file
+    holding the url, size, sha256 checksum and HTTP validators (ETag, Last-Modified) of the download. Files with the
+    same name but different urls (e.g. the KYCG CGI files of each array) don't collide, and a file is only downloaded
+    once.
+
+    :ivar cache_dir: root folder of the cache
+    :vartype cache_dir: pathlib.Path
+
+    :ivar offline: if True, never access the network and raise a FileNotFoundError when a file is not cached
+    :vartype offline: bool
+
+    :ivar revalidate: if True, ask the server if cached files are still up to date (conditional request) and download
+        them again if they changed
+    :vartype revalidate: bool
+
+    :ivar verify: if True, check the checksum of cached files before using them, not only their size
+    :vartype verify: bool
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike | None = None, offline=False, revalidate=False, verify=False,
+                 timeout: float = 60):
+        if cache_dir is None:
+            cache_dir = get_resource_folder('tmp.cache')
+        self.cache_dir = convert_to_path(cache_dir)
+        self.offline = offline
+        self.revalidate = revalidate
+        self.verify = verify
+        self.timeout = timeout
+
+    def entry_dir(self, url: str) -> Path:
+        """Folder of the cache entry of an url"""
+        return self.cache_dir.joinpath(url_key(url))
+
+    def path(self, url: str) -> Path:
+        """Path of the cached file of an url (whether it exists or not)"""
+        return self.entry_dir(url).joinpath(url.split('/')[-1])
+
+    def metadata(self, url: str) -> dict | None:
+        """Metadata of the cached file of an url, None if the url is not cached"""
+        metadata_path = self.entry_dir(url).joinpath('metadata.json')
+        if not metadata_path.exists():
+            return None
+        with open(metadata_path) as f:
+            return json.load(f)
+
+    def is_cached(self, url: str) -> bool:
+        """Check that the url was downloaded and that the file matches its metadata (size, and checksum if `verify`
+        is True)"""
+        metadata = self.metadata(url)
+        filepath = self.path(url)
+        if metadata is None or not filepath.exists():
+            return False
+        if filepath.stat().st_size != metadata['size']:
+            LOGGER.warning(f'cached file {filepath} has an unexpected size')
+            return False
+        if self.verify and file_checksum(filepath) != metadata['sha256']:
+            LOGGER.warning(f'cached file {filepath} has an unexpected checksum')
+            return False
+        return True
+
+    def fetch(self, url: str) -> Path | None:
+        """Get the local path of an url's file, downloading it if it's not cached yet.
+
+        :param url: link to the file
+        :type url: str
+
+        :return: path to the cached file, or None if the download failed
+        :rtype: pathlib.Path | None"""
+
+        cached = self.is_cached(url)
+
+        if self.offline:
+            if not cached:
+                raise FileNotFoundError(f'offline mode : {url} is not in the cache {self.cache_dir}')
+            return self.path(url)
+
+        if cached and not self.revalidate:
+            LOGGER.debug(f'using cached file {self.path(url)}')
+            return self.path(url)
+
+        return self._download(url, self.metadata(url) if cached else None)
+
+    def _download(self, url: str, metadata: dict | None = None) -> Path | None:
+        """Download the url in the cache. If metadata is given, the request is conditional and the cached file is kept
+        when the server answers that it's not modified."""
+
+        request = urllib.request.Request(url)
+        if metadata is not None:
+            if metadata.get('etag'):
+                request.add_header('If-None-Match', metadata['etag'])
+            if metadata.get('last_modified'):
+                request.add_header('If-Modified-Since', metadata['last_modified'])
+
+        entry_dir = self.entry_dir(url)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        LOGGER.info(f'{"downloading" if metadata is None else "revalidating"} {url}')
+        checksum = hashlib.sha256()
+        tmp_path = None
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                # write in a temporary file first, so that another process never reads a partial file
+                with tempfile.NamedTemporaryFile('wb', dir=entry_dir, delete=False) as tmp_file:
+                    tmp_path = tmp_file.name
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                        checksum.update(chunk)
+                        tmp_file.write(chunk)
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and metadata is not None:
+                LOGGER.debug(f'{url} not modified, using cached file')
+                return self.path(url)
+            LOGGER.error(f'download from {url} failed ({e.code} {e.reason})')
+            return None
+        except (urllib.error.URLError, OSError) as e:
+            LOGGER.error(f'download from {url} failed ({e})')
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+        filepath = self.path(url)
+        os.replace(tmp_path, filepath)
+        self.save_metadata(url, checksum.hexdigest(), headers.get('ETag'), headers.get('Last-Modified'))
+
+        LOGGER.info(f'download successful in {filepath}')
+        return filepath
+
+    def save_metadata(self, url: str, sha256: str, etag: str | None = None, last_modified: str | None = None) -> None:
+        """Record the metadata of a file that was just downloaded in the cache"""
+        metadata = {'url': url, 'size': self.path(url).stat().st_size, 'sha256': sha256, 'etag': etag,
+                    'last_modified': last_modified, 'downloaded_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        entry_dir = self.entry_dir(url)
+        with tempfile.NamedTemporaryFile('w', dir=entry_dir, delete=False) as tmp_file:
+            json.dump(metadata, tmp_file, indent=2)
+        os.replace(tmp_file.name, entry_dir.joinpath('metadata.json'))
+
+    def clear(self) -> None:
+        """Delete all the cached files"""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+_default_cache = None
+
+
+def configure_cache(offline=False, revalidate=False, verify=False, cache_dir: str | os.PathLike | None = None) -> None:
+    """Set the options of the cache used by `fetch`. Used as process pool initializer so that workers share the
+    options of the main process."""
+    global _default_cache
+    _default_cache = DownloadCache(cache_dir, offline=offline, revalidate=revalidate, verify=verify)
+
+
+def get_cache() -> DownloadCache:
+    """Get the cache used by `fetch`, with default options if `configure_cache` wasn't called"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DownloadCache()
+    return _default_cache
+
+
+def fetch(url: str) -> Path | None:
+    """Get the local path of an url's file from the default cache, downloading it if needed"""
+    cache = get_cache()
+    with RECORDER.stage('download', url=url, cached=cache.path(url).exists()) as record:
+        filepath = cache.fetch(url)
+        record['bytes_read'] = file_size(filepath)
+    return filepath
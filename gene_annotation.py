@@ -0,0 +1,207 @@
+"""Annotate probes with the genes whose transcripts overlap them, from the transcripts model of the genome info files.
+Used for the combinations that have no SeSAMe gene annotation."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.annotations import GenomeVersion
+from pylluminator.utils import get_logger
+
+from instrumentation import RECORDER, file_size
+from knowledgebases import aggregate_by_probe
+
+LOGGER = get_logger()
+
+TRANSCRIPTS_FILE = 'genome_info/{genome_version}/transcripts_exons.csv.zip'
+
+# promoter region, in bp upstream and downstream of the transcription start site
+PROMOTER_WINDOW = (1500, 0)
+
+
+def read_transcripts(genome_version: GenomeVersion | str, filepath: str | os.PathLike | None = None) \
+        -> pd.DataFrame | None:
+    """Read the transcripts model of a genome version from the versioned genome info files
+
+    :param filepath: path of the transcripts file. Default: None, use `genome_info/<genome version>/transcripts_exons.csv.zip`
+    :type filepath: str | os.PathLike | None
+
+    :return: one row per transcript, None if the file doesn't exist
+    :rtype: pandas.DataFrame | None"""
+
+    if filepath is None:
+        filepath = TRANSCRIPTS_FILE.format(genome_version=genome_version)
+    if not os.path.exists(filepath):
+        LOGGER.info(f'no transcripts file {filepath}')
+        return None
+    with RECORDER.stage('parse', bytes_read=file_size(filepath), kind='transcripts') as record:
+        transcripts = pd.read_csv(filepath, usecols=['chromosome', 'transcript_start', 'transcript_end',
+                                                     'transcript_strand', 'transcript_id', 'gene_name', 'gene_id',
+                                                     'transcript_type'],
+                                  dtype={'chromosome': 'category', 'transcript_strand': 'category'})
+        record['rows_out'] = len(transcripts)
+    return transcripts
+
+
+class TranscriptIndex:
+    """Intervals of the transcripts (body and promoter) indexed per chromosome and sorted by start, so that all the probes
+    are annotated with a vectorized binary search instead of one interval query per probe.
+
+    Coordinates are 1-based and inclusive, like the transcripts file.
+
+    :ivar transcripts: the indexed transcripts, with their `region_start` and `region_end`
+    :vartype transcripts: pandas.DataFrame
+
+    :ivar intervals: per chromosome, the transcript regions sorted by start (arrays start, end, max_end and row of the
+        transcript in `transcripts`)
+    :vartype intervals: dict[str, dict[str, numpy.ndarray]]
+    """
+
+    def __init__(self, transcripts: pd.DataFrame, promoter_window: tuple[int, int] = PROMOTER_WINDOW,
+                 include_body=True):
+        """Index the regions of the transcripts.
+
+        :param transcripts: transcripts with columns chromosome, transcript_start, transcript_end, transcript_strand
+            and gene_name
+        :type transcripts: pandas.DataFrame
+
+        :param promoter_window: bp upstream and downstream of the transcription start site (strand-aware) included in
+            the region of each transcript. Default: (1500, 0)
+        :type promoter_window: tuple[int, int]
+
+        :param include_body: set to False to only use the promoter window, not the transcript body. Default: True
+        :type include_body: bool"""
+
+        upstream, downstream = promoter_window
+        transcripts = transcripts.dropna(subset=['gene_name']).reset_index(drop=True)
+        starts = transcripts['transcript_start'].to_numpy(dtype='int64')
+        ends = transcripts['transcript_end'].to_numpy(dtype='int64')
+        reverse = (transcripts['transcript_strand'] == '-').to_numpy()
+
+        # the TSS is the start of + strand transcripts, and the end of - strand transcripts
+        tss = np.where(reverse, ends, starts)
+        promoter_starts = np.where(reverse, tss - downstream, tss - upstream)
+        promoter_ends = np.where(reverse, tss + upstream, tss + downstream)
+        if include_body:
+            transcripts['region_start'] = np.minimum(starts, promoter_starts)
+            transcripts['region_end'] = np.maximum(ends, promoter_ends)
+        else:
+            transcripts['region_start'] = promoter_starts
+            transcripts['region_end'] = promoter_ends
+        self.transcripts = transcripts
+
+        self.intervals = {}
+        for chromosome, rows in transcripts.groupby('chromosome', observed=True, sort=False).indices.items():
+            rows = rows[np.argsort(transcripts['region_start'].to_numpy()[rows], kind='stable')]
+            region_ends = transcripts['region_end'].to_numpy()[rows]
+            self.intervals[str(chromosome)] = {'start': transcripts['region_start'].to_numpy()[rows],
+                                               'end': region_ends,
+                                               'max_end': np.maximum.accumulate(region_ends),
+                                               'row': rows}
+
+        LOGGER.info(f'{len(transcripts)} transcripts indexed on {len(self.intervals)} chromosomes')
+
+    @classmethod
+    def from_genome_version(cls, genome_version: GenomeVersion | str, promoter_window: tuple[int, int] = PROMOTER_WINDOW,
+                            include_body=True):
+        """Index the transcripts of a genome version, read from the versioned genome info files.
+
+        :return: the index, or None if there is no transcripts file for this genome version
+        :rtype: TranscriptIndex | None"""
+
+        transcripts = read_transcripts(genome_version)
+        if transcripts is None:
+            return None
+        return cls(transcripts, promoter_window, include_body)
+
+    def overlaps(self, chromosomes: pd.Series | np.ndarray, starts: pd.Series | np.ndarray,
+                 ends: pd.Series | np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Find all the (query, transcript) pairs whose intervals overlap.
+
+        :param chromosomes: chromosome of each query, without 'chr' prefix
+        :type chromosomes: pandas.Series | numpy.ndarray
+
+        :param starts: 1-based first position of each query. NA values never overlap
+        :type starts: pandas.Series | numpy.ndarray
+
+        :param ends: 1-based last position of each query
+        :type ends: pandas.Series | numpy.ndarray
+
+        :return: the index of the queries and the row of the transcripts in `transcripts`, one element per overlap
+        :rtype: tuple[numpy.ndarray, numpy.ndarray]"""
+
+        chromosomes = pd.Series(np.asarray(chromosomes, dtype=object))
+        starts = pd.Series(np.asarray(starts)).astype('Int64').to_numpy(dtype='int64', na_value=-1)
+        ends = pd.Series(np.asarray(ends)).astype('Int64').to_numpy(dtype='int64', na_value=-1)
+
+        query_idxs, transcript_rows = [], []
+        for chromosome, idxs in chromosomes.groupby(chromosomes, sort=False).indices.items():
+            if str(chromosome) not in self.intervals:
+                continue
+            intervals = self.intervals[str(chromosome)]
+            idxs = idxs[starts[idxs] >= 0]
+            query_starts, query_ends = starts[idxs], ends[idxs]
+
+            # last interval starting before the end of each query, then walk back while an earlier interval can still
+            # reach the start of the query
+            candidates = np.searchsorted(intervals['start'], query_ends, side='right') - 1
+            active = np.flatnonzero(candidates >= 0)
+            while len(active) > 0:
+                interval_idxs = candidates[active]
+                hit = intervals['end'][interval_idxs] >= query_starts[active]
+                query_idxs.append(idxs[active[hit]])
+                transcript_rows.append(intervals['row'][interval_idxs[hit]])
+                candidates[active] -= 1
+                previous = candidates[active]
+                active = active[(previous >= 0) & (intervals['max_end'][np.maximum(previous, 0)] >= query_starts[active])]
+
+        if len(query_idxs) == 0:
+            return np.array([], dtype='int64'), np.array([], dtype='int64')
+        return np.concatenate(query_idxs), np.concatenate(transcript_rows)
+
+    def annotate(self, chromosomes: pd.Series | np.ndarray, starts: pd.Series | np.ndarray,
+                 ends: pd.Series | np.ndarray, column: str = 'gene_name', separator: str = ';') -> np.ndarray:
+        """List the distinct values of a transcripts column (gene names by default) overlapping each query, sorted
+        alphabetically and joined with `separator` like SeSAMe's `genesUniq` column. Arguments are the same as for
+        `overlaps`.
+
+        :return: the joined values of each query, None if no transcript overlaps it
+        :rtype: numpy.ndarray"""
+
+        query_idxs, transcript_rows = self.overlaps(chromosomes, starts, ends)
+        result = np.full(len(chromosomes), None, dtype=object)
+        if len(query_idxs) == 0:
+            return result
+
+        # sort the pairs by query, then alphabetically, and remove the duplicated values of a query
+        codes, values = pd.factorize(self.transcripts[column].to_numpy()[transcript_rows], sort=True)
+        order = np.lexsort((codes, query_idxs))
+        query_idxs, codes = query_idxs[order], codes[order]
+        is_first = np.r_[True, (query_idxs[1:] != query_idxs[:-1]) | (codes[1:] != codes[:-1])]
+
+        aggregated = aggregate_by_probe(pd.Series(values[codes[is_first]], index=query_idxs[is_first]), separator)
+        result[aggregated.index.to_numpy()] = aggregated.to_numpy()
+        return result
+
+
+def annotate_genes(manifest: pd.DataFrame, index: TranscriptIndex) -> np.ndarray:
+    """Genes of each probe of a manifest, from its chromosome, start (0-based) and end columns"""
+    return index.annotate(manifest['chromosome'].astype(object), manifest['start'] + 1, manifest['end'])
+
+
+def compare_gene_sets(genes: pd.Series, reference: pd.Series, separator: str = ';') -> dict:
+    """Compare two gene annotations of the same probes (e.g. local annotation vs SeSAMe's `genes_uniq`) as sets of
+    genes, ignoring their order.
+
+    :return: number of probes annotated in both, with the same genes, and annotated by only one of them
+    :rtype: dict"""
+
+    def to_sets(values: pd.Series) -> pd.Series:
+        return values.dropna().map(lambda x: frozenset(x.split(separator)))
+
+    genes, reference = to_sets(genes), to_sets(reference)
+    common = genes.index.intersection(reference.index)
+    return {'both': len(common), 'same_genes': int((genes[common] == reference[common]).sum()),
+            'only_annotated': len(genes.index.difference(reference.index)),
+            'only_reference': len(reference.index.difference(genes.index))}
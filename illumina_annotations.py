@@ -1,35 +1,158 @@
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import zipfile
+
 from pylluminator.annotations import ArrayType, GenomeVersion, GenomeInfo
 from pylluminator.utils import get_logger
-from pylluminator.utils import get_resource_folder, download_from_link, column_names_to_snake_case, concatenate_non_na
-from pyliftover import LiftOver
+from pylluminator.utils import get_resource_folder, column_names_to_snake_case, convert_to_path
 
+import numpy as np
 import pandas as pd
 
+from download_cache import fetch
+from instrumentation import RECORDER, file_size
+from liftover import ChainLiftOver
+from normalization import apply_dtype_policy, extract_probe_types, normalize_manifest
 from sesame_annotations import SesameAnnotations
 
 LOGGER = get_logger()
 
-
-def find_tokens_in_file(file_path, tokens) -> dict:
-    line_numbers = {}  # dictionary to store line numbers for each token
-
-    with open(file_path, 'r') as file:
-        for line_num, line in enumerate(file, start=1):
-            for token in tokens:
-                if token in line:
-                    line_numbers[token] = line_num
-                    break
-
-    return line_numbers
+# manifest csv file of each array type, and the link to download it (directly or in a zip archive)
+MANIFEST_FILES = {
+    # version May 23, 2013
+    ArrayType.HUMAN_450K: ('humanmethylation450_15017482_v1-2.csv',
+                           'https://webdata.illumina.com/downloads/productfiles/humanmethylation450/humanmethylation450_15017482_v1-2.csv'),
+    # version March 4, 2024
+    ArrayType.HUMAN_MSA: ('MSA-48v1-0_20102838_A1.csv',
+                          'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/infiniummethylationscreening/MSA-48v1-0_20102838_A1.csv'),
+    # version March 13, 2020
+    ArrayType.HUMAN_EPIC: ('infinium-methylationepic-v-1-0-b5-manifest-file.csv',
+                           'https://webdata.illumina.com/downloads/productfiles/methylationEPIC/infinium-methylationepic-v-1-0-b5-manifest-file-csv.zip'),
+    # version August 16, 2024
+    ArrayType.HUMAN_EPIC_V2: ('MethylationEPIC v2.0 Files/EPIC-8v2-0_A2.csv',
+                              'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/methylationepic/InfiniumMethylationEPICv2.0ProductFiles(ZIPFormat).zip'),
+    # version May 25, 2021
+    ArrayType.MOUSE_MM285: ('MouseMethylation-12v1-0_A2.csv',
+                            'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/mouse-methylation/infinium-mouse-methylation-manifest-file-csv.zip'),
+}
+
+
+def extract_member(archive_path: str | os.PathLike, member: str, filepath: str | os.PathLike) -> None:
+    """Extract one file of a zip archive to `filepath`. The file is written under a temporary name in the same folder
+    then renamed, so that another process (e.g. the worker of another genome version) never reads a partially extracted
+    file, and two processes extracting it at the same time don't write in the same file."""
+    folder = os.path.dirname(filepath)
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = None
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref, zip_ref.open(member) as source:
+            with tempfile.NamedTemporaryFile('wb', dir=folder, delete=False) as tmp_file:
+                tmp_path = tmp_file.name
+                shutil.copyfileobj(source, tmp_file)
+    except BaseException:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, filepath)
+
+
+# columns of the [Assay] section used to build the manifest (snake case names), and their type
+ASSAY_COLUMNS = {'ilmn_id': 'str', 'name': 'str', 'address_a_id': 'Int64', 'address_b_id': 'Int64',
+                 'infinium_design_type': 'category', 'design_type': 'category', 'color_channel': 'category',
+                 'chr': 'str', 'cpg_chrm': 'str', 'mapinfo': 'Int64', 'cpg_beg': 'Int64', 'cpg_end': 'Int64',
+                 'probe_strand': 'str', 'strand_fr': 'str', 'genome_build': 'str'}
+
+# the [Controls] section has no header
+CONTROLS_COLUMNS = {'address': 'Int64', 'control_type': 'category', 'color': 'category', 'extended_type': 'str'}
+
+
+def find_sections(file_path: str | os.PathLike) -> dict[str, tuple[int, int]]:
+    """Find the byte range of the content of each section ([Heading], [Assay], [Controls]...) of an Illumina manifest,
+    in one scan of the file.
+
+    :param file_path: path to the manifest csv file
+    :type file_path: str | os.PathLike
+
+    :return: the (start, end) byte offsets of each section content, excluding the section name line
+    :rtype: dict[str, tuple[int, int]]"""
+
+    if os.path.getsize(file_path) == 0:
+        return {}
+
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # section names are the only lines starting with a bracket
+        starts = [0] if data[:1] == b'[' else []
+        index = data.find(b'\n[')
+        while index != -1:
+            starts.append(index + 1)
+            index = data.find(b'\n[', index + 1)
+
+        sections = {}
+        for i, start in enumerate(starts):
+            name = data[start:data.find(b']', start) + 1].decode()
+            line_end = data.find(b'\n', start)
+            content_start = len(data) if line_end == -1 else line_end + 1
+            content_end = starts[i + 1] if i + 1 < len(starts) else len(data)
+            sections[name] = (content_start, content_end)
+
+    return sections
+
+
+class SectionReader(io.RawIOBase):
+    """Read-only binary file limited to a byte range of a file, to parse one section without reading the others"""
+
+    def __init__(self, file_path: str | os.PathLike, start: int, end: int):
+        super().__init__()
+        self._file = open(file_path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        nb_read = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= nb_read
+        return nb_read
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def read_section(file_path: str | os.PathLike, byte_range: tuple[int, int], **kwargs) -> pd.DataFrame:
+    """Read the csv content in the byte range of a file, extra arguments are passed to pandas.read_csv"""
+    with io.BufferedReader(SectionReader(file_path, *byte_range), buffer_size=1024 * 1024) as section:
+        return pd.read_csv(section, **kwargs)
 
 
 class IlluminaAnnotations:
     """Extract meaningful information from Illumina data files, and create dataframes with pylluminator format"""
 
-    def __init__(self, array_type: ArrayType, genome_version: GenomeVersion):
+    def __init__(self, array_type: ArrayType, genome_version: GenomeVersion, mask: pd.DataFrame | None = None,
+                 dtype_policy: str = 'default'):
+        """Load the Illumina manifest and create the probe infos
+
+        :param array_type: illumina array type (EPIC, MSA...)
+        :type array_type: ArrayType
+        :param genome_version: genome version to use (hg38, mm10...)
+        :type genome_version: GenomeVersion
+        :param mask: SeSAMe mask of the same array type and genome version, if it's already loaded. Default: None, the
+            mask is loaded from SeSAMe data
+        :type mask: pandas.DataFrame | None
+        :param dtype_policy: dtypes of the probe infos columns, see `normalization.apply_dtype_policy`. Default: 'default'
+        :type dtype_policy: str"""
         LOGGER.info('Loading Illumina annotations')
         self.array_type = array_type
         self.genome_version = genome_version
+        self.dtype_policy = dtype_policy
+        self.controls = None
         self.manifest = self.load_manifest()
         if self.manifest is None:
             self.genome_info = None
@@ -37,67 +160,52 @@ class IlluminaAnnotations:
             self.probe_infos = None
             return
         self.genome_info = GenomeInfo('default', genome_version)
-        self.mask = self.load_mask()
+        self.mask = self.load_mask() if mask is None else mask
         self.probe_infos = self.make_pylluminator_probe_info()
 
     def load_manifest(self) -> pd.DataFrame | None:
-        """Download or read a manifest file
+        """Download or read a manifest file. The control probes of the [Controls] section are stored in `controls`.
 
         :return: the manifest as a dataframe
         :rtype: pandas.DataFrame | None"""
 
         # get the annotation resource folder
-        data_folder = get_resource_folder('tmp')
-
-        if self.array_type == ArrayType.HUMAN_450K:
-            filename = 'humanmethylation450_15017482_v1-2.csv'
-        elif self.array_type == ArrayType.HUMAN_MSA:
-            filename = 'MSA-48v1-0_20102838_A1.csv'
-        elif self.array_type == ArrayType.HUMAN_EPIC:
-            filename = 'infinium-methylationepic-v-1-0-b5-manifest-file.csv'
-        elif self.array_type == ArrayType.HUMAN_EPIC_V2:
-            filename = 'MethylationEPIC v2.0 Files/EPIC-8v2-0_A2.csv'
-        elif self.array_type == ArrayType.MOUSE_MM285:
-            filename = 'MouseMethylation-12v1-0_A2.csv'
-        else:
+        data_folder = convert_to_path(get_resource_folder('tmp'))
+
+        if self.array_type not in MANIFEST_FILES:
             LOGGER.warning(f'Illumina annotation : unsupported array type {self.array_type}')
             return None
 
+        filename, dl_link = MANIFEST_FILES[self.array_type]
         filepath = data_folder.joinpath(filename)
 
         # if the csv manifest file doesn't exist, download it from illumina
         if not filepath.exists():
-
-            if self.array_type == ArrayType.HUMAN_450K:
-                # version May 23, 2013
-                dl_link = 'https://webdata.illumina.com/downloads/productfiles/humanmethylation450/humanmethylation450_15017482_v1-2.csv'
-            elif self.array_type == ArrayType.HUMAN_MSA:
-                # version March 4, 2024
-                dl_link = 'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/infiniummethylationscreening/MSA-48v1-0_20102838_A1.csv'
-            elif self.array_type == ArrayType.HUMAN_EPIC:
-                # version March 13, 2020
-                dl_link = 'https://webdata.illumina.com/downloads/productfiles/methylationEPIC/infinium-methylationepic-v-1-0-b5-manifest-file-csv.zip'
-            elif self.array_type == ArrayType.HUMAN_EPIC_V2:
-                # version August 16, 2024
-                dl_link = 'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/methylationepic/InfiniumMethylationEPICv2.0ProductFiles(ZIPFormat).zip'
-            elif self.array_type == ArrayType.MOUSE_MM285:
-                # version May 25, 2021
-                dl_link = 'https://support.illumina.com/content/dam/illumina-support/documents/downloads/productfiles/mouse-methylation/infinium-mouse-methylation-manifest-file-csv.zip'
-            else:
-                LOGGER.warning(f'Unsupported array type {self.array_type}')
-                return None
-
-            return_status = download_from_link(dl_link, data_folder, decompress=True)
-            if return_status == -1:
+            downloaded_file = fetch(dl_link)
+            if downloaded_file is None:
                 return None
-
-        tokens = ['[Controls]', '[Assay]']
-        line_numbers = find_tokens_in_file(filepath, tokens)
-        start_row = line_numbers['[Assay]'] if '[Assay]' in line_numbers else 0
-        total_nrow = line_numbers['[Controls]'] - start_row - len(line_numbers) if '[Controls]' in line_numbers else None
-
-        # now read the downloaded manifest file
-        df = pd.read_csv(str(filepath), delimiter=',', skiprows=start_row, nrows=total_nrow, low_memory=False)
+            if downloaded_file.suffix == '.zip':
+                extract_member(downloaded_file, filename, filepath)
+            else:
+                filepath = downloaded_file
+
+        with RECORDER.stage('parse', bytes_read=file_size(filepath), kind='illumina_manifest') as record:
+            sections = find_sections(filepath)
+            assay_range = sections.get('[Assay]', (0, os.path.getsize(filepath)))
+
+            # only read the needed columns, with their final type
+            columns = read_section(filepath, assay_range, nrows=0).columns
+            snake_columns = column_names_to_snake_case(pd.DataFrame(columns=columns)).columns
+            dtypes = {col: ASSAY_COLUMNS[snake_col] for col, snake_col in zip(columns, snake_columns)
+                      if snake_col in ASSAY_COLUMNS}
+            df = read_section(filepath, assay_range, usecols=list(dtypes), dtype=dtypes)
+
+            # control probes are listed in their own section
+            if '[Controls]' in sections:
+                self.controls = read_section(filepath, sections['[Controls]'], header=None, usecols=range(4),
+                                             names=list(CONTROLS_COLUMNS), dtype=CONTROLS_COLUMNS)
+                self.controls = self.controls.dropna(subset='address').set_index('address')
+            record['rows_out'] = len(df)
 
         # uniformization - who likes camel case ?
         df = column_names_to_snake_case(df)
@@ -107,7 +215,7 @@ class IlluminaAnnotations:
         df['probe_id'] = df['ilmn_id'] if 'ilmn_id' in df.columns else df['name']
 
         # extract probe type from probe id (first letters, identifies control probes, snp...)
-        df['probe_type'] = df['probe_id'].str.extract(r'^([a-zA-Z]+)')
+        df['probe_type'] = extract_probe_types(df['probe_id'])
 
         df = df.rename(columns={'design_type': 'type', 'infinium_design_type': 'type',
                                 'cpg_chrm': 'chromosome', 'chr': 'chromosome',
@@ -125,75 +233,52 @@ class IlluminaAnnotations:
         if 'end' in df.columns:
             df['end'] = df['end'].astype('Int64')
 
-        # Function to perform the LiftOver conversion
-        def convert_position(row):
-            result = lo.convert_coordinate(row['chromosome'], row['start'])#, row['strand'])
-            if result:
-                new_chromosome, new_position = result[0]
-                return pd.Series([new_chromosome, new_position])
-
-            return pd.Series([row['chromosome'], row['start']])
-
-        # check if we need to lift over the genome
-        # human genome
-        print(df.columns)
-        if self.genome_version == GenomeVersion.HG19:
-            idxs_hg38 = df[df.genome_build.str.contains('38')].index
-            if  len(idxs_hg38) > 0:
-                print(f'lift over to hg19 for {len(idxs_hg38)} probes')
-                lo = LiftOver('hg38', 'hg19')
-                # todo : assignment doesnt work here, results in NAs
-                df.loc[idxs_hg38, ['chromosome', 'start']] = df.loc[idxs_hg38].apply(convert_position, axis=1)
-        elif self.genome_version == GenomeVersion.HG38:
-            idxs_hg19 = df[df.genome_build.str.contains('37')].index
-            if len(idxs_hg19) > 0:
-                print(f'lift over to hg38 for {len(idxs_hg19)} probes')
-                lo = LiftOver('hg19', 'hg38')
-                df.loc[idxs_hg19, ['chromosome', 'start']] = df.loc[idxs_hg19].apply(convert_position, axis=1)
-        # mouse genome
-        elif self.genome_version == GenomeVersion.MM10:
-            idxs_mm39 = df[df.genome_build.str.contains('mm39')].index
-            if len(idxs_mm39) > 0:
-                print(f'lift over to mm10 for {len(idxs_mm39)} probes')
-                lo = LiftOver('mm39', 'mm10')
-                df.loc[idxs_mm39, ['chromosome', 'start']] = df.loc[idxs_mm39].apply(convert_position, axis=1)
-        elif self.genome_version == GenomeVersion.MM39:
-            idxs_mm10 = df[df.genome_build.str.contains('10')].index
-            if len(idxs_mm10) > 0:
-                print(f'lift over to mm39 for {len(idxs_mm10)} probes')
-                lo = LiftOver('mm10', 'mm39')
-                df.loc[idxs_mm10, ['chromosome', 'start']] = df.loc[idxs_mm10].apply(convert_position, axis=1)
-
-        # length 2 for CpG, length 1 for SNP and CpH. beg is 0-based and end is 1-based like in bed files.
-        df['end'] = df['start'] + 2
-        df.loc[df.probe_type != 'cg', 'end'] -= 1
-
-        # set dataframes index + specific processing for manifest file
-        # for type I probes that have both address A and address B set, split them in two rows
-        df['illumina_id'] = df.apply(lambda x: concatenate_non_na(x, ['address_a', 'address_b']), axis=1)
-        df = df.explode('illumina_id', ignore_index=True)
-        df['chromosome'] = df['chromosome'].str.lower().str.replace('chr', '').str.upper()
-        # ensure channels are 'R' and 'G', not 'Red' and 'Grn'
-        df.loc[~df.channel.isna(), 'channel'] = df.loc[~df.channel.isna()].channel.str[0]
-        # turn some columns into categories as it speeds up further processing
-        ini_size = len(df)
-        df = df.dropna(subset=['illumina_id'])
-        if ini_size - len(df) > 0:
-            LOGGER.info(f'dropped {ini_size - len(df)} probes with missing illumina ID')
-        df = df.astype({'illumina_id': 'int', 'type': 'category', 'probe_type': 'category',
-                        'channel' :'category', 'chromosome': 'category'})#, 'start': 'Int64', 'end': 'Int64'}, errors='ignore')
-        df = df.set_index('illumina_id')
-        df['probe_type'] = df.probe_type.cat.rename_categories({'rs': 'snp'})  # to improve readability
-        if 'strand' not in df.columns:
-            LOGGER.info('creating probe strand column')
-            df['strand'] = '*'
+        # check if we need to lift over the genome : for each target genome version, the version of the probes to
+        # convert and the token identifying them in the genome_build column
+        liftover_sources = {GenomeVersion.HG19: (GenomeVersion.HG38, '38'),
+                            GenomeVersion.HG38: (GenomeVersion.HG19, '37'),
+                            GenomeVersion.MM10: (GenomeVersion.MM39, 'mm39'),
+                            GenomeVersion.MM39: (GenomeVersion.MM10, '10')}
+        source_version, build_token = liftover_sources[self.genome_version]
+        to_lift = df.genome_build.str.contains(build_token).to_numpy()
+        if to_lift.any():
+            LOGGER.info(f'lift over to {self.genome_version} for {to_lift.sum()} probes')
+            with RECORDER.stage('liftover', rows_in=to_lift.sum(), source=str(source_version)) as record:
+                lo = ChainLiftOver.from_genome_versions(source_version, self.genome_version)
+                mapped = np.zeros(len(df), dtype=bool)
+                if lo is None:
+                    LOGGER.error(f'no chain file from {source_version} to {self.genome_version}, positions are not '
+                                 'lifted and are removed')
+                else:
+                    chromosomes, positions, unmapped = lo.convert(df.loc[to_lift, 'chromosome'],
+                                                                  df.loc[to_lift, 'start'])
+                    if unmapped.any():
+                        LOGGER.warning(f'{unmapped.sum()} probes could not be lifted over, removing their position')
+                    mapped[to_lift] = ~unmapped
+                    df.loc[mapped, 'chromosome'] = chromosomes[~unmapped]
+                    df.loc[mapped, 'start'] = positions[~unmapped]
+                # coordinates of the source genome version are wrong in the target one : the probes that couldn't be
+                # lifted have no position, and are reported by the missing_position validation check
+                df.loc[to_lift & ~mapped, 'chromosome'] = None
+                df.loc[to_lift & ~mapped, 'start'] = pd.NA
+                record['rows_out'] = int(mapped.sum())
+
+        with RECORDER.stage('normalize', rows_in=len(df), kind='illumina_manifest') as record:
+            # length 2 for CpG, length 1 for SNP and CpH. beg is 0-based and end is 1-based like in bed files.
+            df['end'] = df['start'] + 2
+            df.loc[df.probe_type != 'cg', 'end'] -= 1
+
+            # set dataframes index + specific processing for manifest file
+            # for type I probes that have both address A and address B set, split them in two rows
+            df = normalize_manifest(df, normalize_channel=True)
+            record['rows_out'] = len(df)
 
         return df
 
     def load_mask(self):
-        """Load the mask for the corresponding array type and genome version, from SeSAMe data"""
-        sesame_annot = SesameAnnotations(self.array_type, self.genome_version, load_all=False)
-        return sesame_annot.load_annotation('mask')
+        """Load the mask for the corresponding array type and genome version, from SeSAMe data. The mask is shared with
+        the SeSAMe annotations through the annotation cache, so it's only parsed once per process."""
+        return SesameAnnotations(self.array_type, self.genome_version).mask
 
 
     def make_pylluminator_probe_info(self) -> pd.DataFrame | None:
@@ -216,9 +301,11 @@ class IlluminaAnnotations:
                 self.mask = None
             else:
                 # select mask column (`mask_uniq` or column `mask_info` to get all  the information)
-                mask = self.mask[['mask_uniq']].rename(columns={'mask_uniq': 'mask_info'})
-                mask.mask_info = mask.mask_info.str.replace(',', ';').replace('"', '')
-                manifest = manifest.join(mask, on='probe_id')
+                with RECORDER.stage('join', rows_in=len(manifest), annotation='mask') as record:
+                    mask = self.mask[['mask_uniq']].rename(columns={'mask_uniq': 'mask_info'})
+                    mask.mask_info = mask.mask_info.str.replace(',', ';').replace('"', '')
+                    manifest = manifest.join(mask, on='probe_id')
+                    record['rows_out'] = len(manifest)
 
-        return manifest.sort_index()
+        return apply_dtype_policy(manifest.sort_index(), self.dtype_policy)
 
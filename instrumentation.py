@@ -0,0 +1,172 @@
+"""Instrumentation of the data build : wall time, CPU time, peak memory, rows and bytes of each stage (download, parse,
+normalize, join, liftover, write, compress), with an optional cProfile dump per stage"""
+
+import cProfile
+import os
+import re
+import resource
+import time
+from contextlib import contextmanager
+
+
+def peak_rss(reset=False) -> int:
+    """Peak resident memory of the process in kilobytes. On linux, the peak is read from /proc and can be reset ; on
+    other systems the peak since the process started is used."""
+    try:
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except OSError:
+        # ru_maxrss is in kilobytes on linux, and includes the memory of the parent process before exec
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_time() -> float:
+    """CPU time of the process and of its terminated child processes (e.g. compression workers), in seconds"""
+    return sum(usage.ru_utime + usage.ru_stime for usage in [resource.getrusage(resource.RUSAGE_SELF),
+                                                             resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+
+def file_size(filepath: str | os.PathLike | None) -> int | None:
+    """Size of a file in bytes, None if it doesn't exist"""
+    if filepath is None or not os.path.exists(filepath):
+        return None
+    return os.path.getsize(filepath)
+
+
+class StageRecorder:
+    """Record the stages run in this process, grouped by task (e.g. one array type and genome version). Stages can be
+    nested (e.g. a download triggered while joining annotations) : their depth is recorded, and the cProfile dump of a
+    stage doesn't include its nested stages. Stages must be recorded by a single thread.
+
+    :ivar records: the stages recorded since the task started
+    :vartype records: list[dict]
+
+    :ivar task: name of the current task, None outside of a task
+    :vartype task: str | None
+
+    :ivar profile_dir: if set, a cProfile dump of each stage is saved in `<profile_dir>/<task>/`
+    :vartype profile_dir: str | None
+    """
+
+    def __init__(self):
+        self.records = []
+        self.task = None
+        self.profile_dir = None
+        self._stack = []
+
+    def start_task(self, task: str | None, profile_dir: str | os.PathLike | None = None) -> None:
+        """Start recording the stages of a task, and forget the stages recorded before"""
+        self.records = []
+        self.task = task
+        self.profile_dir = profile_dir
+
+    def finish_task(self) -> list[dict]:
+        """Stop recording the current task
+
+        :return: the records of its stages, in the order they started
+        :rtype: list[dict]"""
+        records = self.records
+        self.records, self.task, self.profile_dir = [], None, None
+        return records
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int | None = None, bytes_read: int | None = None, **details):
+        """Measure the code run in the `with` block as a stage. The block can complete the yielded record, e.g. with
+        `rows_out` and `bytes_written`.
+
+        :param name: stage name (download, parse, normalize, join, liftover, write, compress...)
+        :type name: str
+
+        :param rows_in: number of rows processed by the stage. Default: None
+        :type rows_in: int | None
+
+        :param bytes_read: number of bytes read by the stage. Default: None
+        :type bytes_read: int | None
+
+        :param details: other information to record (e.g. the annotation kind, the output file...)"""
+
+        record = {'task': self.task, 'stage': name, 'depth': len(self._stack), **details}
+        if rows_in is not None:
+            record['rows_in'] = int(rows_in)
+        if bytes_read is not None:
+            record['bytes_read'] = int(bytes_read)
+        index = len(self.records)
+        self.records.append(record)
+
+        # pause the parent stage : keep its peak memory so far and stop its profiler
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            parent['peak_rss'] = max(parent['peak_rss'], peak_rss())
+            if parent['profiler'] is not None:
+                parent['profiler'].disable()
+
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+        state = {'peak_rss': 0, 'profiler': profiler}
+        self._stack.append(state)
+        rss_before = peak_rss(reset=True)
+        cpu_start, start = cpu_time(), time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            duration, cpu = time.perf_counter() - start, cpu_time() - cpu_start
+            rss_after = max(state['peak_rss'], peak_rss())
+            self._stack.pop()
+            record.update({'seconds': round(duration, 3), 'cpu_seconds': round(cpu, 3),
+                           'peak_rss_mb': round(rss_after / 1024, 1),
+                           'peak_rss_increase_mb': round(max(rss_after - rss_before, 0) / 1024, 1)})
+            if profiler is not None:
+                record['profile'] = self._dump_profile(profiler, f'{index:03d}_{name}')
+            if len(self._stack) > 0:
+                parent = self._stack[-1]
+                parent['peak_rss'] = max(parent['peak_rss'], rss_after)
+                if parent['profiler'] is not None:
+                    parent['profiler'].enable()
+
+    def run(self, name: str, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` as a stage, and return its result"""
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+    def add(self, record: dict) -> None:
+        """Add a stage recorded in another process (e.g. a compression worker) to the current task"""
+        self.records.append({**record, 'task': self.task, 'depth': len(self._stack)})
+
+    def _dump_profile(self, profiler: cProfile.Profile, name: str) -> str:
+        """Save the profile of a stage, and return its path"""
+        task_dir = re.sub(r'[^\w.-]', '_', str(self.task or 'no_task'))
+        os.makedirs(os.path.join(self.profile_dir, task_dir), exist_ok=True)
+        # stages of the same task can run in several processes (e.g. compression workers), and a worker process can run
+        # several tasks with the same name
+        prefix = os.path.join(self.profile_dir, task_dir, f'{name}_{os.getpid()}')
+        filepath, count = f'{prefix}.prof', 1
+        while os.path.exists(filepath):
+            filepath, count = f'{prefix}.{count}.prof', count + 1
+        profiler.dump_stats(filepath)
+        return filepath
+
+
+def summarize_stages(records: list[dict]) -> dict:
+    """Total time, CPU time and number of runs of each stage name. Nested stages are also counted in their parents."""
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+        total['count'] += 1
+        total['seconds'] = round(total['seconds'] + record.get('seconds', 0), 3)
+        total['cpu_seconds'] = round(total['cpu_seconds'] + record.get('cpu_seconds', 0), 3)
+    return totals
+
+
+RECORDER = StageRecorder()
@@ -0,0 +1,70 @@
+"""Join KYCG knowledgebases (CGI, chromatin states, TFBS...) to a manifest, one column per knowledgebase"""
+
+import numpy as np
+import pandas as pd
+
+from normalization import map_distinct_values
+
+SEPARATOR = ';'
+
+
+def strip_knowledgebase_name(values: pd.Series) -> pd.Series:
+    """Remove the knowledgebase name from KYCG values (e.g. 'CGI;Shore' -> 'Shore')"""
+    return map_distinct_values(values, lambda s: s.str.split(SEPARATOR, n=1).str[-1])
+
+
+def aggregate_by_probe(values: pd.Series, separator: str = SEPARATOR) -> pd.Series:
+    """Join the values of each probe in one string, in their original order (e.g. 'Island' and 'Shore' -> 'Island;Shore').
+    Equivalent to `values.groupby(level=0).apply(separator.join)` but without calling a python function per probe:
+    values are sorted by probe, then the n-th value of every probe having at least n values is appended at once.
+
+    :param values: string values, indexed by probe ID. NA values are ignored
+    :type values: pandas.Series
+
+    :param separator: string inserted between the values of a probe. Default: ';'
+    :type separator: str
+
+    :return: one value per probe, indexed by probe ID
+    :rtype: pandas.Series"""
+
+    values = values.dropna()
+    codes, probe_ids = pd.factorize(values.index)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    sorted_values = values.to_numpy(dtype=object)[order]
+
+    # first value of each probe, and number of values
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(values) > 0 else np.array([], int)
+    counts = np.diff(np.r_[starts, len(sorted_values)])
+
+    aggregated = sorted_values[starts].copy()
+    for n in range(1, counts.max(initial=0)):
+        has_more = np.flatnonzero(counts > n)
+        aggregated[has_more] = aggregated[has_more] + separator + sorted_values[starts[has_more] + n]
+
+    return pd.Series(aggregated, index=probe_ids[sorted_codes[starts]], name=values.name)
+
+
+def join_knowledgebases(manifest: pd.DataFrame, knowledgebases: dict[str, pd.DataFrame],
+                        on: str = 'probe_id') -> pd.DataFrame:
+    """Aggregate the features of each knowledgebase by probe and join them all to the manifest at once.
+
+    :param manifest: manifest with a probe ID column
+    :type manifest: pandas.DataFrame
+
+    :param knowledgebases: KYCG knowledgebases indexed by probe ID, with a `knowledgebase` column, by name of the
+        column to create in the manifest (e.g. {'cgi': island_relation})
+    :type knowledgebases: dict[str, pandas.DataFrame]
+
+    :param on: column of the manifest holding the probe IDs. Default: 'probe_id'
+    :type on: str
+
+    :return: the manifest with one new column per knowledgebase
+    :rtype: pandas.DataFrame"""
+
+    if len(knowledgebases) == 0:
+        return manifest
+
+    features = pd.concat([aggregate_by_probe(strip_knowledgebase_name(kb['knowledgebase'])).rename(name)
+                          for name, kb in knowledgebases.items()], axis=1)
+    return manifest.join(features, on=on)
@@ -0,0 +1,190 @@
+"""Convert genomic coordinates between genome versions for whole columns at once, from UCSC chain files"""
+
+import gzip
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.annotations import GenomeVersion
+from pylluminator.utils import get_logger
+
+from download_cache import fetch
+
+LOGGER = get_logger()
+
+CHAIN_LINK = 'https://hgdownload.soe.ucsc.edu/goldenPath/{source}/liftOver/{source}To{target}.over.chain.gz'
+
+
+class ChainLiftOver:
+    """Batch liftover based on a UCSC chain file. The aligned blocks of all the chains are indexed per source chromosome
+    and sorted by start position, so that converting N positions is a vectorized binary search instead of N interval
+    tree queries.
+
+    Positions are 0-based, like pyliftover. When a position falls in several blocks, the block of the chain with the
+    highest score wins.
+
+    :ivar blocks: aligned blocks per source chromosome, sorted by start, with columns start, end, target_chromosome,
+        target_start, target_size, target_strand and score
+    :vartype blocks: dict[str, pandas.DataFrame]
+    """
+
+    def __init__(self, chain_file: str | os.PathLike):
+        """Read and index a chain file (plain text or gzipped)
+
+        :param chain_file: path to the local chain file
+        :type chain_file: str | os.PathLike"""
+
+        LOGGER.info(f'indexing chain file {chain_file}')
+        self.blocks = {}
+
+        headers = []
+        sizes, source_gaps, target_gaps, chain_ids = [], [], [], []
+
+        open_func = gzip.open if str(chain_file).endswith('.gz') else open
+        with open_func(chain_file, 'rt') as file:
+            for line in file:
+                if line.startswith('chain'):
+                    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    fields = line.split()
+                    headers.append((int(fields[1]), fields[2], int(fields[5]), fields[7], int(fields[8]), fields[9],
+                                    int(fields[10])))
+                    continue
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                sizes.append(int(fields[0]))
+                # the last block of a chain has no gap
+                source_gaps.append(int(fields[1]) if len(fields) == 3 else 0)
+                target_gaps.append(int(fields[2]) if len(fields) == 3 else 0)
+                chain_ids.append(len(headers) - 1)
+
+        if len(headers) == 0:
+            LOGGER.warning(f'no chain found in {chain_file}')
+            return
+
+        headers = pd.DataFrame(headers, columns=['score', 'source_chromosome', 'source_start', 'target_chromosome',
+                                                 'target_size', 'target_strand', 'target_start'])
+        sizes = np.array(sizes, dtype='int64')
+        chain_ids = np.array(chain_ids, dtype='int64')
+
+        # block starts are the chain start plus the cumulated sizes and gaps of the previous blocks of the same chain
+        source_offsets = _exclusive_cumsum_by_group(sizes + np.array(source_gaps, dtype='int64'), chain_ids)
+        target_offsets = _exclusive_cumsum_by_group(sizes + np.array(target_gaps, dtype='int64'), chain_ids)
+
+        blocks = headers.iloc[chain_ids].reset_index(drop=True)
+        blocks['start'] = blocks['source_start'].to_numpy() + source_offsets
+        blocks['end'] = blocks['start'] + sizes
+        blocks['target_start'] = blocks['target_start'].to_numpy() + target_offsets
+
+        for chromosome, chrom_blocks in blocks.groupby('source_chromosome', sort=False):
+            chrom_blocks = chrom_blocks.sort_values('start', kind='stable').reset_index(drop=True)
+            # running maximum of the block ends, to know how far back an overlapping block can start
+            chrom_blocks['max_end'] = chrom_blocks['end'].cummax()
+            self.blocks[chromosome] = chrom_blocks[['start', 'end', 'max_end', 'target_chromosome', 'target_start',
+                                                    'target_size', 'target_strand', 'score']]
+
+        LOGGER.info(f'{len(blocks)} blocks indexed from {len(headers)} chains')
+
+    @classmethod
+    def from_genome_versions(cls, source: GenomeVersion | str, target: GenomeVersion | str):
+        """Get the liftover from `source` to `target` genome versions. The chain file is read from the download cache,
+        and only downloaded from UCSC if it is not cached yet.
+
+        :param source: genome version of the input coordinates
+        :type source: GenomeVersion | str
+
+        :param target: genome version of the output coordinates
+        :type target: GenomeVersion | str
+
+        :return: the liftover object, or None if the chain file could not be found nor downloaded
+        :rtype: ChainLiftOver | None"""
+
+        source, target = str(source), str(target)
+        chain_file = fetch(CHAIN_LINK.format(source=source, target=target[0].upper() + target[1:]))
+        if chain_file is None:
+            return None
+        return cls(chain_file)
+
+    def convert(self, chromosomes: pd.Series | np.ndarray, positions: pd.Series | np.ndarray) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Convert positions to the target genome version.
+
+        :param chromosomes: chromosome of each position, with or without the 'chr' prefix
+        :type chromosomes: pandas.Series | numpy.ndarray
+
+        :param positions: 0-based positions to convert. NA values are reported as unmapped.
+        :type positions: pandas.Series | numpy.ndarray
+
+        :return: the target chromosomes (with 'chr' prefix), the target positions and the unmapped mask. Unmapped
+            positions keep their input chromosome and position, NA positions are returned as -1.
+        :rtype: tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]"""
+
+        chromosomes = pd.Series(np.asarray(chromosomes, dtype=object))
+        positions = pd.Series(np.asarray(positions)).astype('Int64').array
+
+        new_chromosomes = chromosomes.to_numpy(dtype=object, copy=True)
+        new_positions = positions.to_numpy(dtype='int64', na_value=-1).copy()
+        unmapped = np.ones(len(new_positions), dtype=bool)
+
+        for input_chromosome, idxs in chromosomes.groupby(chromosomes, sort=False).indices.items():
+            # chain files name chromosomes with the 'chr' prefix
+            chromosome = 'chr' + re.sub('^chr', '', str(input_chromosome), flags=re.IGNORECASE)
+            if chromosome not in self.blocks:
+                continue
+            chrom_blocks = self.blocks[chromosome]
+            pos = new_positions[idxs]
+            block_idxs, found = _find_blocks(chrom_blocks, pos)
+            if not found.any():
+                continue
+
+            hits = block_idxs[found]
+            offsets = pos[found] - chrom_blocks['start'].to_numpy()[hits]
+            lifted = chrom_blocks['target_start'].to_numpy()[hits] + offsets
+            reverse = chrom_blocks['target_strand'].to_numpy()[hits] == '-'
+            lifted[reverse] = chrom_blocks['target_size'].to_numpy()[hits][reverse] - 1 - lifted[reverse]
+
+            mapped_idxs = idxs[found]
+            new_chromosomes[mapped_idxs] = chrom_blocks['target_chromosome'].to_numpy()[hits]
+            new_positions[mapped_idxs] = lifted
+            unmapped[mapped_idxs] = False
+
+        return new_chromosomes, new_positions, unmapped
+
+
+def _exclusive_cumsum_by_group(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Cumulative sum of `values` restarting at each new group, excluding the current value. Groups must be contiguous."""
+    cumsum = np.cumsum(values) - values
+    group_starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_lengths = np.diff(np.r_[group_starts, len(values)])
+    return cumsum - np.repeat(cumsum[group_starts], group_lengths)
+
+
+def _find_blocks(chrom_blocks: pd.DataFrame, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Find the block containing each position, choosing the highest score when blocks overlap.
+
+    :return: the block index for each position, and a mask of the positions found in a block
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]"""
+
+    starts = chrom_blocks['start'].to_numpy()
+    ends = chrom_blocks['end'].to_numpy()
+    max_ends = chrom_blocks['max_end'].to_numpy()
+    scores = chrom_blocks['score'].to_numpy()
+
+    best_idxs = np.full(len(positions), -1, dtype='int64')
+    best_scores = np.full(len(positions), -1, dtype='int64')
+
+    # last block starting before each position, then walk back while an earlier block can still overlap it
+    candidates = np.searchsorted(starts, positions, side='right') - 1
+    active = np.flatnonzero(candidates >= 0)
+    while len(active) > 0:
+        block_idxs = candidates[active]
+        hit = (positions[active] < ends[block_idxs]) & (scores[block_idxs] > best_scores[active])
+        best_idxs[active[hit]] = block_idxs[hit]
+        best_scores[active[hit]] = scores[block_idxs[hit]]
+        candidates[active] -= 1
+        previous = candidates[active]
+        active = active[(previous >= 0) & (max_ends[np.maximum(previous, 0)] > positions[active])]
+
+    return best_idxs, best_idxs >= 0
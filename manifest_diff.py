@@ -0,0 +1,232 @@
+"""Structured comparison of two probe_infos dataframes (SeSAMe vs Illumina, or two releases of the versioned files)"""
+
+import io
+import json
+import os
+import subprocess
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.utils import get_logger
+
+from columnar import has_pyarrow
+from normalization import PROBE_INFOS_DTYPES
+
+LOGGER = get_logger()
+
+MISMATCH_COLUMNS = ['illumina_id', 'status', 'column', 'left', 'right']
+
+
+def _comparable(left: pd.Series, right: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """Convert two columns to arrays of the same type whose values are equal (and hash equally) if and only if the
+    original values are equal. NA values are equal to each other.
+
+    - numbers (int, nullable int, float) are compared as floats
+    - categories are compared by their codes in the union of their categories
+    - anything else is compared as python objects"""
+
+    if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right) \
+            and not pd.api.types.is_bool_dtype(left) and not pd.api.types.is_bool_dtype(right):
+        return (left.to_numpy(dtype='float64', na_value=np.nan),
+                right.to_numpy(dtype='float64', na_value=np.nan))
+
+    if isinstance(left.dtype, pd.CategoricalDtype) and isinstance(right.dtype, pd.CategoricalDtype):
+        categories = left.cat.categories.union(right.cat.categories)
+        return (left.cat.set_categories(categories).cat.codes.to_numpy(),
+                right.cat.set_categories(categories).cat.codes.to_numpy())
+
+    return left.to_numpy(dtype=object), right.to_numpy(dtype=object)
+
+
+def _equal(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Element-wise equality of two arrays returned by `_comparable`, NA values are equal to each other"""
+    if left.dtype.kind == 'f':
+        return (left == right) | (np.isnan(left) & np.isnan(right))
+    if left.dtype.kind == 'O':
+        return (left == right) | (pd.isna(left) & pd.isna(right))
+    return left == right
+
+
+def _json_value(value):
+    """Convert a numpy/pandas scalar to a json-compatible python value"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def diff_probe_infos(left: pd.DataFrame, right: pd.DataFrame, columns: list[str] | None = None,
+                     left_name: str = 'left', right_name: str = 'right', max_samples: int = 10) \
+        -> tuple[dict, pd.DataFrame]:
+    """Compare two probe_infos dataframes indexed by illumina ID. Rows are first compared by a hash of their values, so
+    that the column by column comparison is only done on the probes that changed.
+
+    :param left: first dataframe, indexed by illumina_id
+    :type left: pandas.DataFrame
+
+    :param right: second dataframe, indexed by illumina_id
+    :type right: pandas.DataFrame
+
+    :param columns: columns to compare. Default: None, all the columns found in both dataframes
+    :type columns: list[str] | None
+
+    :param left_name: name of the first dataframe in the report. Default: 'left'
+    :type left_name: str
+
+    :param right_name: name of the second dataframe in the report. Default: 'right'
+    :type right_name: str
+
+    :param max_samples: number of example rows kept in the report for each column and missing side. Default: 10
+    :type max_samples: int
+
+    :return: the report (json-compatible dictionary with counts and samples), and all the differences as a long
+        dataframe with columns illumina_id, status ('changed', 'missing_in_left', 'missing_in_right'), column, left and
+        right (values as strings)
+    :rtype: tuple[dict, pandas.DataFrame]"""
+
+    duplicated = {}
+    for name, df in [(left_name, left), (right_name, right)]:
+        duplicated[name] = int(df.index.duplicated().sum())
+        if duplicated[name] > 0:
+            LOGGER.warning(f'{name} : {duplicated[name]} duplicated illumina IDs, only the first one is compared')
+    left = left[~left.index.duplicated()]
+    right = right[~right.index.duplicated()]
+
+    if columns is None:
+        columns = [col for col in left.columns if col in right.columns]
+
+    missing_in_right = left.index.difference(right.index)
+    missing_in_left = right.index.difference(left.index)
+    common = left.index.intersection(right.index)
+    left_common = left.loc[common, columns]
+    right_common = right.loc[common, columns]
+
+    comparable = {col: _comparable(left_common[col], right_common[col]) for col in columns}
+
+    # fingerprint the rows with a hash of their numbers and category codes. Hashing strings costs more than comparing
+    # them, so string columns are compared directly. Only the changed rows are then compared column by column
+    hashed_columns = [col for col, values in comparable.items() if values[0].dtype.kind != 'O']
+    is_changed = np.zeros(len(common), dtype=bool)
+    if len(hashed_columns) > 0:
+        def row_hashes(side: int) -> np.ndarray:
+            frame = pd.DataFrame({col: comparable[col][side] for col in hashed_columns})
+            return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+        is_changed |= row_hashes(0) != row_hashes(1)
+    for col in columns:
+        if col not in hashed_columns:
+            is_changed |= ~_equal(*comparable[col])
+    changed = np.flatnonzero(is_changed)
+    changed_ids = common[changed]
+
+    column_reports = {}
+    mismatches = []
+    for col in columns:
+        left_values, right_values = comparable[col]
+        is_different = ~_equal(left_values[changed], right_values[changed])
+        ids = changed_ids[is_different]
+        column_reports[col] = {'mismatches': int(is_different.sum()),
+                               f'{left_name}_dtype': str(left[col].dtype), f'{right_name}_dtype': str(right[col].dtype)}
+        if len(ids) > 0:
+            mismatches.append(pd.DataFrame({'illumina_id': ids, 'status': 'changed', 'column': col,
+                                            'left': left_common.loc[ids, col].astype(str).to_numpy(),
+                                            'right': right_common.loc[ids, col].astype(str).to_numpy()}))
+
+    for status, ids in [('missing_in_right', missing_in_right), ('missing_in_left', missing_in_left)]:
+        if len(ids) > 0:
+            mismatches.append(pd.DataFrame({'illumina_id': ids, 'status': status, 'column': None,
+                                            'left': None, 'right': None}))
+
+    mismatches = pd.concat(mismatches, ignore_index=True) if len(mismatches) > 0 \
+        else pd.DataFrame(columns=MISMATCH_COLUMNS)
+
+    samples = {col: [{'illumina_id': _json_value(row.illumina_id), left_name: row.left, right_name: row.right}
+                     for row in group.head(max_samples).itertuples()]
+               for col, group in mismatches[mismatches.status == 'changed'].groupby('column', sort=False)}
+
+    report = {
+        'left': left_name,
+        'right': right_name,
+        'identical': len(changed_ids) == 0 and len(missing_in_left) == 0 and len(missing_in_right) == 0,
+        'rows': {left_name: len(left), right_name: len(right), 'common': len(common), 'changed': len(changed_ids)},
+        'duplicated_ids': duplicated,
+        f'missing_in_{left_name}': len(missing_in_left),
+        f'missing_in_{right_name}': len(missing_in_right),
+        f'columns_only_in_{left_name}': [col for col in left.columns if col not in right.columns],
+        f'columns_only_in_{right_name}': [col for col in right.columns if col not in left.columns],
+        'columns': column_reports,
+        'samples': {
+            'changed': samples,
+            f'missing_in_{left_name}': [_json_value(v) for v in missing_in_left[:max_samples]],
+            f'missing_in_{right_name}': [_json_value(v) for v in missing_in_right[:max_samples]],
+        }
+    }
+    mismatches['status'] = mismatches['status'].replace({'missing_in_left': f'missing_in_{left_name}',
+                                                         'missing_in_right': f'missing_in_{right_name}'})
+    return report, mismatches.rename(columns={'left': left_name, 'right': right_name})
+
+
+def format_diff(report: dict) -> str:
+    """Human-readable summary of a diff report"""
+    left, right = report['left'], report['right']
+    if report['identical']:
+        return f'{left} and {right} are identical ({report["rows"]["common"]} probes)'
+    lines = [f'{report["rows"]["common"]} common probes, {report["rows"]["changed"]} changed',
+             f'missing {report[f"missing_in_{left}"]} probes in {left}',
+             f'missing {report[f"missing_in_{right}"]} probes in {right}']
+    for col, col_report in report['columns'].items():
+        if col_report['mismatches'] > 0:
+            lines.append(f'{col_report["mismatches"]} different rows in col {col}')
+            for sample in report['samples']['changed'][col]:
+                lines.append(f'    {sample["illumina_id"]}: {sample[left]} | {sample[right]}')
+    return '\n'.join(lines)
+
+
+def save_diff(report: dict, mismatches: pd.DataFrame, filepath_prefix: str, output_format: str = 'json') -> None:
+    """Save the report as `<prefix>.json`. With the parquet format, all the differences are also saved in
+    `<prefix>.mismatches.parquet`.
+
+    :param output_format: 'json' or 'parquet'. Default: 'json'
+    :type output_format: str"""
+
+    os.makedirs(os.path.dirname(filepath_prefix) or '.', exist_ok=True)
+    with open(f'{filepath_prefix}.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if output_format == 'parquet':
+        if not has_pyarrow():
+            LOGGER.warning('pyarrow is not installed, saving the mismatches as csv')
+            mismatches.to_csv(f'{filepath_prefix}.mismatches.csv', index=False)
+        else:
+            mismatches.to_parquet(f'{filepath_prefix}.mismatches.parquet', index=False)
+
+
+def read_probe_infos_csv(file) -> pd.DataFrame:
+    """Read a probe_infos.csv(.zip) file with the types set by pylluminator, indexed by illumina ID"""
+    df = pd.read_csv(file, dtype=PROBE_INFOS_DTYPES, compression='infer' if isinstance(file, str) else None)
+    return df.set_index('illumina_id')
+
+
+def load_versioned_probe_infos(filepath: str, revision: str | None = None) -> pd.DataFrame | None:
+    """Load a versioned probe_infos.csv.zip file from the working tree, or as it was at a git revision.
+
+    :param filepath: path of the file, relative to the repository root
+    :type filepath: str
+
+    :param revision: git revision (commit, tag, branch...). Default: None, read the file from the working tree
+    :type revision: str | None
+
+    :return: the probe infos, or None if the file doesn't exist
+    :rtype: pandas.DataFrame | None"""
+
+    if revision is None:
+        return read_probe_infos_csv(filepath) if os.path.exists(filepath) else None
+
+    result = subprocess.run(['git', 'show', f'{revision}:{filepath}'], capture_output=True)
+    if result.returncode != 0:
+        return None
+    with zipfile.ZipFile(io.BytesIO(result.stdout)) as zipf:
+        with zipf.open(zipf.namelist()[0]) as f:
+            return read_probe_infos_csv(f)
@@ -0,0 +1,237 @@
+"""Column-wise normalization of manifests, shared by SesameAnnotations and IlluminaAnnotations"""
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from pylluminator.utils import get_logger
+
+from columnar import has_pyarrow
+from instrumentation import RECORDER
+
+LOGGER = get_logger()
+
+ADDRESS_COLUMNS = ['address_a', 'address_b']
+
+# dtypes applied to every normalized manifest, callers can add or override columns
+MANIFEST_DTYPES = {'illumina_id': 'int', 'type': 'category', 'probe_type': 'category', 'channel': 'category',
+                   'chromosome': 'category'}
+
+# dtypes of the probe_infos files written by create_manifest.py, to read them back
+PROBE_INFOS_DTYPES = {'type': 'category', 'probe_type': 'category', 'channel': 'category', 'chromosome': 'category',
+                      'start': 'Int64', 'end': 'Int64', 'address_a': 'Int64', 'address_b': 'Int64'}
+
+# dtype policies of the probe infos : 'default' keeps the parsed dtypes, 'lean' stores the same values in less memory
+DTYPE_POLICIES = ['default', 'lean']
+
+# 'lean' policy : columns with fixed categories, completed by the other values found in the column
+FIXED_CATEGORIES = {'strand': ['+', '-', '*'],
+                    'chromosome': [str(i) for i in range(1, 23)] + ['X', 'Y', 'M']}
+
+# 'lean' policy : string columns with at most this ratio of distinct values become categories, the others Arrow strings
+CATEGORY_MAX_RATIO = 0.5
+
+INTEGER_DTYPES = ['Int8', 'Int16', 'Int32', 'Int64']
+
+# key of the dataframe attrs where the 'lean' policy keeps the dtypes of the columns it converted
+DEFAULT_DTYPES_ATTR = 'default_dtypes'
+
+
+def map_distinct_values(values: pd.Series, transform) -> pd.Series:
+    """Apply a string transformation to the distinct values of a series only, and broadcast the result back to all the
+    rows. Much faster than a row-wise transformation when values are highly repeated (chromosomes, channels...)
+
+    :param values: input series
+    :type values: pandas.Series
+
+    :param transform: function taking and returning a pandas.Series of object dtype
+    :type transform: Callable
+
+    :return: the transformed series, with the same index as the input, NA values are kept
+    :rtype: pandas.Series"""
+
+    codes, uniques = pd.factorize(values)
+    mapped = transform(pd.Series(np.asarray(uniques, dtype=object), dtype=object)).to_numpy(dtype=object)
+    return pd.Series(pd.api.extensions.take(mapped, codes, allow_fill=True), index=values.index, name=values.name)
+
+
+def clean_chromosomes(chromosomes: pd.Series) -> pd.Series:
+    """Remove the 'chr' prefix and upper-case chromosome names (e.g. 'chrX' -> 'X', 'chr1' -> '1')"""
+    return map_distinct_values(chromosomes, lambda s: s.str.lower().str.replace('chr', '').str.upper())
+
+
+def normalize_channels(channels: pd.Series) -> pd.Series:
+    """Ensure channels are 'R' and 'G', not 'Red' and 'Grn'"""
+    return map_distinct_values(channels, lambda s: s.str[0])
+
+
+def extract_probe_types(probe_ids: pd.Series) -> pd.Series:
+    """Extract probe type from probe id (first letters, identifies control probes, snp...)"""
+    return probe_ids.str.extract(r'^([a-zA-Z]+)', expand=False)
+
+
+def split_addresses(df: pd.DataFrame, address_columns: list[str] | None = None) -> pd.DataFrame:
+    """Create the `illumina_id` column from the address columns, with one row per non-NA address. Type I probes that
+    have both address A and address B set are split in two rows (A first, then B), and probes without any address are
+    dropped. This is the array equivalent of applying `concatenate_non_na` on each row and exploding the result.
+
+    :param df: manifest with address columns
+    :type df: pandas.DataFrame
+
+    :param address_columns: columns to read the addresses from. Default: ['address_a', 'address_b']
+    :type address_columns: list[str] | None
+
+    :return: the manifest with an `illumina_id` column and a new default index
+    :rtype: pandas.DataFrame"""
+
+    if address_columns is None:
+        address_columns = ADDRESS_COLUMNS
+
+    addresses = df[address_columns].astype('float64').to_numpy()
+    is_set = ~np.isnan(addresses)
+    nb_addresses = is_set.sum(axis=1)
+
+    nb_dropped = int((nb_addresses == 0).sum())
+    if nb_dropped > 0:
+        LOGGER.info(f'dropped {nb_dropped} probes with missing illumina ID')
+
+    # boolean indexing reads the 2D array row by row, so A comes before B for each probe
+    exploded = df.iloc[np.repeat(np.arange(len(df)), nb_addresses)].reset_index(drop=True)
+    exploded['illumina_id'] = addresses[is_set].astype('int64')
+    return exploded
+
+
+def normalize_manifest(df: pd.DataFrame, dtypes: dict | None = None, normalize_channel=False) -> pd.DataFrame:
+    """Normalize a manifest that already has pylluminator column names (probe_id, type, probe_type, channel,
+    chromosome, address_a, address_b...) : split type I addresses, clean chromosome names, cast categories, rename 'rs'
+    probe type to 'snp', and set `illumina_id` as index.
+
+    :param df: manifest to normalize
+    :type df: pandas.DataFrame
+
+    :param dtypes: dtypes to apply in addition to MANIFEST_DTYPES. Default: None
+    :type dtypes: dict | None
+
+    :param normalize_channel: set to True to convert channel names to their first letter (e.g. Red -> R). Default: False
+    :type normalize_channel: bool
+
+    :return: the normalized manifest, indexed by illumina_id
+    :rtype: pandas.DataFrame"""
+
+    df = split_addresses(df)
+    df['chromosome'] = clean_chromosomes(df['chromosome'])
+    if normalize_channel:
+        df['channel'] = normalize_channels(df['channel'])
+
+    # turn some columns into categories as it speeds up further processing
+    df = df.astype(MANIFEST_DTYPES | (dtypes or {}))
+    df = df.set_index('illumina_id')
+    df['probe_type'] = df.probe_type.cat.rename_categories({'rs': 'snp'})  # to improve readability
+    if 'strand' not in df.columns:
+        LOGGER.info('creating probe strand column')
+        df['strand'] = '*'
+
+    return df
+
+
+def concat_chunks(chunks: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate dataframes read by chunks. Categorical columns stay categorical, with the sorted union of the
+    categories of all the chunks (pandas.concat would convert them to object if their categories differ)
+
+    :param chunks: dataframes with the same columns
+    :type chunks: list[pandas.DataFrame]
+
+    :return: the concatenated dataframe
+    :rtype: pandas.DataFrame"""
+
+    if len(chunks) == 0:
+        return pd.DataFrame()
+
+    for col, dtype in chunks[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = union_categoricals([chunk[col] for chunk in chunks], sort_categories=True).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+
+    return pd.concat(chunks)
+
+
+def smallest_integer_dtype(values: pd.Series) -> str:
+    """Smallest nullable integer dtype holding all the values of an integer column"""
+    if values.notna().sum() == 0:
+        return INTEGER_DTYPES[0]
+    min_value, max_value = values.min(), values.max()
+    return next(dtype for dtype in INTEGER_DTYPES
+                if np.iinfo(dtype.lower()).min <= min_value and max_value <= np.iinfo(dtype.lower()).max)
+
+
+def lean_dtypes(df: pd.DataFrame) -> dict:
+    """Dtypes of the 'lean' policy for the columns of a dataframe (see `apply_dtype_policy`)"""
+    dtypes = {}
+    for column, values in df.items():
+        if column in FIXED_CATEGORIES:
+            extra_values = set(values.dropna().unique()) - set(FIXED_CATEGORIES[column])
+            dtypes[column] = pd.CategoricalDtype(FIXED_CATEGORIES[column] + sorted(extra_values, key=str))
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            dtypes[column] = smallest_integer_dtype(values)
+        elif pd.api.types.is_object_dtype(values.dtype) or isinstance(values.dtype, pd.StringDtype):
+            # parsed strings are python objects before pandas 3, and strings (Arrow-backed if pyarrow is installed) after
+            if values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+                dtypes[column] = 'category'
+            elif pd.api.types.is_object_dtype(values.dtype) and has_pyarrow():
+                dtypes[column] = 'string[pyarrow]'
+    return dtypes
+
+
+def default_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert probe infos with 'lean' dtypes back to the dtypes of the 'default' policy, e.g. to write the same parquet
+    file with both policies (the row groups follow the order of the chromosome categories). Only the columns converted
+    by `apply_dtype_policy` are restored, from the dtypes it kept in `df.attrs`."""
+    dtypes = {column: dtype for column, dtype in df.attrs.get(DEFAULT_DTYPES_ATTR, {}).items() if column in df.columns}
+    if len(dtypes) == 0:
+        return df
+    restored = df.astype(dtypes)
+    # the restored dataframe has nothing left to restore, and pyarrow can't store dtypes in the parquet metadata
+    restored.attrs = {key: value for key, value in df.attrs.items() if key != DEFAULT_DTYPES_ATTR}
+    return restored
+
+
+def frame_memory(df: pd.DataFrame) -> int:
+    """Memory used by a dataframe and its index in bytes, python strings included"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def apply_dtype_policy(df: pd.DataFrame, policy: str = 'default') -> pd.DataFrame:
+    """Set the dtypes of a probe infos dataframe according to a policy. The values don't change, and neither does the
+    csv file written from the dataframe.
+
+    - 'default': keep the dtypes of the parsed files (python strings, Int64...)
+    - 'lean': strand and chromosome become categories with fixed categories, integer columns the smallest nullable
+      integer type holding their values, string columns with repeated values (masks, genes...) categories, and other
+      string columns (probe IDs) Arrow strings if pyarrow is installed. The memory before and after is recorded, and
+      the previous dtypes of the converted columns are kept in `df.attrs` (see `default_dtypes`).
+
+    :param df: probe infos
+    :type df: pandas.DataFrame
+
+    :param policy: one of DTYPE_POLICIES. Default: 'default'
+    :type policy: str
+
+    :rtype: pandas.DataFrame"""
+
+    if policy not in DTYPE_POLICIES:
+        raise ValueError(f'unknown dtype policy {policy}, must be one of {DTYPE_POLICIES}')
+    if policy == 'default':
+        return df
+
+    with RECORDER.stage('normalize', rows_in=len(df), kind='dtypes', policy=policy) as record:
+        memory_before = frame_memory(df)
+        dtypes = lean_dtypes(df)
+        previous_dtypes = {column: df[column].dtype for column in dtypes}
+        df = df.astype(dtypes)
+        df.attrs[DEFAULT_DTYPES_ATTR] = previous_dtypes
+        memory_after = frame_memory(df)
+        record['memory_before_mb'] = round(memory_before / 1e6, 1)
+        record['memory_after_mb'] = round(memory_after / 1e6, 1)
+    LOGGER.info(f'{policy} dtypes : {memory_before / 1e6:.1f} MB -> {memory_after / 1e6:.1f} MB')
+    return df
@@ -0,0 +1,259 @@
+"""Genomic position index of a probe_infos file : probes sorted by chromosome and start, with the offsets of each
+chromosome, so that region and window queries are binary searches instead of boolean masks over all the probes. The
+index is stored as a raw int32 array (.npy) that is memory-mapped when loaded, and a small json file for the chromosome
+offsets and cytobands. It's only saved by `create_manifest.py --positions`, and can be built from the probe infos when
+they are loaded (`PositionIndex.from_probe_infos`)."""
+
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.annotations import GenomeVersion
+from pylluminator.utils import get_logger
+
+LOGGER = get_logger()
+
+CYTOBANDS_FILE = 'genome_info/{genome_version}/chromosome_regions.csv.zip'
+
+# rows of the position array
+FIELDS = ['start', 'end', 'max_end', 'row', 'cytoband']
+START, END, MAX_END, ROW, CYTOBAND = range(len(FIELDS))
+
+
+def read_cytobands(genome_version: GenomeVersion | str, filepath: str | os.PathLike | None = None) \
+        -> pd.DataFrame | None:
+    """Read the cytobands of a genome version from the versioned genome info files
+
+    :param filepath: path of the cytobands file. Default: None, use `genome_info/<genome version>/chromosome_regions.csv.zip`
+    :type filepath: str | os.PathLike | None
+
+    :return: cytobands sorted by chromosome and start (0-based, end excluded), None if the file doesn't exist
+    :rtype: pandas.DataFrame | None"""
+
+    if filepath is None:
+        filepath = CYTOBANDS_FILE.format(genome_version=genome_version)
+    if not os.path.exists(filepath):
+        LOGGER.info(f'no cytobands file {filepath}')
+        return None
+    cytobands = pd.read_csv(filepath, usecols=['chromosome', 'start', 'end', 'name'], dtype={'chromosome': str})
+    return cytobands.sort_values(['chromosome', 'start'], kind='stable').reset_index(drop=True)
+
+
+def chromosome_sort_key(chromosome: str) -> tuple:
+    """Sort numbered chromosomes numerically first (1, 2, ... 10), then the others alphabetically (X, Y, M...)"""
+    return (0, int(chromosome), '') if chromosome.isdigit() else (1, 0, chromosome)
+
+
+class PositionIndex:
+    """Probes of a probe_infos table sorted by chromosome and start. Coordinates are 0-based with the end excluded, like
+    the start and end columns of probe_infos.
+
+    :ivar positions: int32 array of shape (len(FIELDS), number of indexed probes) : start, end, running maximum of the
+        ends within the chromosome, row of the probe in probe_infos and row of its cytoband in `cytobands` (-1 if none)
+    :vartype positions: numpy.ndarray
+
+    :ivar chromosomes: indexed chromosomes
+    :vartype chromosomes: list[str]
+
+    :ivar offsets: the probes of chromosome i are in columns offsets[i] to offsets[i + 1] of `positions`
+    :vartype offsets: numpy.ndarray
+
+    :ivar cytobands: cytobands (chromosome, start, end, name) sorted by chromosome and start, or None
+    :vartype cytobands: pandas.DataFrame | None
+
+    :ivar n_rows: number of rows of the indexed probe_infos table, including the probes without position
+    :vartype n_rows: int
+    """
+
+    def __init__(self, positions: np.ndarray, chromosomes: list[str], offsets: np.ndarray,
+                 cytobands: pd.DataFrame | None, n_rows: int):
+        self.positions = positions
+        self.chromosomes = chromosomes
+        self.offsets = offsets
+        self.cytobands = cytobands
+        self.n_rows = n_rows
+        self._chromosome_idx = {chromosome: i for i, chromosome in enumerate(chromosomes)}
+
+    @classmethod
+    def from_probe_infos(cls, probe_infos: pd.DataFrame, cytobands: pd.DataFrame | None = None):
+        """Index the probes of probe_infos that have a chromosome, start and end, and assign them to the cytoband
+        containing their start.
+
+        :param probe_infos: probe infos with chromosome, start and end columns
+        :type probe_infos: pandas.DataFrame
+
+        :param cytobands: cytobands read by `read_cytobands`. Default: None, no cytoband assignment
+        :type cytobands: pandas.DataFrame | None"""
+
+        chromosomes = pd.Series(probe_infos['chromosome'].to_numpy(dtype=object)).astype('string')
+        starts = probe_infos['start'].astype('Int64').to_numpy(dtype='int64', na_value=-1)
+        ends = probe_infos['end'].astype('Int64').to_numpy(dtype='int64', na_value=-1)
+        rows = np.flatnonzero(chromosomes.notna().to_numpy() & (starts >= 0) & (ends >= 0))
+
+        chromosome_names = sorted(chromosomes.iloc[rows].unique(), key=chromosome_sort_key)
+        chromosome_codes = pd.Categorical(chromosomes.iloc[rows], categories=chromosome_names).codes
+        order = np.lexsort((starts[rows], chromosome_codes))
+        rows, chromosome_codes = rows[order], chromosome_codes[order]
+        offsets = np.searchsorted(chromosome_codes, np.arange(len(chromosome_names) + 1))
+
+        positions = np.full((len(FIELDS), len(rows)), -1, dtype='int32')
+        positions[START], positions[END], positions[ROW] = starts[rows], ends[rows], rows
+        for i, chromosome in enumerate(chromosome_names):
+            chromosome_slice = slice(offsets[i], offsets[i + 1])
+            positions[MAX_END, chromosome_slice] = np.maximum.accumulate(positions[END, chromosome_slice])
+            if cytobands is not None:
+                positions[CYTOBAND, chromosome_slice] = _assign_cytobands(cytobands, chromosome,
+                                                                         positions[START, chromosome_slice])
+
+        LOGGER.info(f'{len(rows)} probes indexed on {len(chromosome_names)} chromosomes')
+        return cls(positions, chromosome_names, offsets, cytobands, len(probe_infos))
+
+    def __len__(self) -> int:
+        return self.positions.shape[1]
+
+    def _chromosome_positions(self, chromosome: str) -> np.ndarray | None:
+        """Positions of the probes of one chromosome, None if no probe is on it"""
+        i = self._chromosome_idx.get(str(chromosome))
+        if i is None:
+            return None
+        return self.positions[:, self.offsets[i]:self.offsets[i + 1]]
+
+    def region(self, chromosome: str, start: int, end: int) -> np.ndarray:
+        """Probes overlapping a region
+
+        :param chromosome: chromosome name, without 'chr' prefix
+        :type chromosome: str
+
+        :param start: 0-based start of the region
+        :type start: int
+
+        :param end: end of the region (excluded)
+        :type end: int
+
+        :return: rows of the probes in probe_infos, sorted by start
+        :rtype: numpy.ndarray"""
+
+        positions = self._chromosome_positions(chromosome)
+        if positions is None:
+            return np.array([], dtype='int32')
+        # probes starting before the end of the region, from the first one whose end could reach the region
+        first = np.searchsorted(positions[MAX_END], start, side='right')
+        last = np.searchsorted(positions[START], end, side='left')
+        overlapping = first + np.flatnonzero(positions[END, first:last] > start)
+        return positions[ROW, overlapping]
+
+    def window(self, chromosome: str, position: int, width: int) -> np.ndarray:
+        """Probes less than `width` bp away from a 0-based position, see `region`"""
+        return self.region(chromosome, position - width, position + width + 1)
+
+    def regions(self, chromosomes: pd.Series | np.ndarray, starts: pd.Series | np.ndarray,
+                ends: pd.Series | np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Probes overlapping each of many regions (e.g. the gaps of `gap_info.csv`), coordinates as in `region`.
+
+        :return: the index of the regions and the rows of the probes in probe_infos, one element per overlap
+        :rtype: tuple[numpy.ndarray, numpy.ndarray]"""
+
+        chromosomes = pd.Series(np.asarray(chromosomes, dtype=object))
+        starts, ends = np.asarray(starts, dtype='int64'), np.asarray(ends, dtype='int64')
+
+        region_idxs, rows = [], []
+        for chromosome, idxs in chromosomes.groupby(chromosomes, sort=False).indices.items():
+            positions = self._chromosome_positions(chromosome)
+            if positions is None:
+                continue
+            firsts = np.searchsorted(positions[MAX_END], starts[idxs], side='right')
+            counts = np.maximum(np.searchsorted(positions[START], ends[idxs], side='left') - firsts, 0)
+            # candidate probes of each region, then keep the ones whose end is after the region start
+            candidate_regions = np.repeat(idxs, counts)
+            candidates = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - firsts, counts)
+            hit = positions[END, candidates] > starts[candidate_regions]
+            region_idxs.append(candidate_regions[hit])
+            rows.append(positions[ROW, candidates[hit]])
+
+        if len(region_idxs) == 0:
+            return np.array([], dtype='int64'), np.array([], dtype='int32')
+        return np.concatenate(region_idxs), np.concatenate(rows)
+
+    def cytoband(self, chromosome: str, name: str) -> np.ndarray:
+        """Probes in a cytoband. Names are matched by prefix, so that 'p36' also selects p36.33, p36.32... and 'q' the
+        whole q arm.
+
+        :return: rows of the probes in probe_infos, sorted by start
+        :rtype: numpy.ndarray"""
+
+        if self.cytobands is None:
+            raise ValueError('no cytobands in this index')
+        bands = self.cytobands[(self.cytobands['chromosome'] == str(chromosome))
+                               & self.cytobands['name'].str.startswith(name, na=False)]
+        if len(bands) == 0:
+            return np.array([], dtype='int32')
+        return self.region(chromosome, bands['start'].min(), bands['end'].max())
+
+    def probe_cytobands(self) -> np.ndarray:
+        """Cytoband of each row of probe_infos, None for probes without position or cytoband"""
+        result = np.full(self.n_rows, None, dtype=object)
+        if self.cytobands is None:
+            return result
+        has_band = self.positions[CYTOBAND] >= 0
+        result[self.positions[ROW, has_band]] = self.cytobands['name'].to_numpy(dtype=object)[
+            self.positions[CYTOBAND, has_band]]
+        return result
+
+    def save(self, prefix: str | os.PathLike) -> tuple[str, str]:
+        """Save the index in `<prefix>.npy` (positions) and `<prefix>.json` (chromosomes, offsets and cytobands)
+
+        :return: path of the two files
+        :rtype: tuple[str, str]"""
+
+        positions_path, metadata_path = f'{prefix}.npy', f'{prefix}.json'
+        np.save(positions_path, np.ascontiguousarray(self.positions))
+        metadata = {'fields': FIELDS, 'rows': self.n_rows, 'chromosomes': self.chromosomes,
+                    'offsets': [int(offset) for offset in self.offsets],
+                    'cytobands': None if self.cytobands is None else self.cytobands.to_dict(orient='list')}
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
+        return positions_path, metadata_path
+
+    @classmethod
+    def load(cls, prefix: str | os.PathLike, mmap=True):
+        """Load an index saved by `save`. Both files can be zipped, as in the versioned folders : zipped positions are
+        read in memory, not memory-mapped.
+
+        :param mmap: memory-map the positions instead of reading them. Default: True
+        :type mmap: bool"""
+
+        metadata_path = f'{prefix}.json'
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        else:
+            with zipfile.ZipFile(metadata_path + '.zip') as archive:
+                metadata = json.loads(archive.read(archive.namelist()[0]))
+        if metadata['fields'] != FIELDS:
+            raise ValueError(f'unexpected fields {metadata["fields"]} in {metadata_path}')
+
+        positions_path = f'{prefix}.npy'
+        if os.path.exists(positions_path):
+            positions = np.load(positions_path, mmap_mode='r' if mmap else None)
+        else:
+            with zipfile.ZipFile(positions_path + '.zip') as archive:
+                positions = np.load(io.BytesIO(archive.read(archive.namelist()[0])))
+        cytobands = None if metadata['cytobands'] is None else pd.DataFrame(metadata['cytobands'])
+        return cls(positions, metadata['chromosomes'], np.array(metadata['offsets'], dtype='int64'), cytobands,
+                   metadata['rows'])
+
+
+def _assign_cytobands(cytobands: pd.DataFrame, chromosome: str, starts: np.ndarray) -> np.ndarray:
+    """Row in `cytobands` of the cytoband containing each position of a chromosome, -1 if none"""
+    band_rows = np.flatnonzero((cytobands['chromosome'] == chromosome).to_numpy())
+    if len(band_rows) == 0:
+        return np.full(len(starts), -1)
+    band_starts = cytobands['start'].to_numpy()[band_rows]
+    band_ends = cytobands['end'].to_numpy()[band_rows]
+    idxs = np.searchsorted(band_starts, starts, side='right') - 1
+    inside = (idxs >= 0) & (starts < band_ends[np.maximum(idxs, 0)])
+    return np.where(inside, band_rows[np.maximum(idxs, 0)], -1)
@@ -0,0 +1,234 @@
+"""Download all the annotation files concurrently into the download cache, resuming partial downloads"""
+
+import asyncio
+import http.client
+import json
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+from urllib.parse import urlsplit, urljoin
+
+from pylluminator.annotations import ArrayType, GenomeVersion
+from pylluminator.utils import get_logger
+
+from download_cache import DownloadCache, get_cache, file_checksum, CHUNK_SIZE
+from illumina_annotations import MANIFEST_FILES
+from sesame_annotations import LINKS
+
+LOGGER = get_logger()
+
+MAX_REDIRECTS = 5
+
+
+def get_links(array_type: ArrayType, genome_version: GenomeVersion, illumina=False) -> list[str]:
+    """List the urls of the files needed to build the annotation of an array type and genome version
+
+    :param illumina: set to True to include the Illumina manifest of the array type. Default: False
+    :type illumina: bool
+
+    :rtype: list[str]"""
+
+    links = [LINKS[kind][genome_version][array_type] for kind in LINKS
+             if array_type in LINKS[kind].get(genome_version, {})]
+    if illumina and array_type in MANIFEST_FILES:
+        links.append(MANIFEST_FILES[array_type][1])
+    return links
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections per host, reused by the successive downloads from the same server"""
+
+    def __init__(self, timeout: float = 60):
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def get(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        """Get an idle connection to the host, or open a new one"""
+        with self._lock:
+            if len(self._idle[(scheme, netloc)]) > 0:
+                return self._idle[(scheme, netloc)].pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme: str, netloc: str, connection: http.client.HTTPConnection) -> None:
+        """Give back a connection whose response was fully read, so that it can be reused"""
+        with self._lock:
+            self._idle[(scheme, netloc)].append(connection)
+
+    def close(self) -> None:
+        """Close all the idle connections"""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+def _request(pool: ConnectionPool, url: str, headers: dict) \
+        -> tuple[http.client.HTTPResponse, http.client.HTTPConnection, tuple]:
+    """Send a GET request, following redirections. A stale keep-alive connection is reopened once, and closed if the
+    request fails again.
+
+    :return: the response, its connection, and the (scheme, netloc) key to give the connection back to the pool
+    :rtype: tuple[http.client.HTTPResponse, http.client.HTTPConnection, tuple]"""
+
+    for _ in range(MAX_REDIRECTS):
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        connection = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                raise
+
+        if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            pool.put(parts.scheme, parts.netloc, connection)
+            url = urljoin(url, response.getheader('Location'))
+            continue
+
+        return response, connection, (parts.scheme, parts.netloc)
+
+    raise http.client.HTTPException(f'too many redirections for {url}')
+
+
+def download(url: str, cache: DownloadCache, pool: ConnectionPool, retries: int = 3) -> Path | None:
+    """Download an url in the cache. The data is written in a `.part` file that is resumed with a range request if the
+    download is interrupted (in this run or a previous one), and only moved to the cache once its size matches the size
+    announced by the server.
+
+    :return: path to the cached file, or None if the download failed
+    :rtype: pathlib.Path | None"""
+
+    filepath = cache.path(url)
+    part_path = filepath.with_name(filepath.name + '.part')
+    part_info_path = filepath.with_name(filepath.name + '.part.json')
+    os.makedirs(cache.entry_dir(url), exist_ok=True)
+
+    for attempt in range(retries):
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+            # only resume if the file didn't change on the server since the partial download
+            if part_path.exists() and part_info_path.exists():
+                with open(part_info_path) as f:
+                    validator = json.load(f).get('validator')
+                if validator is not None:
+                    headers['If-Range'] = validator
+
+        connection = None
+        try:
+            response, connection, pool_key = _request(pool, url, headers)
+
+            if response.status == 416:
+                # the range is not valid anymore, start again from scratch
+                response.read()
+                pool.put(*pool_key, connection)
+                os.remove(part_path)
+                continue
+
+            if response.status not in (200, 206):
+                LOGGER.error(f'download from {url} failed ({response.status} {response.reason})')
+                response.read()
+                pool.put(*pool_key, connection)
+                return None
+
+            if response.status == 200:
+                # full content : the server doesn't support ranges, or the file changed
+                offset = 0
+                with open(part_info_path, 'w') as f:
+                    json.dump({'validator': response.getheader('ETag') or response.getheader('Last-Modified')}, f)
+                expected_size = response.getheader('Content-Length')
+            else:
+                # Content-Range: bytes <start>-<end>/<total>
+                content_range = response.getheader('Content-Range', '')
+                if not content_range.startswith(f'bytes {offset}-'):
+                    LOGGER.warning(f'unexpected content range {content_range} for {url}, restarting the download')
+                    connection.close()
+                    os.remove(part_path)
+                    continue
+                expected_size = content_range.split('/')[-1]
+                LOGGER.info(f'resuming download of {url} from byte {offset}')
+
+            with open(part_path, 'wb' if offset == 0 else 'ab') as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+            pool.put(*pool_key, connection)
+
+        except (http.client.HTTPException, OSError) as e:
+            # the response may not be fully read : the connection can't be reused
+            if connection is not None:
+                connection.close()
+            LOGGER.warning(f'download of {url} interrupted ({e}), attempt {attempt + 1}/{retries}')
+            continue
+
+        # integrity check : the file must have the size announced by the server
+        size = part_path.stat().st_size
+        if expected_size is not None and expected_size != '*' and size != int(expected_size):
+            LOGGER.warning(f'incomplete download of {url} ({size}/{expected_size} bytes), '
+                           f'attempt {attempt + 1}/{retries}')
+            continue
+
+        os.replace(part_path, filepath)
+        if part_info_path.exists():
+            os.remove(part_info_path)
+        cache.save_metadata(url, file_checksum(filepath), response.getheader('ETag'),
+                            response.getheader('Last-Modified'))
+        LOGGER.info(f'download successful in {filepath}')
+        return filepath
+
+    LOGGER.error(f'download from {url} failed after {retries} attempts')
+    return None
+
+
+async def prefetch_async(urls: list[str], cache: DownloadCache | None = None, max_concurrency: int = 8,
+                         on_complete=None) -> dict[str, Path | None]:
+    """Download the urls that are not cached yet, at most `max_concurrency` at a time, and call
+    `on_complete(url, path)` as soon as each file is available (path is None if the download failed)."""
+
+    if cache is None:
+        cache = get_cache()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    pool = ConnectionPool(cache.timeout)
+
+    async def fetch_one(url: str) -> tuple[str, Path | None]:
+        if cache.is_cached(url):
+            path = cache.path(url)
+        else:
+            async with semaphore:
+                path = await asyncio.to_thread(download, url, cache, pool)
+        if on_complete is not None:
+            on_complete(url, path)
+        return url, path
+
+    try:
+        # the same url can be needed by several array types
+        return dict(await asyncio.gather(*[fetch_one(url) for url in dict.fromkeys(urls)]))
+    finally:
+        pool.close()
+
+
+def prefetch(urls: list[str], cache: DownloadCache | None = None, max_concurrency: int = 8,
+             on_complete=None) -> dict[str, Path | None]:
+    """Download the urls that are not cached yet concurrently, see `prefetch_async`. Nothing is downloaded if the cache
+    is offline.
+
+    :return: the path of each url in the cache, None for the failed downloads
+    :rtype: dict[str, pathlib.Path | None]"""
+
+    if cache is None:
+        cache = get_cache()
+    if cache.offline:
+        return {url: cache.path(url) if cache.is_cached(url) else None for url in urls}
+    return asyncio.run(prefetch_async(urls, cache, max_concurrency, on_complete))
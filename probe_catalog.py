@@ -0,0 +1,176 @@
+"""Probe catalog shared by all the array types of a genome version. Many probes are on several arrays (450K, EPIC, EPIC+
+or EPICv2, MSA) with the same coordinates, genes, mask and CGI relation : the catalog stores this annotation once, and a
+thin table per array type holds its illumina IDs, addresses, design type, channel and strand. The catalog is written in
+addition to the probe_infos files of the array types, to load several array types with less memory."""
+
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from normalization import PROBE_INFOS_DTYPES
+
+CATALOG_FILE = 'probe_catalog.csv'
+CATALOG_METADATA_FILE = 'probe_catalog.json'
+ARRAY_PROBES_FILE = 'array_probes.csv'
+
+# columns of probe_infos that depend on the array design, kept in the array tables. The other columns are in the catalog
+ARRAY_COLUMNS = ['type', 'channel', 'address_a', 'address_b', 'strand']
+
+ARRAY_PROBES_DTYPES = {'catalog_row': 'int32', 'type': 'category', 'channel': 'category', 'address_a': 'Int64',
+                       'address_b': 'Int64'}
+
+
+def build_catalog(probe_infos: dict[str, pd.DataFrame]) -> tuple[pd.DataFrame, dict[str, pd.DataFrame]]:
+    """Split the probe_infos of several array types of the same genome version in a shared catalog and one array table
+    per array type. Probes of different arrays share a catalog row if they have the same probe ID and the same
+    annotation : a probe annotated differently on two arrays (e.g. other coordinates) has one row per variant.
+
+    :param probe_infos: probe infos of each array type, indexed by illumina ID
+    :type probe_infos: dict[str, pandas.DataFrame]
+
+    :return: the catalog (probe_id and annotation columns, sorted by probe ID and indexed by catalog row), and the array
+        table of each array type, indexed by illumina ID with a `catalog_row` column and the ARRAY_COLUMNS
+    :rtype: tuple[pandas.DataFrame, dict[str, pandas.DataFrame]]"""
+
+    catalog_columns = ['probe_id']
+    for df in probe_infos.values():
+        catalog_columns += [col for col in df.columns if col not in ARRAY_COLUMNS and col not in catalog_columns]
+
+    # annotation of every row of every array, with NA for the columns an array doesn't have. Hashes only depend on the
+    # values, not on the categories of each array
+    annotations = pd.concat([df.reindex(columns=catalog_columns) for df in probe_infos.values()], ignore_index=True)
+    row_hashes = pd.util.hash_pandas_object(annotations, index=False).to_numpy()
+    keys = pd.MultiIndex.from_arrays([annotations['probe_id'].to_numpy(dtype=object), row_hashes])
+    catalog_rows, unique_keys = pd.factorize(keys)
+
+    # first occurrence of each key, then sort the catalog by probe ID to keep a stable order across builds
+    first_rows = np.full(len(unique_keys), len(catalog_rows), dtype='int64')
+    np.minimum.at(first_rows, catalog_rows, np.arange(len(catalog_rows)))
+    order = np.lexsort((unique_keys.get_level_values(1).to_numpy(), unique_keys.get_level_values(0).to_numpy()))
+    new_rows = np.empty(len(order), dtype='int32')
+    new_rows[order] = np.arange(len(order))
+
+    catalog = annotations.iloc[first_rows[order]].reset_index(drop=True)
+    for column in catalog.columns:
+        if column in PROBE_INFOS_DTYPES:
+            catalog[column] = catalog[column].astype(PROBE_INFOS_DTYPES[column])
+    catalog.index.name = 'catalog_row'
+
+    array_tables, offset = {}, 0
+    for array_type, df in probe_infos.items():
+        array_table = df[[col for col in ARRAY_COLUMNS if col in df.columns]].copy()
+        array_table.insert(0, 'catalog_row', new_rows[catalog_rows[offset:offset + len(df)]])
+        array_tables[array_type] = array_table
+        offset += len(df)
+    return catalog, array_tables
+
+
+def join_catalog(catalog: pd.DataFrame, array_table: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """Rebuild the probe_infos table of an array type from the catalog and its array table (see `build_catalog`)
+
+    :param columns: columns of the probe_infos table, in order
+    :type columns: list[str]
+
+    :return: probe infos indexed by illumina ID, in the order of the array table
+    :rtype: pandas.DataFrame"""
+
+    annotation = catalog.iloc[array_table['catalog_row'].to_numpy()]
+    annotation.index = array_table.index
+    probe_infos = pd.concat([annotation, array_table.drop(columns='catalog_row')], axis=1)[columns]
+    # the catalog categories are the values of all the arrays, only keep the ones of this array
+    for column in probe_infos.select_dtypes('category').columns:
+        probe_infos[column] = probe_infos[column].cat.remove_unused_categories()
+    return probe_infos
+
+
+def write_catalog(probe_infos: dict[str, pd.DataFrame], folder: str | os.PathLike) -> list[str]:
+    """Write the catalog of the probe_infos of several array types in the folder of their genome version : the catalog
+    and its metadata (columns of each array type) in the folder, and the array tables in `<folder>/<array type>/`
+
+    :return: path of the written files
+    :rtype: list[str]"""
+
+    catalog, array_tables = build_catalog(probe_infos)
+    catalog_path = os.path.join(folder, CATALOG_FILE)
+    catalog.to_csv(catalog_path)
+    filepaths = [catalog_path]
+    for array_type, array_table in array_tables.items():
+        os.makedirs(os.path.join(folder, array_type), exist_ok=True)
+        filepaths.append(os.path.join(folder, array_type, ARRAY_PROBES_FILE))
+        array_table.to_csv(filepaths[-1])
+
+    metadata_path = os.path.join(folder, CATALOG_METADATA_FILE)
+    with open(metadata_path, 'w') as f:
+        json.dump({'catalog_rows': len(catalog),
+                   'arrays': {array_type: {'rows': len(df), 'columns': list(df.columns)}
+                              for array_type, df in probe_infos.items()}}, f, indent=2)
+    return filepaths + [metadata_path]
+
+
+def _find(filepath: str) -> str:
+    """Path of a generated file, or of its zipped version in the versioned folders"""
+    return filepath if os.path.exists(filepath) else filepath + '.zip'
+
+
+def read_catalog_metadata(folder: str | os.PathLike) -> dict | None:
+    """Read the metadata of the catalog of a genome version folder (json file or its zipped version), None if there is
+    no catalog"""
+    metadata_path = _find(os.path.join(folder, CATALOG_METADATA_FILE))
+    if not os.path.exists(metadata_path):
+        return None
+    if metadata_path.endswith('.zip'):
+        with zipfile.ZipFile(metadata_path) as archive:
+            return json.loads(archive.read(archive.namelist()[0]))
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+class ProbeCatalog:
+    """Probe catalog of a genome version, loaded once and used to build the probe_infos of any of its array types
+
+    :ivar catalog: annotation of the probes, indexed by catalog row
+    :vartype catalog: pandas.DataFrame
+
+    :ivar arrays: columns and number of rows of the probe_infos of each array type in the catalog
+    :vartype arrays: dict[str, dict]
+
+    :ivar folder: folder of the catalog
+    :vartype folder: str
+    """
+
+    def __init__(self, catalog: pd.DataFrame, arrays: dict[str, dict], folder: str | os.PathLike):
+        self.catalog = catalog
+        self.arrays = arrays
+        self.folder = folder
+
+    @classmethod
+    def read(cls, folder: str | os.PathLike):
+        """Read the catalog of a genome version folder (csv and json files, or their zipped versions)"""
+        metadata = read_catalog_metadata(folder)
+        if metadata is None:
+            raise FileNotFoundError(f'no probe catalog in {folder}')
+        catalog = pd.read_csv(_find(os.path.join(folder, CATALOG_FILE)), index_col='catalog_row',
+                              dtype=PROBE_INFOS_DTYPES, low_memory=False)
+        return cls(catalog, metadata['arrays'], folder)
+
+    @property
+    def array_types(self) -> list[str]:
+        """Array types in the catalog"""
+        return list(self.arrays)
+
+    def read_array_table(self, array_type: str) -> pd.DataFrame:
+        """Read the array table of an array type, indexed by illumina ID"""
+        if array_type not in self.arrays:
+            raise ValueError(f'no array type {array_type} in the catalog of {self.folder}')
+        return pd.read_csv(_find(os.path.join(self.folder, str(array_type), ARRAY_PROBES_FILE)),
+                           index_col='illumina_id', dtype=ARRAY_PROBES_DTYPES)
+
+    def probe_infos(self, array_type: str) -> pd.DataFrame:
+        """Probe infos of an array type, the same as its probe_infos.csv file read with PROBE_INFOS_DTYPES
+
+        :rtype: pandas.DataFrame"""
+        array_type = str(array_type)
+        return join_catalog(self.catalog, self.read_array_table(array_type), self.arrays[array_type]['columns'])
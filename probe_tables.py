@@ -0,0 +1,99 @@
+"""Normalized version of probe_infos : one row per probe, and a thin table mapping each address to its probe. Type I
+probes have two addresses, so the wide probe_infos table repeats all their information on two rows."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from normalization import PROBE_INFOS_DTYPES
+
+PROBES_FILE = 'probes.csv'
+ADDRESSES_FILE = 'addresses.csv'
+
+
+def split_probe_infos(probe_infos: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Split probe_infos in a probe table and an address table. Rows with the same probe ID and the same values are
+    stored once in the probe table.
+
+    :param probe_infos: probe infos indexed by illumina ID, with address_a and address_b columns
+    :type probe_infos: pandas.DataFrame
+
+    :return: the probe table (one row per probe, indexed by probe row number), and the address table indexed by
+        illumina ID, with columns `probe_row` (row of the probe in the probe table) and `role` ('A' or 'B')
+    :rtype: tuple[pandas.DataFrame, pandas.DataFrame]"""
+
+    # rows of the same probe have the same values, only their index differ
+    row_hashes = pd.util.hash_pandas_object(probe_infos, index=False).to_numpy()
+    probe_keys = pd.MultiIndex.from_arrays([probe_infos['probe_id'].to_numpy(), row_hashes])
+    probe_rows, unique_keys = pd.factorize(probe_keys)
+    first_rows = np.full(len(unique_keys), len(probe_rows), dtype='int64')
+    np.minimum.at(first_rows, probe_rows, np.arange(len(probe_rows)))
+
+    probes = probe_infos.iloc[first_rows].reset_index(drop=True)
+    probes.index.name = 'probe_row'
+
+    illumina_ids = probe_infos.index.to_numpy()
+    is_a = probe_infos['address_a'].to_numpy(dtype='float64', na_value=np.nan) == illumina_ids
+    is_b = probe_infos['address_b'].to_numpy(dtype='float64', na_value=np.nan) == illumina_ids
+    if not (is_a | is_b).all():
+        raise ValueError(f'{int((~(is_a | is_b)).sum())} illumina IDs are neither the address A nor B of their probe')
+    addresses = pd.DataFrame({'probe_row': probe_rows.astype('int32'),
+                              'role': pd.Categorical(np.where(is_b, 'B', 'A'), categories=['A', 'B'])},
+                             index=probe_infos.index)
+    return probes, addresses
+
+
+def join_probe_tables(probes: pd.DataFrame, addresses: pd.DataFrame) -> pd.DataFrame:
+    """Rebuild the wide probe_infos table from the probe and address tables (see `split_probe_infos`)
+
+    :return: probe infos indexed by illumina ID, in the order of the address table
+    :rtype: pandas.DataFrame"""
+
+    probe_infos = probes.iloc[addresses['probe_row'].to_numpy()]
+    probe_infos.index = addresses.index
+    return probe_infos
+
+
+def write_probe_tables(probe_infos: pd.DataFrame, folder: str | os.PathLike) -> tuple[str, str]:
+    """Write the probe and address tables of probe_infos as csv files in a folder
+
+    :return: path of the probe and address files
+    :rtype: tuple[str, str]"""
+
+    probes, addresses = split_probe_infos(probe_infos)
+    probes_path, addresses_path = os.path.join(folder, PROBES_FILE), os.path.join(folder, ADDRESSES_FILE)
+    probes.to_csv(probes_path)
+    # illumina IDs are the address A or B of the probe row, no need to write them again
+    addresses.to_csv(addresses_path, index=False)
+    return probes_path, addresses_path
+
+
+def read_probe_tables(folder: str | os.PathLike, wide=True) -> pd.DataFrame | tuple[pd.DataFrame, pd.DataFrame]:
+    """Read the probe and address tables of a folder (csv, or zipped csv as in the versioned folders).
+
+    :param folder: folder holding the probes.csv(.zip) and addresses.csv(.zip) files
+    :type folder: str | os.PathLike
+
+    :param wide: set to False to get the two tables instead of rebuilding the wide probe_infos table. Default: True
+    :type wide: bool
+
+    :return: the probe infos indexed by illumina ID, or the probe and address tables
+    :rtype: pandas.DataFrame | tuple[pandas.DataFrame, pandas.DataFrame]"""
+
+    def find(filename: str) -> str:
+        path = os.path.join(folder, filename)
+        return path if os.path.exists(path) else path + '.zip'
+
+    probes = pd.read_csv(find(PROBES_FILE), index_col='probe_row', dtype=PROBE_INFOS_DTYPES)
+    addresses = pd.read_csv(find(ADDRESSES_FILE), dtype={'probe_row': 'int32', 'role': pd.CategoricalDtype(['A', 'B'])})
+
+    # get the illumina IDs back from the addresses of the probes
+    probe_rows = addresses['probe_row'].to_numpy()
+    is_b = (addresses['role'] == 'B').to_numpy()
+    illumina_ids = np.where(is_b, probes['address_b'].to_numpy(dtype='int64', na_value=-1)[probe_rows],
+                            probes['address_a'].to_numpy(dtype='int64', na_value=-1)[probe_rows])
+    addresses.index = pd.Index(illumina_ids, name='illumina_id')
+    if not wide:
+        return probes, addresses
+    return join_probe_tables(probes, addresses)
@@ -0,0 +1,170 @@
+"""Provenance of the generated files : each combination folder of `_generated_data` records the inputs (urls and
+content hashes of the downloaded files, local genome info files), pipeline version and parameters it was built from, so
+that a new build can skip the combinations whose inputs didn't change"""
+
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import time
+from functools import cache
+from importlib import metadata
+
+from pylluminator.utils import get_logger
+
+from download_cache import fetch, file_checksum, get_cache
+
+LOGGER = get_logger()
+
+PROVENANCE_FILE = 'provenance.json'
+
+# module building the files, the code version covers it and the modules of the repository it imports
+BUILD_MODULE = 'create_manifest'
+
+# packages whose version can change the generated files
+PACKAGES = ['pylluminator', 'pandas', 'numpy', 'pyarrow']
+
+
+def git_revision() -> tuple[str | None, bool]:
+    """Current commit of the repository, and whether the working tree has uncommitted changes"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=repo_dir).stdout
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True,
+                                check=True, cwd=repo_dir).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit.strip(), status.strip() != ''
+
+
+def imported_modules(module: str, repo_dir: str) -> list[str]:
+    """Modules of the repository imported by a module, directly or through other modules, the module included
+
+    :return: the file paths of the modules, sorted
+    :rtype: list[str]"""
+    found = set()
+    to_visit = [module]
+    while len(to_visit) > 0:
+        name = to_visit.pop()
+        filepath = os.path.join(repo_dir, f'{name}.py')
+        if name in found or not os.path.exists(filepath):
+            continue
+        found.add(name)
+        with open(filepath) as f:
+            tree = ast.parse(f.read(), filepath)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                to_visit += [alias.name.split('.')[0] for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                to_visit.append(node.module.split('.')[0])
+    return sorted(os.path.join(repo_dir, f'{name}.py') for name in found)
+
+
+@cache
+def pipeline_version() -> dict:
+    """Version of the pipeline : hash of the code of the modules used by the build (BUILD_MODULE and the modules it
+    imports), versions of the packages it uses, and git commit for information. Computed once per process."""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    code_checksum = hashlib.sha256()
+    for filepath in imported_modules(BUILD_MODULE, repo_dir):
+        code_checksum.update(os.path.basename(filepath).encode())
+        code_checksum.update(file_checksum(filepath).encode())
+
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+
+    commit, dirty = git_revision()
+    return {'code_sha256': code_checksum.hexdigest(), 'packages': packages, 'commit': commit, 'dirty': dirty}
+
+
+def input_records(urls: list[str], local_files: list[str]) -> list[dict] | None:
+    """Content hash of the inputs of a build : downloaded files (from the download cache metadata, the files are
+    downloaded if needed) and local files.
+
+    :return: one record per input, or None if a file couldn't be downloaded
+    :rtype: list[dict] | None"""
+    records = []
+    for url in urls:
+        if fetch(url) is None:
+            return None
+        records.append({'url': url, 'sha256': get_cache().metadata(url)['sha256']})
+    for filepath in sorted(local_files):
+        records.append({'path': filepath.replace(os.sep, '/'), 'sha256': file_checksum(filepath)})
+    return records
+
+
+def make_provenance(inputs: list[dict], parameters: dict) -> dict:
+    """Provenance of a build before it runs : its inputs, the pipeline version, the parameters, and a fingerprint of
+    all of them (the git commit excluded, only the code matters)"""
+    version = pipeline_version()
+    fingerprinted = {'inputs': inputs, 'parameters': parameters, 'code_sha256': version['code_sha256'],
+                     'packages': version['packages']}
+    fingerprint = hashlib.sha256(json.dumps(fingerprinted, sort_keys=True, default=str).encode()).hexdigest()
+    return {'fingerprint': fingerprint, 'inputs': inputs, 'pipeline': version, 'parameters': parameters}
+
+
+def read_provenance(folder: str | os.PathLike) -> dict | None:
+    """Read the provenance of a folder, None if it has none"""
+    filepath = os.path.join(folder, PROVENANCE_FILE)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def write_provenance(folder: str | os.PathLike, provenance: dict, outputs: list[str], details: dict | None) -> str:
+    """Record the provenance of the files built in a folder, with their size and content hash and the details
+    returned by the build
+
+    :return: path of the provenance file
+    :rtype: str"""
+    record = {**provenance, 'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'details': details,
+              'outputs': {os.path.relpath(filepath, folder).replace(os.sep, '/'):
+                          {'size': os.path.getsize(filepath), 'sha256': file_checksum(filepath)}
+                          for filepath in outputs}}
+    filepath = os.path.join(folder, PROVENANCE_FILE)
+    with open(filepath, 'w') as f:
+        json.dump(record, f, indent=2, default=str)
+    return filepath
+
+
+def is_up_to_date(folder: str | os.PathLike, provenance: dict) -> dict | None:
+    """Check if the files of a folder were built from the same inputs, pipeline version and parameters, and weren't
+    modified or deleted since (same size)
+
+    :return: the recorded provenance if the folder is up to date, None otherwise
+    :rtype: dict | None"""
+    previous = read_provenance(folder)
+    if previous is None:
+        return None
+    if previous.get('fingerprint') != provenance['fingerprint']:
+        LOGGER.info(f'{folder} changed : {", ".join(describe_changes(previous, provenance))}')
+        return None
+    for name, output in previous['outputs'].items():
+        filepath = os.path.join(folder, name)
+        if not os.path.exists(filepath) or os.path.getsize(filepath) != output['size']:
+            LOGGER.info(f'{filepath} is missing or was modified')
+            return None
+    return previous
+
+
+def describe_changes(previous: dict, provenance: dict) -> list[str]:
+    """List what changed between two provenance records : inputs, code, packages or parameters"""
+    changes = []
+    old_inputs = {record.get('url', record.get('path')): record['sha256'] for record in previous.get('inputs', [])}
+    new_inputs = {record.get('url', record.get('path')): record['sha256'] for record in provenance['inputs']}
+    changes += [f'{name} {"changed" if name in old_inputs else "added"}' for name, sha256 in new_inputs.items()
+                if old_inputs.get(name) != sha256]
+    changes += [f'{name} removed' for name in old_inputs if name not in new_inputs]
+    for key in ['code_sha256', 'packages']:
+        if previous.get('pipeline', {}).get(key) != provenance['pipeline'][key]:
+            changes.append('pipeline code' if key == 'code_sha256' else 'package versions')
+    if previous.get('parameters') != provenance['parameters']:
+        changes.append('parameters')
+    return changes
@@ -0,0 +1,189 @@
+"""Run a build function on every ArrayType * GenomeVersion combination in a process pool, and summarize the results"""
+
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pylluminator.annotations import ArrayType, GenomeVersion
+from pylluminator.utils import get_logger
+
+from instrumentation import RECORDER, summarize_stages
+from normalization import DTYPE_POLICIES
+from prefetch import prefetch
+
+LOGGER = get_logger()
+
+# largest arrays first : the slowest builds start right away, and the small ones fill the workers left idle
+ARRAY_BUILD_ORDER = [ArrayType.HUMAN_EPIC_V2, ArrayType.HUMAN_MSA, ArrayType.HUMAN_EPIC_PLUS, ArrayType.HUMAN_EPIC,
+                     ArrayType.HUMAN_450K, ArrayType.MOUSE_MM285, ArrayType.HUMAN_27K, ArrayType.MAMMAL_40]
+
+
+def get_parser(description: str, summary_file: str = 'build_summary.json') -> argparse.ArgumentParser:
+    """Command line options shared by the scripts building all the combinations"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of combinations built in parallel, each process holds a whole manifest in memory '
+                             '(see the README for the peak memory of each array). Default: 1')
+    parser.add_argument('--summary', default=summary_file,
+                        help=f'where to write the json summary of the build. Default: {summary_file}')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use the files already in the download cache, fail if one is missing')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='check with the servers that the cached files are up to date')
+    parser.add_argument('--downloads', type=int, default=8,
+                        help='maximum number of files downloaded at the same time. Default: 8')
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help='save a cProfile dump of each stage of each combination in this folder')
+    parser.add_argument('--dtypes', choices=DTYPE_POLICIES, default='default',
+                        help='dtype policy of the probe infos, "lean" uses less memory for the same values. '
+                             'Default: default')
+    return parser
+
+
+def get_combinations() -> list[tuple[ArrayType, GenomeVersion]]:
+    """List the (array type, genome version) pairs of the same species, the largest arrays first"""
+
+    def build_rank(array_type: ArrayType) -> int:
+        return ARRAY_BUILD_ORDER.index(array_type) if array_type in ARRAY_BUILD_ORDER else len(ARRAY_BUILD_ORDER)
+
+    return [(at, gv) for at in sorted(ArrayType, key=build_rank) for gv in GenomeVersion
+            if at.is_human() == gv.is_human()]
+
+
+def run_task(func, array_type: ArrayType, genome_version: GenomeVersion, profile_dir: str | None = None) -> dict:
+    """Run `func(array_type, genome_version)` and catch any error, so that a failure only affects its own combination.
+
+    The function returns a dictionary of details to report (row counts, output paths...), or None if there was nothing
+    to build for this combination. The stages recorded by RECORDER while the function runs are added to the result.
+
+    :param profile_dir: if set, save a cProfile dump of each stage in this folder. Default: None
+    :type profile_dir: str | None
+
+    :return: the status ('ok', 'skipped' or 'failed'), duration, error, details and stages of the task
+    :rtype: dict"""
+
+    result = {'array_type': str(array_type), 'genome_version': str(genome_version)}
+    RECORDER.start_task(f'{genome_version}_{array_type}', profile_dir)
+    start_time = time.perf_counter()
+    try:
+        details = func(array_type, genome_version)
+        result['status'] = 'skipped' if details is None else 'ok'
+        result['details'] = details
+    except Exception:
+        LOGGER.error(f'build failed for {array_type} {genome_version}')
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['duration'] = round(time.perf_counter() - start_time, 2)
+    result['stages'] = RECORDER.finish_task()
+    result['stage_totals'] = summarize_stages(result['stages'])
+    return result
+
+
+def run_all(func, combinations: list[tuple[ArrayType, GenomeVersion]], jobs: int = 1, initializer=None,
+            initargs: tuple = (), links: dict | None = None, max_downloads: int = 8,
+            profile_dir: str | None = None) -> list[dict]:
+    """Run `func` on all the combinations, in a pool of `jobs` processes (or in the current process if `jobs` is 1).
+    `func` must be defined at the top level of a module so that it can be sent to the worker processes.
+    `initializer(*initargs)` is called once in each process before running any task (e.g. to configure the cache).
+
+    If `links` is given, the files of all the combinations are first downloaded concurrently in the cache, and each
+    combination is started as soon as its own files are available.
+
+    :param links: urls of the files needed by each combination. Default: None
+    :type links: dict[tuple[ArrayType, GenomeVersion], list[str]] | None
+
+    :param max_downloads: maximum number of concurrent downloads. Default: 8
+    :type max_downloads: int
+
+    :param profile_dir: if set, save a cProfile dump of each stage of each combination in this folder. Default: None
+    :type profile_dir: str | None
+
+    :return: the result of each task, in the order of `combinations`
+    :rtype: list[dict]"""
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    if jobs is None or jobs <= 1:
+        if links is not None:
+            prefetch([url for combination in combinations for url in links.get(combination, [])],
+                     max_concurrency=max_downloads)
+        return [run_task(func, at, gv, profile_dir) for at, gv in combinations]
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(combinations)), initializer=initializer,
+                             initargs=initargs) as executor:
+        futures = {}
+
+        def submit(combination: tuple[ArrayType, GenomeVersion]) -> None:
+            futures[executor.submit(run_task, func, *combination, profile_dir)] = combination
+
+        if links is None:
+            for combination in combinations:
+                submit(combination)
+        else:
+            missing_files = {combination: set(links.get(combination, [])) for combination in combinations}
+
+            def on_download(url, _):
+                for combination in combinations:
+                    if combination in missing_files:
+                        missing_files[combination].discard(url)
+                        if len(missing_files[combination]) == 0:
+                            del missing_files[combination]
+                            submit(combination)
+
+            for combination in [c for c in combinations if len(missing_files[c]) == 0]:
+                del missing_files[combination]
+                submit(combination)
+            prefetch([url for combination in combinations for url in links.get(combination, [])],
+                     max_concurrency=max_downloads, on_complete=on_download)
+            # offline mode, or failed downloads : the task will report the error
+            for combination in list(missing_files):
+                submit(combination)
+
+        for future in as_completed(futures):
+            at, gv = futures[future]
+            try:
+                results[(at, gv)] = future.result()
+            except Exception:
+                # the worker process itself died (out of memory...), not only the build function
+                results[(at, gv)] = {'array_type': str(at), 'genome_version': str(gv), 'status': 'failed',
+                                     'error': traceback.format_exc()}
+            LOGGER.info(f'{at} {gv} : {results[(at, gv)]["status"]}')
+
+    return [results[combination] for combination in combinations]
+
+
+def format_gene_agreement(agreement: dict | None) -> str:
+    """Share of the probes with the same genes in SeSAMe and in the local transcripts model, for the build summary"""
+    if agreement is None or agreement['both'] == 0:
+        return ''
+    return f'  same genes as SeSAMe : {agreement["same_genes"] / agreement["both"]:.1%}'
+
+
+def write_summary(results: list[dict], filepath: str | os.PathLike | None = None) -> None:
+    """Log a one line summary per combination, and save the full results as json if a filepath is given"""
+
+    LOGGER.info('------------------- build summary')
+    for result in results:
+        # slowest top-level stage, to see at a glance where the time goes
+        stages = [stage for stage in result.get('stages', []) if stage['depth'] == 0 and 'seconds' in stage]
+        slowest = max(stages, key=lambda stage: stage['seconds'], default=None)
+        LOGGER.info(f'{result["genome_version"]:<6} {result["array_type"]:<10} {result["status"]:<8} '
+                    f'{result.get("duration", float("nan")):>8.1f}s'
+                    + ('  unchanged' if (result.get('details') or {}).get('unchanged') else '')
+                    + format_gene_agreement((result.get('details') or {}).get('gene_agreement'))
+                    + ('' if slowest is None else f'  slowest stage : {slowest["stage"]} {slowest["seconds"]:.1f}s'))
+
+    failed = [r for r in results if r['status'] == 'failed']
+    if len(failed) > 0:
+        LOGGER.warning(f'{len(failed)} combination(s) failed : '
+                       + ', '.join(f'{r["array_type"]} {r["genome_version"]}' for r in failed))
+
+    if filepath is not None:
+        with open(filepath, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+        LOGGER.info(f'build summary saved in {filepath}')
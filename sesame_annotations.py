@@ -1,10 +1,17 @@
 """Read data downloaded from SeSAMe annotations and restructure them to match pylluminator data structure"""
-import os
+from functools import cached_property
 
 from pylluminator.annotations import ArrayType, GenomeVersion, GenomeInfo
-from pylluminator.utils import get_resource_folder, download_from_link, column_names_to_snake_case, concatenate_non_na
+from pylluminator.utils import column_names_to_snake_case
 from pylluminator.utils import get_logger
 
+from annotation_cache import ANNOTATION_CACHE
+from download_cache import fetch
+from gene_annotation import TranscriptIndex, annotate_genes, compare_gene_sets
+from instrumentation import RECORDER, file_size
+from knowledgebases import join_knowledgebases
+from normalization import apply_dtype_policy, concat_chunks, extract_probe_types, normalize_manifest
+
 import pandas as pd
 
 LOGGER = get_logger()
@@ -81,26 +88,95 @@ LINKS = {
     }
 }
 
+# KYCG knowledgebases joined to the probe infos : name of the probe infos column -> kind of the annotation in LINKS. To
+# add a knowledgebase (e.g. chromatin states), add its links in LINKS and its column here
+KNOWLEDGEBASES = {'cgi': 'island_relation'}
+KNOWLEDGEBASE_COLUMNS = {'probe_id': 'str', 'knowledgebase': 'str'}
+
+# columns of each annotation file used to make the probe infos (snake case names), and their type. Only these columns
+# are read in streaming mode
+ANNOTATION_COLUMNS = {
+    'mask': {'probe_id': 'str', 'mask_uniq': 'str'},
+    'manifest': {'probe_id': 'str', 'design_type': 'category', 'channel': 'category', 'address_a': 'Int64',
+                 'address_b': 'Int64', 'cpg_chrm': 'category', 'cpg_beg': 'Int64', 'cpg_end': 'Int64',
+                 'probe_strand': 'str'},
+    'gene': {'probe_id': 'str', 'genes_uniq': 'str'},
+    'island_relation': KNOWLEDGEBASE_COLUMNS
+}
+
 class SesameAnnotations:
     """Extract meaningful information from Sesame data files, and create dataframes with pylluminator format"""
 
-    def __init__(self, array_type: ArrayType, genome_version: GenomeVersion, load_all=True):
-        if load_all:
-            LOGGER.info('Loading SeSAMe annotations')
+    def __init__(self, array_type: ArrayType, genome_version: GenomeVersion, load_all=False,
+                 chunksize: int | None = None, dtype_policy: str = 'default'):
+        """Initialize the SeSAMe annotations of an array type and genome version. Annotations (`mask`, `manifest`,
+        `genome_info`, `gene`, `island_relation` and `probe_infos`) are loaded the first time they are accessed, and
+        parsed files are shared with the other instances through ANNOTATION_CACHE.
+
+        :param array_type: illumina array type (EPIC, MSA...)
+        :type array_type: ArrayType
+        :param genome_version: genome version to use (hg38, mm10...)
+        :type genome_version: GenomeVersion
+        :param load_all: set to True to load all the annotations now instead of on first access. Default: False
+        :type load_all: bool
+        :param chunksize: if set, annotation files are streamed by chunks of this number of rows, and only the columns
+            needed for the probe infos are read (see ANNOTATION_COLUMNS). Default: None, read the whole files
+        :type chunksize: int | None
+        :param dtype_policy: dtypes of the probe infos columns, see `normalization.apply_dtype_policy`. Default: 'default'
+        :type dtype_policy: str"""
 
         self.array_type = array_type
         self.genome_version = genome_version
+        self.chunksize = chunksize
+        self.dtype_policy = dtype_policy
+        # agreement of the SeSAMe genes with the local transcripts model, set when the probe infos are made
+        self.gene_agreement = None
         if load_all:
-            self.mask = self.load_annotation('mask')
-            self.manifest = self.load_annotation('manifest')
-            self.genome_info = self.load_annotation('genome_info')
-            self.gene = self.load_annotation('gene')
-            self.island_relation = self.load_annotation('island_relation')
-            if self.manifest is not None:
-                self.probe_infos = self.make_pylluminator_probe_info()
+            LOGGER.info('Loading SeSAMe annotations')
+            _ = self.probe_infos
+
+    @cached_property
+    def mask(self) -> pd.DataFrame | None:
+        """Probes mask, indexed by probe ID"""
+        return self.load_annotation('mask')
+
+    @cached_property
+    def manifest(self) -> pd.DataFrame | None:
+        """Manifest, indexed by illumina ID"""
+        return self.load_annotation('manifest')
+
+    @cached_property
+    def genome_info(self) -> GenomeInfo:
+        """Genome information of the genome version"""
+        return self.load_annotation('genome_info')
+
+    @cached_property
+    def gene(self) -> pd.DataFrame | None:
+        """Genes associated with each probe, indexed by probe ID"""
+        return self.load_annotation('gene')
+
+    @cached_property
+    def island_relation(self) -> pd.DataFrame | None:
+        """CpG island relation of each probe, indexed by probe ID"""
+        return self.load_annotation('island_relation')
+
+    @cached_property
+    def probe_infos(self) -> pd.DataFrame | None:
+        """Probes information in pylluminator format, see `make_pylluminator_probe_info`"""
+        return self.make_pylluminator_probe_info()
 
     def load_annotation(self, kind: str) -> pd.DataFrame | None:
-        """Download or read an annotation file. Kind must be 'mask', 'manifest', 'genome_info' or 'gene'"""
+        """Get an annotation from ANNOTATION_CACHE, or download and read its file if it's not cached yet. Kind must be
+        'mask', 'manifest', 'genome_info', 'gene' or 'island_relation'. The returned dataframe is shared, it must not be
+        modified in place."""
+
+        # genome info doesn't depend on the array type. Streamed annotations only have a subset of the columns
+        array_type = None if kind == 'genome_info' else self.array_type
+        key = (kind, array_type, self.genome_version, self.chunksize is not None)
+        return ANNOTATION_CACHE.get(key, lambda: self._read_annotation(kind))
+
+    def _read_annotation(self, kind: str) -> pd.DataFrame | None:
+        """Download or read an annotation file, without using ANNOTATION_CACHE"""
 
         LOGGER.debug(f'>> loading {kind} for {self.array_type} {self.genome_version} from Sesame')
 
@@ -121,49 +197,51 @@ class SesameAnnotations:
             LOGGER.error(f'SeSAMe - Unsupported {kind} array type {self.array_type} for genome version {self.genome_version}')
             return None
 
-        # get the annotation resource folder
-        data_folder = get_resource_folder('tmp')
-        filelink = LINKS[kind][self.genome_version][self.array_type]
-        local_filepath = data_folder.joinpath(filelink.split('/')[-1])
-
-        # all the 'cgi' files are called the same no matter the array type/genome version so we need to delete them each time
-        if kind == 'island_relation' and os.path.exists(local_filepath):
-            os.remove(local_filepath)
-
-        # if the csv manifest file doesn't exist, download it from sesame repository
-        return_status = download_from_link(filelink, data_folder)
-        if return_status == -1:
+        # if the file isn't cached yet, download it from sesame repository
+        local_filepath = fetch(LINKS[kind][self.genome_version][self.array_type])
+        if local_filepath is None:
             return None
 
         # now read the downloaded manifest file
-        df = pd.read_csv(str(local_filepath), delimiter='\t')
+        if self.chunksize is None:
+            with RECORDER.stage('parse', bytes_read=file_size(local_filepath), kind=kind) as record:
+                df = pd.read_csv(str(local_filepath), delimiter='\t')
+                record['rows_out'] = len(df)
+            with RECORDER.stage('normalize', rows_in=len(df), kind=kind) as record:
+                df = self._normalize_annotation(df, kind)
+                record['rows_out'] = len(df)
+            return df
+
+        # streaming mode : only read the needed columns with their declared type, and normalize each chunk on the fly
+        with RECORDER.stage('parse', bytes_read=file_size(local_filepath), kind=kind,
+                            chunksize=self.chunksize) as record:
+            columns = pd.read_csv(str(local_filepath), delimiter='\t', nrows=0).columns
+            snake_columns = column_names_to_snake_case(pd.DataFrame(columns=columns)).columns
+            kind_columns = ANNOTATION_COLUMNS.get(kind, KNOWLEDGEBASE_COLUMNS)
+            dtypes = {col: kind_columns[snake_col] for col, snake_col in zip(columns, snake_columns)
+                      if snake_col in kind_columns}
+            with pd.read_csv(str(local_filepath), delimiter='\t', usecols=list(dtypes), dtype=dtypes,
+                             chunksize=self.chunksize) as reader:
+                df = concat_chunks([self._normalize_annotation(chunk, kind) for chunk in reader])
+            record['rows_out'] = len(df)
+        return df
+
+    @staticmethod
+    def _normalize_annotation(df: pd.DataFrame, kind: str) -> pd.DataFrame:
+        """Rename the columns and set the index of an annotation dataframe (or of a chunk of it)"""
 
         # uniformization - who likes camel case ?
         df = column_names_to_snake_case(df)
 
         # extract probe type from probe id (first letters, identifies control probes, snp...)
-        df['probe_type'] = df['probe_id'].str.extract(r'^([a-zA-Z]+)')
+        df['probe_type'] = extract_probe_types(df['probe_id'])
 
         # set dataframes index + specific processing for manifest file
         if kind == 'manifest':
-            # for type I probes that have both address A and address B set, split them in two rows
-            df['illumina_id'] = df.apply(lambda x: concatenate_non_na(x, ['address_a', 'address_b']), axis=1)
-            df = df.explode('illumina_id', ignore_index=True)
             df = df.rename(columns={'design_type': 'type', 'cpg_chrm': 'chromosome',
                                     'cpg_beg': 'start', 'cpg_end': 'end', 'probe_strand': 'strand'}, errors='ignore')
-            df['chromosome'] = df['chromosome'].str.lower().str.replace('chr', '').str.upper()
-            # turn some columns into categories as it speeds up further processing
-            ini_size = len(df)
-            df = df.dropna(subset=['illumina_id'])
-            LOGGER.info(f'dropped {ini_size - len(df)} probes with missing illumina ID')
-            df = df.astype({'illumina_id': 'int', 'type': 'category', 'probe_type': 'category',
-                            'channel' :'category', 'chromosome': 'category', 'start': 'Int64',
-                            'end': 'Int64', 'address_a': 'Int64', 'address_b': 'Int64'})
-            df = df.set_index('illumina_id')
-            df['probe_type'] = df.probe_type.cat.rename_categories({'rs': 'snp'})  # to improve readability
-            if 'strand' not in df.columns:
-                LOGGER.info('creating probe strand column')
-                df['strand'] = '*'
+            # for type I probes that have both address A and address B set, split them in two rows
+            df = normalize_manifest(df, {'start': 'Int64', 'end': 'Int64', 'address_a': 'Int64', 'address_b': 'Int64'})
         else:
             df = df.set_index('probe_id')
             if kind == 'mask':
@@ -185,29 +263,48 @@ class SesameAnnotations:
 
         if self.mask is not None:
             if 'mask_uniq' not in self.mask.columns:
-                LOGGER.warning('Make pylluminator probe info : mask missing mask_uniq column, resetting it')
                 # todo handle old mask versions
-                self.mask = None
+                LOGGER.warning('Make pylluminator probe info : mask missing mask_uniq column, ignoring it')
             else:
                 # select mask column (`mask_uniq` or column `mask_info` to get all  the information)
-                mask = self.mask[['mask_uniq']].rename(columns={'mask_uniq': 'mask_info'})
-                mask.mask_info = mask.mask_info.str.replace(',', ';').replace('"', '')
-                manifest = manifest.join(mask, on='probe_id')
+                with RECORDER.stage('join', rows_in=len(manifest), annotation='mask') as record:
+                    mask = self.mask[['mask_uniq']].rename(columns={'mask_uniq': 'mask_info'})
+                    mask.mask_info = mask.mask_info.str.replace(',', ';').replace('"', '')
+                    manifest = manifest.join(mask, on='probe_id')
+                    record['rows_out'] = len(manifest)
 
+        # transcripts model of the genome info files, None if the genome version has none
+        transcript_index = ANNOTATION_CACHE.get(('transcript_index', None, self.genome_version),
+                                                lambda: TranscriptIndex.from_genome_version(self.genome_version))
         if self.gene is not None:
             # select genes columns
-            genes = self.gene[['genes_uniq']].rename(columns={'genes_uniq': 'genes'})
-            manifest = manifest.join(genes, on='probe_id')
+            with RECORDER.stage('join', rows_in=len(manifest), annotation='gene') as record:
+                genes = self.gene[['genes_uniq']].rename(columns={'genes_uniq': 'genes'})
+                manifest = manifest.join(genes, on='probe_id')
+                record['rows_out'] = len(manifest)
             # manifest.transcript_types = manifest.transcript_types.apply(lambda x: ';'.join(set(str(x).replace('nan', '').split(';'))))
-
-        if self.island_relation is not None:
-            self.island_relation['cgi'] = self.island_relation['knowledgebase'].str.replace('CGI;', '')
-            self.island_relation = self.island_relation['cgi']  # keep only this column
-            self.island_relation = self.island_relation.groupby('probe_id').apply(lambda x: ';'.join(x))
-            manifest = manifest.join(self.island_relation, on='probe_id')
-            print(manifest)
+            if transcript_index is not None:
+                # both annotations exist : check the local one against SeSAMe
+                with RECORDER.stage('compare', rows_in=len(manifest), annotation='transcripts'):
+                    local_genes = pd.Series(annotate_genes(manifest, transcript_index), index=manifest.index)
+                    self.gene_agreement = compare_gene_sets(local_genes, manifest['genes'])
+                LOGGER.info(f'genes of the local transcripts model vs SeSAMe : {self.gene_agreement}')
         else:
-            print('no island relations')
-            # print(self.island_relation)
+            # no SeSAMe gene annotation for this combination, use the transcripts model of the genome info files
+            if transcript_index is not None:
+                LOGGER.info('annotating probes with the genes of the local transcripts model')
+                with RECORDER.stage('join', rows_in=len(manifest), annotation='transcripts') as record:
+                    manifest = manifest.assign(genes=annotate_genes(manifest, transcript_index))
+                    record['rows_out'] = len(manifest)
+
+        knowledgebases = {column: self.load_annotation(kind) for column, kind in KNOWLEDGEBASES.items()
+                          if self.genome_version in LINKS[kind] and self.array_type in LINKS[kind][self.genome_version]}
+        knowledgebases = {column: kb for column, kb in knowledgebases.items() if kb is not None}
+        if len(knowledgebases) > 0:
+            with RECORDER.stage('join', rows_in=len(manifest), annotation=','.join(knowledgebases)) as record:
+                manifest = join_knowledgebases(manifest, knowledgebases)
+                record['rows_out'] = len(manifest)
 
-        return manifest.sort_index().sort_values('probe_id')
\ No newline at end of file
+        with RECORDER.stage('normalize', rows_in=len(manifest), kind='probe_infos'):
+            manifest = manifest.sort_index().sort_values('probe_id')
+        return apply_dtype_policy(manifest, self.dtype_policy)
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""Encoded forms of the multi-value columns of probe_infos (mask_info, genes, cgi), stored as ';'-joined strings in the
+csv files. Mask reasons become a bitset per probe, and genes and CGI relations a sparse probe x term matrix, so that
+probes can be filtered by mask reason or gene without parsing strings."""
+
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+SEPARATOR = ';'
+
+# encoding of each multi-value column
+ENCODED_COLUMNS = {'mask_info': 'bitset', 'genes': 'csr', 'cgi': 'csr'}
+
+
+def _term_codes(sorted_terms: np.ndarray, terms: str | list[str]) -> np.ndarray:
+    """Position of the terms in a sorted term dictionary, unknown terms are ignored"""
+    terms = np.array([terms] if isinstance(terms, str) else list(terms), dtype=object)
+    positions = np.searchsorted(sorted_terms, terms)
+    found = positions < len(sorted_terms)
+    positions, terms = positions[found], terms[found]
+    return positions[sorted_terms[positions] == terms]
+
+
+class TermIndex:
+    """Sparse probe x term matrix in CSR format : the terms of probe i are `terms[indices[indptr[i]:indptr[i + 1]]]`,
+    in their original order.
+
+    :ivar indptr: start of the terms of each probe in `indices`, of length number of probes + 1
+    :vartype indptr: numpy.ndarray
+
+    :ivar indices: term codes, position of the term in `terms`
+    :vartype indices: numpy.ndarray
+
+    :ivar terms: term dictionary, sorted
+    :vartype terms: numpy.ndarray
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, terms: np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+        self.terms = terms
+
+    @classmethod
+    def from_strings(cls, values: pd.Series | np.ndarray, separator: str = SEPARATOR):
+        """Encode joined strings (e.g. 'GENE1;GENE2'). NA and empty values have no term.
+
+        Only the distinct values are split, the terms of each probe are then gathered with array operations.
+
+        :param values: joined terms of each probe
+        :type values: pandas.Series | numpy.ndarray
+
+        :param separator: separator of the terms. Default: ';'
+        :type separator: str"""
+
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+
+        # split the distinct values and build the term dictionary
+        split_uniques = [[term for term in str(value).split(separator) if term != ''] for value in uniques]
+        terms = np.array(sorted({term for value_terms in split_uniques for term in value_terms}), dtype=object)
+        term_codes = {term: i for i, term in enumerate(terms)}
+        unique_counts = np.array([len(value_terms) for value_terms in split_uniques] + [0], dtype='int64')
+        unique_indptr = np.r_[0, np.cumsum(unique_counts)]
+        unique_indices = np.array([term_codes[term] for value_terms in split_uniques for term in value_terms],
+                                  dtype='int32')
+
+        # NA values have the code -1, which points to the last (empty) unique value
+        codes = np.where(codes < 0, len(uniques), codes)
+        counts = unique_counts[codes]
+        indptr = np.r_[0, np.cumsum(counts)]
+        # position of each term of each probe in unique_indices
+        positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - unique_indptr[codes], counts)
+        return cls(indptr, unique_indices[positions], terms)
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def probe_indices(self) -> np.ndarray:
+        """Probe (row) of each element of `indices`"""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def contains(self, terms: str | list[str]) -> np.ndarray:
+        """Mask of the probes having at least one of the terms (e.g. probes overlapping one of the genes)
+
+        :rtype: numpy.ndarray"""
+        is_selected = np.isin(self.indices, _term_codes(self.terms, terms))
+        result = np.zeros(len(self), dtype=bool)
+        result[self.probe_indices()[is_selected]] = True
+        return result
+
+    def to_strings(self, separator: str = SEPARATOR) -> np.ndarray:
+        """Join the terms of each probe back to strings, None for probes without term"""
+        series = pd.Series(self.terms[self.indices], index=self.probe_indices(), dtype=object)
+        joined = series.groupby(level=0, sort=True).agg(separator.join)
+        result = np.full(len(self), None, dtype=object)
+        result[joined.index.to_numpy()] = joined.to_numpy()
+        return result
+
+
+def _term_order(term_index: TermIndex) -> np.ndarray | None:
+    """Order of the terms that all the probes follow (e.g. SeSAMe lists the mask reasons of a probe in the order of the
+    mask columns), the terms that can be in any order being sorted. None if the probes list their terms in contradicting
+    orders.
+
+    :return: term codes, in order
+    :rtype: numpy.ndarray | None"""
+
+    # pairs of consecutive terms of the same probe : the first one must come before the second one
+    same_probe = np.diff(term_index.probe_indices()) == 0
+    pairs = np.unique(np.stack([term_index.indices[:-1][same_probe], term_index.indices[1:][same_probe]], axis=1), axis=0)
+
+    successors = [[] for _ in range(len(term_index.terms))]
+    nb_predecessors = np.zeros(len(term_index.terms), dtype='int64')
+    for before, after in pairs:
+        successors[before].append(after)
+        nb_predecessors[after] += 1
+
+    # topological sort, picking the first term in alphabetical order among the ones that can come next
+    ready = [code for code in range(len(term_index.terms)) if nb_predecessors[code] == 0]
+    order = []
+    while len(ready) > 0:
+        code = heapq.heappop(ready)
+        order.append(code)
+        for after in successors[code]:
+            nb_predecessors[after] -= 1
+            if nb_predecessors[after] == 0:
+                heapq.heappush(ready, after)
+    return np.array(order, dtype='int64') if len(order) == len(term_index.terms) else None
+
+
+class TermBitset:
+    """One bit per term and per probe, for columns with at most 64 distinct terms (e.g. mask reasons). Bit i is set if
+    the probe has the term `terms[i]`.
+
+    :ivar bits: bitset of each probe
+    :vartype bits: numpy.ndarray
+
+    :ivar terms: term of each bit, in the order the encoded strings list them (sorted if they contradict each other)
+    :vartype terms: numpy.ndarray
+    """
+
+    def __init__(self, bits: np.ndarray, terms: np.ndarray):
+        self.bits = bits
+        self.terms = terms
+
+    @classmethod
+    def from_term_index(cls, term_index: TermIndex):
+        """Convert a sparse term matrix to bitsets. The bits follow the order of the terms in the probes (see
+        `_term_order`), so that `to_strings` gives back the original strings."""
+        if len(term_index.terms) > 64:
+            raise ValueError(f'{len(term_index.terms)} terms, a bitset can only hold 64')
+        order = _term_order(term_index)
+        if order is None:
+            order = np.arange(len(term_index.terms))
+        bit_positions = np.empty(len(order), dtype='uint64')
+        bit_positions[order] = np.arange(len(order), dtype='uint64')
+        bits = np.zeros(len(term_index), dtype='uint64')
+        np.bitwise_or.at(bits, term_index.probe_indices(), np.left_shift(np.uint64(1),
+                                                                          bit_positions[term_index.indices]))
+        return cls(bits, term_index.terms[order])
+
+    @classmethod
+    def from_strings(cls, values: pd.Series | np.ndarray, separator: str = SEPARATOR):
+        """Encode joined strings (e.g. 'M_nonuniq;M_mapping'), see `TermIndex.from_strings`"""
+        return cls.from_term_index(TermIndex.from_strings(values, separator))
+
+    def __len__(self) -> int:
+        return len(self.bits)
+
+    def mask(self, terms: str | list[str]) -> np.uint64:
+        """Bitset of the terms, unknown terms are ignored"""
+        mask = np.uint64(0)
+        terms = [terms] if isinstance(terms, str) else list(terms)
+        for code in np.flatnonzero(np.isin(self.terms, np.array(terms, dtype=object))):
+            mask |= np.uint64(1) << np.uint64(code)
+        return mask
+
+    def contains(self, terms: str | list[str]) -> np.ndarray:
+        """Mask of the probes having at least one of the terms (e.g. probes masked for `M_nonuniq`)"""
+        return (self.bits & self.mask(terms)) != 0
+
+    def contains_all(self, terms: str | list[str]) -> np.ndarray:
+        """Mask of the probes having all the terms"""
+        mask = self.mask(terms)
+        return (self.bits & mask) == mask
+
+    def to_strings(self, separator: str = SEPARATOR) -> np.ndarray:
+        """Join the terms of each probe back to strings in the order of `terms`, i.e. the original strings if they
+        all list their terms in the same order, None for probes without term"""
+        result = np.full(len(self), None, dtype=object)
+        for i, term in enumerate(self.terms):
+            has_term = (self.bits >> np.uint64(i)) & np.uint64(1) == 1
+            is_first = has_term & pd.isna(result)
+            result[has_term & ~is_first] = result[has_term & ~is_first] + separator + term
+            result[is_first] = term
+        return result
+
+
+def count_decoding_errors(values: pd.Series | np.ndarray, encoded: TermIndex | TermBitset,
+                          separator: str = SEPARATOR) -> int:
+    """Number of values that the encoded column doesn't decode back to (NA and empty strings being the same)"""
+    decoded = pd.Series(encoded.to_strings(separator), dtype=object).fillna('')
+    return int((pd.Series(np.asarray(values, dtype=object), dtype=object).fillna('') != decoded).sum())
+
+
+def encode_probe_infos(probe_infos: pd.DataFrame) -> dict[str, TermIndex | TermBitset]:
+    """Encode the multi-value columns of probe_infos found in ENCODED_COLUMNS. Mask reasons fall back to the sparse
+    encoding if there are more than 64 of them."""
+    encoded = {}
+    for column, encoding in ENCODED_COLUMNS.items():
+        if column not in probe_infos.columns:
+            continue
+        term_index = TermIndex.from_strings(probe_infos[column])
+        encoded[column] = TermBitset.from_term_index(term_index) \
+            if encoding == 'bitset' and len(term_index.terms) <= 64 else term_index
+    return encoded
+
+
+def save_encoded(encoded: dict[str, TermIndex | TermBitset], illumina_ids: pd.Index | np.ndarray,
+                 filepath: str | os.PathLike) -> None:
+    """Save encoded columns in a compressed numpy archive, with the illumina IDs of the probes (rows)"""
+    arrays = {'illumina_id': np.asarray(illumina_ids, dtype='int64')}
+    for column, encoded_column in encoded.items():
+        # terms are saved as fixed-length unicode so that the archive can be loaded without pickle
+        arrays[f'{column}.terms'] = encoded_column.terms.astype(str)
+        if isinstance(encoded_column, TermBitset):
+            arrays[f'{column}.bits'] = encoded_column.bits
+        else:
+            arrays[f'{column}.indptr'] = encoded_column.indptr
+            arrays[f'{column}.indices'] = encoded_column.indices
+    np.savez_compressed(filepath, **arrays)
+
+
+def load_encoded(filepath: str | os.PathLike) -> tuple[np.ndarray, dict[str, TermIndex | TermBitset]]:
+    """Load the encoded columns saved by `save_encoded`
+
+    :return: the illumina IDs of the probes, and the encoded columns
+    :rtype: tuple[numpy.ndarray, dict[str, TermIndex | TermBitset]]"""
+    encoded = {}
+    with np.load(filepath) as archive:
+        illumina_ids = archive['illumina_id']
+        for key in archive.files:
+            if not key.endswith('.terms'):
+                continue
+            column = key[:-len('.terms')]
+            terms = archive[key].astype(object)
+            if f'{column}.bits' in archive.files:
+                encoded[column] = TermBitset(archive[f'{column}.bits'], terms)
+            else:
+                encoded[column] = TermIndex(archive[f'{column}.indptr'], archive[f'{column}.indices'], terms)
+    return illumina_ids, encoded
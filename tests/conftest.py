@@ -0,0 +1,126 @@
+"""Local HTTP server standing in for the annotation servers (GitHub, Illumina) in the download tests"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the scripts are modules at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve the files of the server with ETag validators, conditional requests (If-None-Match) and range requests
+    (Range, If-Range), and drop the connection in the middle of the responses listed in `server.truncate`"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self._respond()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _respond(self):
+        server = self.server
+        content = server.files.get(self.path)
+        if content is None:
+            return self._send(404, b'')
+        etag = server.etag(self.path)
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, None, {'ETag': etag})
+
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if server.ranges and range_header is not None and (if_range is None or if_range == etag):
+            start = int(range_header.removeprefix('bytes=').split('-')[0])
+            if start >= len(content):
+                return self._send(416, b'', {'Content-Range': f'bytes */{len(content)}'})
+            return self._send(206, content[start:], {'ETag': etag,
+                                                     'Content-Range': f'bytes {start}-{len(content) - 1}/{len(content)}'})
+        return self._send(200, content, {'ETag': etag})
+
+    def _send(self, status: int, body: bytes | None, headers: dict | None = None):
+        server = self.server
+        with server.lock:
+            server.requests.append({'path': self.path, 'headers': dict(self.headers), 'status': status})
+            truncated = status in (200, 206) and server.truncate.get(self.path, 0) > 0
+            if truncated:
+                server.truncate[self.path] -= 1
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is None:
+            return
+        if truncated:
+            # the announced length is not sent : the client sees the connection closed in the middle of the body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        if server.stall > 0:
+            # send half of the body, then wait longer than the client timeout
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            time.sleep(server.stall)
+            self.wfile.write(body[len(body) // 2:])
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(ThreadingHTTPServer):
+    """HTTP server on a free local port
+
+    :ivar files: content of each served path
+    :ivar requests: path, headers and response status of each request received
+    :ivar truncate: number of responses to cut in the middle for each path
+    :ivar ranges: set to False to ignore range requests
+    :ivar delay: seconds to wait before each response
+    :ivar stall: seconds to wait in the middle of each response body
+    :ivar max_active: maximum number of requests processed at the same time
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.files = {}
+        self.requests = []
+        self.truncate = {}
+        self.ranges = True
+        self.delay = 0
+        self.stall = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def url(self, path: str) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+    def etag(self, path: str) -> str:
+        return '"' + hashlib.sha256(self.files[path]).hexdigest()[:16] + '"'
+
+
+@pytest.fixture
+def http_server():
+    server = LocalServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
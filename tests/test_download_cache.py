@@ -0,0 +1,85 @@
+import hashlib
+
+import pytest
+
+from download_cache import DownloadCache
+
+CONTENT = b'Probe_ID\tmask_uniq\n' + b'cg00000001_TC11\tM_nonuniq\n' * 1000
+
+
+@pytest.fixture
+def url(http_server):
+    http_server.files['/Anno/EPIC.hg38.mask.tsv.gz'] = CONTENT
+    return http_server.url('/Anno/EPIC.hg38.mask.tsv.gz')
+
+
+def test_miss_downloads_file_and_metadata(http_server, url, tmp_path):
+    cache = DownloadCache(tmp_path)
+    filepath = cache.fetch(url)
+
+    assert filepath == cache.path(url)
+    assert filepath.read_bytes() == CONTENT
+    metadata = cache.metadata(url)
+    assert metadata['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert metadata['size'] == len(CONTENT)
+    assert metadata['etag'] == http_server.etag('/Anno/EPIC.hg38.mask.tsv.gz')
+    assert [request['status'] for request in http_server.requests] == [200]
+
+
+def test_hit_uses_cached_file(http_server, url, tmp_path):
+    DownloadCache(tmp_path).fetch(url)
+    filepath = DownloadCache(tmp_path).fetch(url)
+
+    assert filepath.read_bytes() == CONTENT
+    assert len(http_server.requests) == 1
+
+
+def test_revalidation_keeps_file_not_modified(http_server, url, tmp_path):
+    filepath = DownloadCache(tmp_path).fetch(url)
+    mtime = filepath.stat().st_mtime_ns
+
+    assert DownloadCache(tmp_path, revalidate=True).fetch(url) == filepath
+    request = http_server.requests[-1]
+    assert request['status'] == 304
+    assert request['headers']['If-None-Match'] == http_server.etag('/Anno/EPIC.hg38.mask.tsv.gz')
+    assert filepath.stat().st_mtime_ns == mtime
+
+
+def test_revalidation_downloads_modified_file(http_server, url, tmp_path):
+    DownloadCache(tmp_path).fetch(url)
+    http_server.files['/Anno/EPIC.hg38.mask.tsv.gz'] = CONTENT + b'cg00000002_BC21\tM_mapping\n'
+
+    cache = DownloadCache(tmp_path, revalidate=True)
+    filepath = cache.fetch(url)
+    assert http_server.requests[-1]['status'] == 200
+    assert filepath.read_bytes().endswith(b'M_mapping\n')
+    assert cache.metadata(url)['sha256'] == hashlib.sha256(filepath.read_bytes()).hexdigest()
+
+
+def test_corrupted_file_is_downloaded_again(http_server, url, tmp_path):
+    filepath = DownloadCache(tmp_path).fetch(url)
+    filepath.write_bytes(CONTENT[:100])
+
+    assert DownloadCache(tmp_path).fetch(url).read_bytes() == CONTENT
+    assert len(http_server.requests) == 2
+
+
+def test_offline_miss_raises(http_server, url, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        DownloadCache(tmp_path, offline=True).fetch(url)
+    assert len(http_server.requests) == 0
+
+
+def test_offline_hit_uses_cached_file(http_server, url, tmp_path):
+    DownloadCache(tmp_path).fetch(url)
+    assert DownloadCache(tmp_path, offline=True, verify=True).fetch(url).read_bytes() == CONTENT
+    assert len(http_server.requests) == 1
+
+
+def test_failed_download_is_not_cached(http_server, tmp_path):
+    cache = DownloadCache(tmp_path)
+    url = http_server.url('/Anno/missing.tsv.gz')
+
+    assert cache.fetch(url) is None
+    assert not cache.is_cached(url)
+    assert list(cache.entry_dir(url).iterdir()) == []
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from liftover import ChainLiftOver
+
+# chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id, then the blocks (size, gap in the
+# source, gap in the target). The second chain is on the - strand of the target, the third one overlaps the first one
+# with a higher score and the fourth one overlaps the second one with a lower score.
+CHAINS = """chain 1000 chr1 10000 + 100 650 chr1 12000 + 500 1030 1
+200 50 30
+300
+
+chain 500 chr1 10000 + 1000 1400 chr2 5000 - 200 600 2
+150 20 20
+230
+
+chain 2000 chr1 10000 + 250 400 chr3 8000 + 10 160 3
+150
+
+chain 100 chr1 10000 + 1100 1200 chr4 6000 + 0 100 4
+100
+
+chain 800 chr5 20000 + 0 300 chr5 20000 - 1000 1300 5
+300
+"""
+
+
+@pytest.fixture
+def chain_file(tmp_path):
+    filepath = tmp_path / 'test.over.chain'
+    filepath.write_text(CHAINS)
+    return filepath
+
+
+def test_convert_matches_pyliftover(chain_file):
+    pyliftover = pytest.importorskip('pyliftover')
+    reference = pyliftover.LiftOver(str(chain_file))
+    chromosomes = ['chr1'] * 1500 + ['5'] * 400 + ['chr7'] * 10
+    positions = np.concatenate([np.arange(1500), np.arange(400), np.arange(10)])
+
+    new_chromosomes, new_positions, unmapped = ChainLiftOver(chain_file).convert(chromosomes, positions)
+
+    for i, (chromosome, position) in enumerate(zip(chromosomes, positions)):
+        # pyliftover returns None for the chromosomes without chain
+        hits = reference.convert_coordinate('chr' + chromosome.removeprefix('chr'), int(position)) or []
+        if len(hits) == 0:
+            assert unmapped[i], (chromosome, position)
+        else:
+            # the hit of the chain with the highest score
+            expected = max(hits, key=lambda hit: hit[3])
+            assert not unmapped[i], (chromosome, position)
+            assert (new_chromosomes[i], new_positions[i]) == expected[:2], (chromosome, position)
+
+
+def test_convert_reports_missing_positions(chain_file):
+    new_chromosomes, new_positions, unmapped = ChainLiftOver(chain_file).convert(
+        pd.Series(['1', '1', None]), pd.array([150, None, 150], dtype='Int64'))
+
+    assert list(unmapped) == [False, True, True]
+    assert list(new_chromosomes[:2]) == ['chr1', '1'] and pd.isna(new_chromosomes[2])
+    assert list(new_positions) == [550, -1, 150]
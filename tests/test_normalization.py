@@ -0,0 +1,109 @@
+import io
+
+import pandas as pd
+import pytest
+
+from columnar import has_pyarrow, write_parquet
+from manifest_diff import read_probe_infos_csv
+from normalization import FIXED_CATEGORIES, apply_dtype_policy, concat_chunks, default_dtypes, normalize_manifest, \
+    split_addresses
+
+
+def probe_infos_csv(n_probes: int = 200) -> str:
+    """Probe infos csv file like the ones written by create_manifest.py, with repeated masks, genes and CGI names"""
+    lines = ['illumina_id,probe_id,type,probe_type,channel,address_a,address_b,chromosome,start,end,strand,mask_info,'
+             'genes,cgi']
+    for i in range(n_probes):
+        type_ii = i % 3 == 0
+        address_b = '' if type_ii else str(20_000_000 + i)
+        channel = '' if type_ii else ('R', 'G')[i % 2]
+        chromosome, start = ('', '') if i % 50 == 7 else (('1', '2', 'X')[i % 3], str(1_000_000 + 1000 * i))
+        end = str(int(start) + 50) if start else ''
+        mask = ('', 'M_mapping', 'M_nonuniq;M_SNPcommon_1pt')[i % 3]
+        genes = ('', 'GENE1', 'GENE2;GENE3', 'GENE4')[i % 4]
+        cgi = '' if i % 5 == 0 else f'chr1:{i // 10}-{i // 10 + 500}'
+        lines.append(f'{i},cg{i:08d}_{"TC" if i % 2 else "BC"}21,{"II" if type_ii else "I"},cg,{channel},'
+                     f'{10_000_000 + i},{address_b},{chromosome},{start},{end},{("+", "-")[i % 2]},{mask},{genes},{cgi}')
+    return '\n'.join(lines) + '\n'
+
+
+def raw_manifest() -> pd.DataFrame:
+    """Manifest with pylluminator column names, before normalization"""
+    # the control probe has no address, and is dropped
+    return pd.DataFrame({'probe_id': ['cg00000001_BC21', 'rs00000002_TC11', 'cg00000003_TC21', 'ctl_0004',
+                                      'cg00000005_BC21'],
+                         'type': ['I', 'I', 'II', 'II', 'II'],
+                         'probe_type': ['cg', 'rs', 'cg', 'ctl', 'cg'],
+                         'channel': ['Red', 'Grn', None, None, None],
+                         'chromosome': ['chr1', 'chrX', 'chr2', None, 'chrY'],
+                         'address_a': pd.array([101, 103, 105, None, 106], dtype='Int64'),
+                         'address_b': pd.array([102, 104, None, None, None], dtype='Int64')})
+
+
+@pytest.fixture
+def probe_infos():
+    return read_probe_infos_csv(io.StringIO(probe_infos_csv()))
+
+
+def test_lean_policy_dtypes(probe_infos):
+    lean = apply_dtype_policy(probe_infos, 'lean')
+
+    for column in ['chromosome', 'strand']:
+        assert isinstance(lean[column].dtype, pd.CategoricalDtype)
+        assert list(lean[column].cat.categories) == FIXED_CATEGORIES[column]
+    assert lean['address_a'].dtype == 'Int32'
+    assert lean['start'].dtype == 'Int32'
+    # repeated strings become categories, whether they were parsed as python objects (pandas 2) or strings (pandas 3)
+    for column in ['mask_info', 'genes', 'cgi']:
+        assert isinstance(lean[column].dtype, pd.CategoricalDtype), column
+    assert isinstance(lean['probe_id'].dtype, pd.StringDtype)
+    assert lean.attrs['default_dtypes']['cgi'] == probe_infos['cgi'].dtype
+    pd.testing.assert_frame_equal(default_dtypes(lean), probe_infos)
+
+
+def test_outputs_identical_with_both_policies(probe_infos, tmp_path):
+    lean = apply_dtype_policy(probe_infos, 'lean')
+
+    assert lean.to_csv() == probe_infos.to_csv()
+    if has_pyarrow():
+        write_parquet(default_dtypes(probe_infos), tmp_path / 'default.parquet')
+        write_parquet(default_dtypes(lean), tmp_path / 'lean.parquet')
+        assert (tmp_path / 'default.parquet').read_bytes() == (tmp_path / 'lean.parquet').read_bytes()
+
+
+def test_split_addresses_matches_rowwise_explode():
+    manifest = raw_manifest()
+
+    split = split_addresses(manifest)
+
+    # row-wise reference : list the non-NA addresses of each probe, and explode the lists
+    reference = manifest.copy()
+    reference['illumina_id'] = [[int(a) for a in (row.address_a, row.address_b) if not pd.isna(a)]
+                                for row in manifest.itertuples()]
+    reference = reference[reference['illumina_id'].str.len() > 0].explode('illumina_id').reset_index(drop=True)
+    reference['illumina_id'] = reference['illumina_id'].astype('int64')
+    pd.testing.assert_frame_equal(split, reference)
+    assert list(split['illumina_id']) == [101, 102, 103, 104, 105, 106]
+
+
+def test_normalize_manifest():
+    manifest = normalize_manifest(raw_manifest(), {'type': 'category'}, normalize_channel=True)
+
+    assert manifest.index.name == 'illumina_id'
+    assert list(manifest.index) == [101, 102, 103, 104, 105, 106]
+    assert list(manifest['chromosome']) == ['1', '1', 'X', 'X', '2', 'Y']
+    assert list(manifest['channel'].astype(object).fillna('')) == ['R', 'R', 'G', 'G', '', '']
+    assert list(manifest['probe_type'].cat.categories) == ['cg', 'snp']
+    assert list(manifest['strand']) == ['*'] * 6
+    for column in ['type', 'probe_type', 'channel', 'chromosome']:
+        assert isinstance(manifest[column].dtype, pd.CategoricalDtype), column
+
+
+def test_concat_chunks_keeps_categories():
+    chunks = [normalize_manifest(chunk) for chunk in [raw_manifest().iloc[:2], raw_manifest().iloc[2:]]]
+
+    manifest = concat_chunks(chunks)
+
+    assert isinstance(manifest['chromosome'].dtype, pd.CategoricalDtype)
+    assert list(manifest['chromosome'].cat.categories) == ['1', '2', 'X', 'Y']
+    assert list(manifest['chromosome']) == ['1', '1', 'X', 'X', '2', 'Y']
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from position_index import PositionIndex
+from update_data import compress
+
+CYTOBANDS = pd.DataFrame({'chromosome': ['1', '1', '1', '2'], 'start': [0, 50_000, 120_000, 0],
+                          'end': [50_000, 120_000, 250_000, 250_000], 'name': ['p36.33', 'p36.32', 'q11', 'p25.3']})
+
+
+@pytest.fixture
+def probe_infos():
+    rng = np.random.default_rng(0)
+    n_probes = 2000
+    starts = rng.integers(0, 200_000, n_probes)
+    # a few long probes, whose end reaches past many shorter probes starting after them
+    lengths = np.where(rng.random(n_probes) < 0.02, 5000, rng.integers(1, 60, n_probes))
+    chromosomes = rng.choice(['1', '2', '10', 'X'], n_probes).astype(object)
+    missing = rng.random(n_probes) < 0.05
+    chromosomes[missing[:n_probes // 2].nonzero()[0]] = None
+    probe_infos = pd.DataFrame({'chromosome': pd.Categorical(chromosomes), 'start': pd.array(starts, dtype='Int64'),
+                                'end': pd.array(starts + lengths, dtype='Int64')})
+    probe_infos.loc[missing[n_probes // 2:].nonzero()[0] + n_probes // 2, 'start'] = pd.NA
+    return probe_infos
+
+
+def overlapping(probe_infos: pd.DataFrame, chromosome: str, start: int, end: int) -> list[int]:
+    """Rows of the probes overlapping a region, with a boolean mask over all the probes"""
+    mask = (probe_infos['chromosome'] == chromosome) & (probe_infos['start'] < end) & (probe_infos['end'] > start)
+    return sorted(np.flatnonzero(mask.fillna(False).to_numpy()))
+
+
+def test_region_matches_boolean_mask(probe_infos):
+    index = PositionIndex.from_probe_infos(probe_infos, CYTOBANDS)
+
+    assert len(index) == probe_infos[['chromosome', 'start', 'end']].notna().all(axis=1).sum()
+    assert index.chromosomes == ['1', '2', '10', 'X']
+    for chromosome, start, end in [('1', 1000, 1100), ('1', 0, 200_000), ('2', 150_000, 150_001),
+                                   ('X', 199_990, 250_000), ('10', 5000, 5000), ('Y', 0, 200_000)]:
+        rows = index.region(chromosome, start, end)
+        assert sorted(rows) == overlapping(probe_infos, chromosome, start, end)
+        assert list(probe_infos['start'].iloc[rows]) == sorted(probe_infos['start'].iloc[rows])
+    assert sorted(index.window('2', 10_000, 20)) == overlapping(probe_infos, '2', 9980, 10_021)
+
+
+def test_regions_match_region(probe_infos):
+    index = PositionIndex.from_probe_infos(probe_infos)
+    regions = pd.DataFrame({'chromosome': ['1', '2', 'Y', '1', 'X'], 'start': [1000, 0, 0, 100_000, 50_000],
+                            'end': [3000, 500, 100, 100_000, 60_000]})
+
+    region_idxs, rows = index.regions(regions['chromosome'], regions['start'], regions['end'])
+
+    for i, (chromosome, start, end) in regions.iterrows():
+        assert sorted(rows[region_idxs == i]) == sorted(index.region(chromosome, start, end))
+
+
+def test_cytobands(probe_infos):
+    index = PositionIndex.from_probe_infos(probe_infos, CYTOBANDS)
+
+    assert sorted(index.cytoband('1', 'p36')) == overlapping(probe_infos, '1', 0, 120_000)
+    cytobands = index.probe_cytobands()
+    starts = probe_infos['start'].astype('float')
+    on_1 = (probe_infos['chromosome'] == '1').to_numpy() & starts.notna().to_numpy()
+    assert set(cytobands[on_1 & (starts >= 120_000).to_numpy()]) == {'q11'}
+    assert set(cytobands[on_1 & (starts < 50_000).to_numpy()]) == {'p36.33'}
+    assert set(cytobands[(probe_infos['chromosome'] == 'X').to_numpy()]) == {None}
+    assert cytobands[probe_infos['start'].isna().to_numpy()].tolist() == [None] * probe_infos['start'].isna().sum()
+
+
+@pytest.mark.parametrize('zipped', [False, True])
+def test_save_and_load(probe_infos, tmp_path, zipped):
+    index = PositionIndex.from_probe_infos(probe_infos, CYTOBANDS)
+    for filepath in index.save(tmp_path / 'positions'):
+        if zipped:
+            # as in the versioned folders, see update_data.py
+            compress(filepath, f'{filepath}.zip', os.path.basename(filepath))
+            os.remove(filepath)
+
+    loaded = PositionIndex.load(tmp_path / 'positions')
+
+    np.testing.assert_array_equal(loaded.positions, index.positions)
+    assert loaded.chromosomes == index.chromosomes
+    assert loaded.n_rows == len(probe_infos)
+    pd.testing.assert_frame_equal(loaded.cytobands, CYTOBANDS)
+    assert list(loaded.region('1', 1000, 1100)) == list(index.region('1', 1000, 1100))
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from download_cache import DownloadCache
+from prefetch import ConnectionPool, download, prefetch
+
+CONTENT = os.urandom(300_000)
+PATH = '/Anno/EPICv2.hg38.manifest.tsv.gz'
+
+
+@pytest.fixture
+def url(http_server):
+    http_server.files[PATH] = CONTENT
+    return http_server.url(PATH)
+
+
+@pytest.fixture
+def pool():
+    pool = ConnectionPool(timeout=5)
+    yield pool
+    pool.close()
+
+
+def test_interrupted_download_is_resumed(http_server, url, pool, tmp_path):
+    http_server.truncate[PATH] = 1
+    cache = DownloadCache(tmp_path)
+
+    filepath = download(url, cache, pool)
+
+    assert filepath == cache.path(url)
+    assert filepath.read_bytes() == CONTENT
+    assert [request['status'] for request in http_server.requests] == [200, 206]
+    resume_headers = http_server.requests[1]['headers']
+    assert resume_headers['Range'] == f'bytes={len(CONTENT) // 2}-'
+    assert resume_headers['If-Range'] == http_server.etag(PATH)
+    assert cache.metadata(url)['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert sorted(os.listdir(cache.entry_dir(url))) == sorted([filepath.name, 'metadata.json'])
+
+
+def test_partial_file_of_a_previous_run_is_resumed(http_server, url, pool, tmp_path):
+    cache = DownloadCache(tmp_path)
+    os.makedirs(cache.entry_dir(url))
+    part_path = cache.path(url).with_name(cache.path(url).name + '.part')
+    part_path.write_bytes(CONTENT[:1000])
+    with open(str(part_path) + '.json', 'w') as f:
+        json.dump({'validator': http_server.etag(PATH)}, f)
+
+    assert download(url, cache, pool).read_bytes() == CONTENT
+    assert [request['status'] for request in http_server.requests] == [206]
+    assert http_server.requests[0]['headers']['Range'] == 'bytes=1000-'
+
+
+def test_partial_file_of_a_modified_file_is_downloaded_again(http_server, url, pool, tmp_path):
+    cache = DownloadCache(tmp_path)
+    os.makedirs(cache.entry_dir(url))
+    part_path = cache.path(url).with_name(cache.path(url).name + '.part')
+    part_path.write_bytes(b'previous version of the file')
+    with open(str(part_path) + '.json', 'w') as f:
+        json.dump({'validator': '"previous etag"'}, f)
+
+    assert download(url, cache, pool).read_bytes() == CONTENT
+    assert [request['status'] for request in http_server.requests] == [200]
+    assert http_server.requests[0]['headers']['If-Range'] == '"previous etag"'
+
+
+def test_server_without_ranges_restarts_the_download(http_server, url, pool, tmp_path):
+    http_server.truncate[PATH] = 1
+    http_server.ranges = False
+
+    assert download(url, DownloadCache(tmp_path), pool).read_bytes() == CONTENT
+    assert [request['status'] for request in http_server.requests] == [200, 200]
+
+
+def test_incomplete_download_is_not_cached(http_server, url, pool, tmp_path):
+    # every response is cut : the size never matches the Content-Length
+    http_server.truncate[PATH] = 10
+    http_server.ranges = False
+    cache = DownloadCache(tmp_path)
+
+    assert download(url, cache, pool, retries=3) is None
+    assert len(http_server.requests) == 3
+    assert not cache.is_cached(url)
+    assert not cache.path(url).exists()
+
+
+def test_failed_request_is_not_cached(http_server, pool, tmp_path):
+    cache = DownloadCache(tmp_path)
+    url = http_server.url('/Anno/missing.tsv.gz')
+
+    assert download(url, cache, pool) is None
+    assert not cache.is_cached(url)
+
+
+def test_prefetch_caps_concurrent_downloads(http_server, tmp_path):
+    urls = []
+    for i in range(6):
+        http_server.files[f'/Anno/file{i}.tsv.gz'] = CONTENT[i * 1000:]
+        urls.append(http_server.url(f'/Anno/file{i}.tsv.gz'))
+    http_server.delay = 0.1
+    completed = []
+
+    paths = prefetch(urls + urls[:2], DownloadCache(tmp_path), max_concurrency=2,
+                     on_complete=lambda url, path: completed.append(url))
+
+    assert http_server.max_active == 2
+    assert sorted(completed) == sorted(urls)
+    assert all(paths[url].read_bytes() == CONTENT[i * 1000:] for i, url in enumerate(urls))
+    assert len(http_server.requests) == len(urls)
+
+
+def test_prefetch_skips_cached_files(http_server, url, tmp_path):
+    cache = DownloadCache(tmp_path)
+    cache.fetch(url)
+
+    assert prefetch([url], cache) == {url: cache.path(url)}
+    assert len(http_server.requests) == 1
+
+
+def test_prefetch_offline_does_not_download(http_server, url, tmp_path):
+    assert prefetch([url], DownloadCache(tmp_path, offline=True)) == {url: None}
+    assert len(http_server.requests) == 0
+
+
+class RecordingPool(ConnectionPool):
+    """Connection pool keeping track of all the connections it opened"""
+
+    def __init__(self, timeout: float):
+        super().__init__(timeout)
+        self.opened = []
+
+    def get(self, scheme, netloc):
+        connection = super().get(scheme, netloc)
+        self.opened.append(connection)
+        return connection
+
+
+@pytest.mark.parametrize('wait', ['delay', 'stall'])
+def test_timed_out_connections_are_closed(http_server, url, tmp_path, wait):
+    # the server doesn't answer in time, before sending the headers or in the middle of the body
+    setattr(http_server, wait, 0.5)
+    pool = RecordingPool(timeout=0.2)
+
+    assert download(url, DownloadCache(tmp_path), pool, retries=2) is None
+    assert len(pool.opened) > 0
+    assert all(connection.sock is None for connection in pool.opened)
+    pool.close()
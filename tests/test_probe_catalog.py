@@ -0,0 +1,53 @@
+import io
+import os
+
+import pandas as pd
+
+from manifest_diff import read_probe_infos_csv
+from probe_catalog import ProbeCatalog, write_catalog
+from update_data import compress
+
+EPIC = """illumina_id,probe_id,type,probe_type,channel,address_a,address_b,chromosome,start,end,strand,mask_info,genes,cgi
+1,cg00000001_BC21,I,cg,R,101,102,1,1000,1050,+,M_mapping,GENE1,
+2,cg00000002_TC21,II,cg,,103,,1,2000,2050,-,,GENE1;GENE2,chr1:1900-2500
+3,cg00000003_BC21,II,cg,,104,,2,500,550,+,,,
+4,ch00000004_TC11,II,ch,,105,,X,700,750,-,M_nonuniq,,
+5,rs00000005_BC11,I,rs,G,106,107,,,,*,,,
+"""
+
+# cg00000001 and rs00000005 are annotated the same, cg00000003 has other coordinates and ch00000004 is not on this array
+MSA = """illumina_id,probe_id,type,probe_type,channel,address_a,address_b,chromosome,start,end,strand,mask_info,genes
+11,cg00000001_BC21,II,cg,,201,,1,1000,1050,+,M_mapping,GENE1
+12,cg00000003_BC21,II,cg,,202,,2,600,650,+,,
+13,rs00000005_BC11,I,rs,R,203,204,,,,*,,
+14,cg00000006_TC21,II,cg,,205,,3,100,150,-,M_SNPcommon_1pt,GENE3
+"""
+
+
+def test_catalog_round_trip(tmp_path):
+    probe_infos = {'EPIC': read_probe_infos_csv(io.StringIO(EPIC)), 'MSA': read_probe_infos_csv(io.StringIO(MSA))}
+
+    write_catalog(probe_infos, tmp_path)
+    catalog = ProbeCatalog.read(tmp_path)
+
+    assert catalog.array_types == ['EPIC', 'MSA']
+    # the annotation shared by the two arrays is stored once, the probe with other coordinates twice. MSA has no CGI
+    # relations : the catalog columns are the ones of both arrays
+    assert list(catalog.catalog['probe_id']) == ['cg00000001_BC21', 'cg00000002_TC21', 'cg00000003_BC21',
+                                                 'cg00000003_BC21', 'cg00000006_TC21', 'ch00000004_TC11',
+                                                 'rs00000005_BC11']
+    assert 'cgi' in catalog.catalog.columns and 'type' not in catalog.catalog.columns
+    for array_type, csv in [('EPIC', EPIC), ('MSA', MSA)]:
+        pd.testing.assert_frame_equal(catalog.probe_infos(array_type), probe_infos[array_type])
+        # the same as probe_infos.csv written and read back
+        pd.testing.assert_frame_equal(catalog.probe_infos(array_type), read_probe_infos_csv(io.StringIO(csv)))
+
+
+def test_zipped_catalog(tmp_path):
+    probe_infos = {'EPIC': read_probe_infos_csv(io.StringIO(EPIC)), 'MSA': read_probe_infos_csv(io.StringIO(MSA))}
+    for filepath in write_catalog(probe_infos, tmp_path):
+        # as in the versioned folders, see update_data.py
+        compress(filepath, f'{filepath}.zip', os.path.basename(filepath))
+        os.remove(filepath)
+
+    pd.testing.assert_frame_equal(ProbeCatalog.read(tmp_path).probe_infos('MSA'), probe_infos['MSA'])
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from provenance import BUILD_MODULE, describe_changes, imported_modules, input_records, is_up_to_date, \
+    make_provenance, read_provenance, write_provenance
+from update_data import list_generated_files
+
+PARAMETERS = {'chunksize': None, 'probe_tables': False, 'strict': False}
+
+
+@pytest.fixture
+def build(tmp_path):
+    """A built folder : a local input file, the file built from it and its provenance"""
+    input_file = tmp_path / 'seq_length.csv'
+    input_file.write_text('chromosome,seq_length\n1,248956422\n')
+    output_dir = tmp_path / '_generated_data' / 'annotations' / 'hg38' / 'EPIC'
+    output_dir.mkdir(parents=True)
+    output_file = output_dir / 'probe_infos.csv'
+    output_file.write_text('illumina_id,probe_id\n1,cg00000001_BC21\n')
+    provenance = make_provenance(input_records([], [str(input_file)]), PARAMETERS)
+    write_provenance(output_dir, provenance, [str(output_file)], {'rows': 1})
+    return input_file, output_dir, output_file
+
+
+def test_unchanged_build_is_up_to_date(build):
+    input_file, output_dir, _ = build
+
+    previous = is_up_to_date(output_dir, make_provenance(input_records([], [str(input_file)]), PARAMETERS))
+
+    assert previous is not None
+    assert previous['details'] == {'rows': 1}
+    assert list(previous['outputs']) == ['probe_infos.csv']
+
+
+def test_changed_input_is_not_up_to_date(build):
+    input_file, output_dir, _ = build
+    input_file.write_text('chromosome,seq_length\n1,248956422\n2,242193529\n')
+
+    provenance = make_provenance(input_records([], [str(input_file)]), PARAMETERS)
+
+    assert is_up_to_date(output_dir, provenance) is None
+    input_name = str(input_file).replace(os.sep, '/')
+    assert describe_changes(read_provenance(output_dir), provenance) == [f'{input_name} changed']
+
+
+def test_changed_parameters_are_not_up_to_date(build):
+    input_file, output_dir, _ = build
+
+    assert is_up_to_date(output_dir, make_provenance(input_records([], [str(input_file)]),
+                                                     {**PARAMETERS, 'strict': True})) is None
+
+
+def test_modified_output_is_not_up_to_date(build):
+    input_file, output_dir, output_file = build
+    output_file.write_text('illumina_id,probe_id\n')
+
+    assert is_up_to_date(output_dir, make_provenance(input_records([], [str(input_file)]), PARAMETERS)) is None
+
+
+def test_provenance_is_not_versioned(build):
+    _, output_dir, _ = build
+
+    generated_files = list_generated_files(str(output_dir.parents[1]))
+
+    assert [os.path.basename(source_file) for source_file, _, _ in generated_files] == ['probe_infos.csv']
+
+
+def test_code_version_covers_the_build_modules():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    modules = [os.path.basename(filepath) for filepath in imported_modules(BUILD_MODULE, repo_dir)]
+
+    assert 'create_manifest.py' in modules and 'sesame_annotations.py' in modules and 'provenance.py' in modules
+    # scripts that don't change the built files
+    assert 'compare_manifests.py' not in modules and 'update_data.py' not in modules
+    assert not any(module.startswith('benchmark_') for module in modules)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+from term_index import TermBitset, TermIndex, count_decoding_errors, encode_probe_infos, load_encoded, save_encoded
+
+# mask reasons listed in the order of the SeSAMe mask columns, which is not alphabetical
+MASK_INFO = ['M_nonuniq;M_mapping', None, 'M_mapping', 'M_SNPcommon_1pt;M_mapping;M_1baseSwitchSNPcommon_1pt', '',
+             'M_nonuniq', 'M_SNPcommon_1pt;M_1baseSwitchSNPcommon_1pt']
+GENES = ['GENE2;GENE1', 'GENE1', None, 'GENE3;GENE2;GENE1', 'GENE4', '', 'GENE1']
+CGI = ['chr1:1-100;chr1:500-600', None, 'chr1:500-600', None, 'chr2:1-50', None, None]
+
+
+def expected(values: list) -> list:
+    """Decoded values : NA and empty strings have no term, and are decoded as None"""
+    return [None if pd.isna(value) or value == '' else value for value in values]
+
+
+def test_term_index_round_trip():
+    genes = TermIndex.from_strings(pd.Series(GENES))
+
+    assert len(genes) == len(GENES)
+    assert list(genes.terms) == ['GENE1', 'GENE2', 'GENE3', 'GENE4']
+    assert list(genes.to_strings()) == expected(GENES)
+    assert list(genes.contains('GENE2')) == [True, False, False, True, False, False, False]
+    assert list(genes.contains(['GENE4', 'GENE3', 'unknown'])) == [False, False, False, True, True, False, False]
+    assert count_decoding_errors(GENES, genes) == 0
+
+
+def test_bitset_keeps_the_order_of_the_terms():
+    mask_info = TermBitset.from_strings(pd.Series(MASK_INFO))
+
+    assert list(mask_info.terms) == ['M_SNPcommon_1pt', 'M_nonuniq', 'M_mapping', 'M_1baseSwitchSNPcommon_1pt']
+    assert list(mask_info.to_strings()) == expected(MASK_INFO)
+    assert count_decoding_errors(MASK_INFO, mask_info) == 0
+    assert list(mask_info.contains('M_mapping')) == [True, False, True, True, False, False, False]
+    assert list(mask_info.contains_all(['M_SNPcommon_1pt', 'M_1baseSwitchSNPcommon_1pt'])) == \
+           [False, False, False, True, False, False, True]
+
+
+def test_contradicting_orders_are_decoding_errors():
+    values = ['M_mapping;M_nonuniq', 'M_nonuniq;M_mapping', 'M_mapping']
+    mask_info = TermBitset.from_strings(values)
+
+    # no order fits all the probes : the terms are sorted, and one of the first two values isn't decoded back
+    assert list(mask_info.terms) == ['M_mapping', 'M_nonuniq']
+    assert count_decoding_errors(values, mask_info) == 1
+
+
+def test_save_and_load(tmp_path):
+    probe_infos = pd.DataFrame({'mask_info': MASK_INFO, 'genes': GENES, 'cgi': CGI},
+                               index=pd.Index(np.arange(100, 100 + len(GENES)), name='illumina_id'))
+    encoded = encode_probe_infos(probe_infos)
+    assert isinstance(encoded['mask_info'], TermBitset) and isinstance(encoded['genes'], TermIndex)
+
+    save_encoded(encoded, probe_infos.index, tmp_path / 'probe_infos.terms.npz')
+    illumina_ids, loaded = load_encoded(tmp_path / 'probe_infos.terms.npz')
+
+    assert list(illumina_ids) == list(probe_infos.index)
+    assert sorted(loaded) == ['cgi', 'genes', 'mask_info']
+    for column in probe_infos.columns:
+        assert type(loaded[column]) is type(encoded[column])
+        assert list(loaded[column].to_strings()) == expected(probe_infos[column].tolist())
@@ -0,0 +1,64 @@
+import pandas as pd
+
+from validation import format_violations, validate_probe_infos
+
+COLUMNS = ['illumina_id', 'probe_type', 'type', 'channel', 'address_a', 'address_b', 'chromosome', 'start', 'end']
+
+VALID_ROWS = [
+    (1, 'cg', 'II', None, 11, None, '1', 100, 102),
+    (2, 'cg', 'I', 'R', 12, 13, '2', 200, 202),
+    (3, 'rs', 'I', 'G', 14, 15, 'X', 300, 301),
+    # control probes have no position
+    (4, 'ctl', 'II', None, 16, None, None, None, None),
+]
+
+# one row breaking each check, and only this one
+INVALID_ROWS = {
+    'duplicated_illumina_id': (1, 'cg', 'II', None, 20, None, '1', 1000, 1002),
+    'missing_position': (21, 'cg', 'II', None, 21, None, '1', None, None),
+    'invalid_range': (22, 'cg', 'II', None, 22, None, '1', -2, 0),
+    'unexpected_length': (23, 'cg', 'II', None, 23, None, '1', 1100, 1103),
+    'unknown_type': (24, 'cg', None, None, 24, None, '1', 1200, 1202),
+    'type_i_addresses': (25, 'cg', 'I', 'R', 25, None, '1', 1300, 1302),
+    'type_i_channel': (26, 'cg', 'I', None, 26, 36, '1', 1400, 1402),
+    'type_ii_addresses': (27, 'cg', 'II', None, 27, 37, '1', 1500, 1502),
+    'type_ii_channel': (28, 'cg', 'II', 'G', 28, None, '1', 1600, 1602),
+    'unknown_chromosome': (29, 'cg', 'II', None, 29, None, 'Un', 100, 102),
+    'beyond_chromosome_end': (30, 'cg', 'II', None, 30, None, '2', 999, 1001),
+}
+
+SEQ_LENGTHS = pd.Series({'1': 10_000, '2': 1000, 'X': 5000}, name='seq_length')
+
+# the first probe is in the gap, the others are after it
+GAPS = pd.DataFrame({'chromosome': ['1'], 'start': [90], 'end': [101], 'type': ['telomere']})
+
+
+def make_probe_infos(rows: list[tuple]) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=COLUMNS).astype({'probe_type': 'category', 'type': 'category',
+                                                     'channel': 'category', 'chromosome': 'category',
+                                                     'address_a': 'Int64', 'address_b': 'Int64', 'start': 'Int64',
+                                                     'end': 'Int64'})
+    return df.set_index('illumina_id')
+
+
+def test_valid_probe_infos():
+    report = validate_probe_infos(make_probe_infos(VALID_ROWS), SEQ_LENGTHS, GAPS)
+
+    assert report == {'rows': 4, 'violations': {}, 'rows_in_gaps': 1}
+    assert format_violations(report) == '4 rows, no violation'
+
+
+def test_one_violation_of_each_kind():
+    report = validate_probe_infos(make_probe_infos(VALID_ROWS + list(INVALID_ROWS.values())), SEQ_LENGTHS, GAPS)
+
+    assert report['rows'] == len(VALID_ROWS) + len(INVALID_ROWS)
+    assert report['violations'] == {name: {'count': 1, 'examples': [row[0]]} for name, row in INVALID_ROWS.items()}
+    assert report['rows_in_gaps'] == 1
+    assert len(format_violations(report).splitlines()) == len(INVALID_ROWS)
+
+
+def test_chromosomes_are_not_checked_without_seq_lengths():
+    report = validate_probe_infos(make_probe_infos(VALID_ROWS + list(INVALID_ROWS.values())))
+
+    assert 'unknown_chromosome' not in report['violations'] and 'beyond_chromosome_end' not in report['violations']
+    assert 'rows_in_gaps' not in report
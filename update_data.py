@@ -1,44 +1,185 @@
 """Compress and move every file in folder `_generated_data` to the versioned folders `annotations` and `genome_info`"""
 
+import argparse
+import json
 import os
+import shutil
 import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
 from pylluminator.utils import get_logger
+
+from download_cache import file_checksum, CHUNK_SIZE
+from instrumentation import RECORDER, summarize_stages
+from provenance import PROVENANCE_FILE
+
 LOGGER = get_logger()
 
-# Function to read file contents
-def read_file(file_path):
-    with open(file_path, 'rb') as f:
-        return f.read()
+SOURCE_DIR = '_generated_data'
+
+# hashes and sizes of the versioned files, to find the files that changed without decompressing the archives
+INDEX_FILE = 'data_index.json'
+
+# fixed metadata, so that the same data always gives byte-identical archives
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_COMPRESS_LEVEL = 6
+
+# files that are already compressed, copied as is instead of zipped
+UNZIPPED_EXTENSIONS = ('.parquet', '.npz')
+
+
+def read_index(filepath: str = INDEX_FILE) -> dict:
+    """Read the index of the versioned files, empty if it doesn't exist yet"""
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def write_index(index: dict, filepath: str = INDEX_FILE) -> None:
+    """Write the index of the versioned files, sorted so that it's stable under version control"""
+    with open(filepath, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def file_crc(filepath: str) -> int:
+    """CRC32 of a file content, as stored in zip archives"""
+    crc = 0
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
 
-# Function to read a file inside a zip archive
-def read_file_from_zip(zip_path, file_name_in_zip):
-    with zipfile.ZipFile(zip_path, 'r') as zipf:
-        with zipf.open(file_name_in_zip) as f:
-            return f.read()
+def same_archive_content(source_file: str, dest_file: str, arcname: str) -> bool:
+    """Check if an existing archive contains the source file, using the size and CRC stored in the zip directory (no
+    decompression). Used for the files that are not indexed yet."""
+    try:
+        with zipfile.ZipFile(dest_file) as zipf:
+            info = zipf.getinfo(arcname)
+    except (KeyError, zipfile.BadZipFile):
+        return False
+    return info.file_size == os.path.getsize(source_file) and info.CRC == file_crc(source_file)
 
-for dir_path, _, filenames in os.walk('_generated_data'):
 
-    if len(filenames) == 0:
-        continue
+def is_up_to_date(source_file: str, dest_file: str, arcname: str, entry: dict | None, sha256: str) -> bool:
+    """Check if the versioned file already holds the content of the source file"""
+    if not os.path.exists(dest_file):
+        return False
+    if entry is not None:
+        return entry['sha256'] == sha256 and entry['archive_size'] == os.path.getsize(dest_file)
+    if dest_file.endswith('.zip'):
+        return same_archive_content(source_file, dest_file, arcname)
+    return file_checksum(dest_file) == sha256
 
-    destination_dir = dir_path.replace('_generated_data', '.', 1)
 
-    os.makedirs(destination_dir, exist_ok=True)
+def compress(source_file: str, dest_file: str, arcname: str) -> int:
+    """Write the source file in a zip archive with fixed metadata, or copy it as is if it's in UNZIPPED_EXTENSIONS
+    (parquet files are compressed by column chunk so that they can be read by row group, .npz files are already
+    compressed).
 
-    for filename in filenames:
-        source_file = dir_path  + '/' + filename
-        dest_file = destination_dir  + '/' + filename + '.zip'
+    :return: size of the versioned file
+    :rtype: int"""
 
-        if os.path.exists(dest_file):
-            source_file_content = read_file(source_file)
-            dest_file_content = read_file_from_zip(dest_file, filename)
-            if source_file_content == dest_file_content:
+    # written next to the destination first, so that an interrupted update never leaves a truncated file
+    tmp_path = dest_file + '.tmp'
+
+    if not dest_file.endswith('.zip'):
+        shutil.copyfile(source_file, tmp_path)
+    else:
+        info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        # the size is needed before writing to know if zip64 extensions are needed
+        info.file_size = os.path.getsize(source_file)
+        with zipfile.ZipFile(tmp_path, 'w', compresslevel=ZIP_COMPRESS_LEVEL) as zipf:
+            with open(source_file, 'rb') as src, zipf.open(info, 'w') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    os.replace(tmp_path, dest_file)
+    return os.path.getsize(dest_file)
+
+
+def compress_stage(source_file: str, dest_file: str, arcname: str, profile_dir: str | None = None) -> tuple[int, dict]:
+    """Run `compress` as a recorded stage, in a worker process
+
+    :return: size of the versioned file, and the record of the stage
+    :rtype: tuple[int, dict]"""
+    RECORDER.start_task('update_data', profile_dir)
+    with RECORDER.stage('compress', bytes_read=os.path.getsize(source_file), file=dest_file) as record:
+        record['bytes_written'] = compress(source_file, dest_file, arcname)
+    return record['bytes_written'], RECORDER.finish_task()[0]
+
+
+def list_generated_files(source_dir: str = SOURCE_DIR) -> list[tuple[str, str, str]]:
+    """List the generated files, with the path of their versioned file and their name in the archive. The provenance
+    files are not versioned : they only describe the local builds (build time, commit...)."""
+    files = []
+    for dir_path, _, filenames in os.walk(source_dir):
+        destination_dir = os.path.normpath(dir_path.replace(source_dir, '.', 1))
+        for filename in sorted(filenames):
+            if filename == PROVENANCE_FILE:
                 continue
+            dest_name = filename if filename.endswith(UNZIPPED_EXTENSIONS) else filename + '.zip'
+            files.append((os.path.join(dir_path, filename), os.path.join(destination_dir, dest_name), filename))
+    return files
+
+
+def update_data(jobs: int | None = None, source_dir: str = SOURCE_DIR, index_file: str = INDEX_FILE) -> list[str]:
+    """Compress the generated files that changed since the last update into the versioned folders, in parallel.
 
-        LOGGER.info(f'creating {dest_file} from {source_file}')
-        with zipfile.ZipFile(dest_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(source_file, arcname=filename)
+    :param jobs: number of processes compressing files. Default: None, one per core
+    :type jobs: int | None
+
+    :return: the versioned files that were updated
+    :rtype: list[str]"""
+
+    index = read_index(index_file)
+    to_update = {}
+    generated_files = list_generated_files(source_dir)
+    with RECORDER.stage('hash', rows_in=len(generated_files),
+                        bytes_read=sum(os.path.getsize(source_file) for source_file, _, _ in generated_files)):
+        for source_file, dest_file, arcname in generated_files:
+            key = dest_file.replace(os.sep, '/')
+            sha256 = file_checksum(source_file)
+            if is_up_to_date(source_file, dest_file, arcname, index.get(key), sha256):
+                if key not in index:
+                    index[key] = {'sha256': sha256, 'size': os.path.getsize(source_file),
+                                  'archive_size': os.path.getsize(dest_file)}
+                continue
+            os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+            to_update[key] = (source_file, dest_file, arcname, sha256)
 
+    if len(to_update) > 0:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {key: executor.submit(compress_stage, *params[:3], RECORDER.profile_dir)
+                       for key, params in to_update.items()}
+            for key, future in futures.items():
+                source_file, dest_file, _, sha256 = to_update[key]
+                archive_size, record = future.result()
+                RECORDER.add(record)
+                index[key] = {'sha256': sha256, 'size': os.path.getsize(source_file), 'archive_size': archive_size}
+                LOGGER.info(f'created {dest_file} from {source_file}')
 
+    write_index(index, index_file)
+    return list(to_update)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of files compressed in parallel. Default: number of cores')
+    parser.add_argument('--report', default=None,
+                        help='save the time, memory and bytes of each stage (hash, compress) in this json file')
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help='save a cProfile dump of each stage in this folder')
+    args = parser.parse_args()
+    RECORDER.start_task('update_data', args.profile)
+    updated = update_data(args.jobs)
+    LOGGER.info(f'{len(updated)} versioned file(s) updated')
+    stages = RECORDER.finish_task()
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump({'stages': stages, 'stage_totals': summarize_stages(stages)}, f, indent=2)
@@ -0,0 +1,136 @@
+"""Validation of a probe_infos table against the genome information of its genome version, before it's written. All
+the checks are array operations on whole columns, so that they can run on every build."""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from pylluminator.annotations import GenomeVersion
+from pylluminator.utils import get_logger
+
+from position_index import PositionIndex
+
+LOGGER = get_logger()
+
+SEQ_LENGTH_FILE = 'genome_info/{genome_version}/seq_length.csv.zip'
+GAP_INFO_FILE = 'genome_info/{genome_version}/gap_info.csv.zip'
+
+# probe types without genomic position
+UNPLACED_PROBE_TYPES = ['ctl']
+
+# expected end - start of each probe type, the other probe types (SNP, CpH...) have a length of 1
+PROBE_LENGTHS = {'cg': 2}
+
+# number of illumina IDs given as example of each violation
+MAX_EXAMPLES = 5
+
+
+def read_seq_lengths(genome_version: GenomeVersion | str) -> pd.Series | None:
+    """Read the length of the chromosomes of a genome version, None if the file doesn't exist"""
+    filepath = SEQ_LENGTH_FILE.format(genome_version=genome_version)
+    if not os.path.exists(filepath):
+        LOGGER.info(f'no sequence length file {filepath}')
+        return None
+    seq_lengths = pd.read_csv(filepath, dtype={'chromosome': str})
+    return seq_lengths.set_index('chromosome')['seq_length']
+
+
+def read_gaps(genome_version: GenomeVersion | str) -> pd.DataFrame | None:
+    """Read the gaps (telomeres, centromeres, contigs...) of a genome version, with 0-based starts and excluded ends
+    like probe_infos. None if the file doesn't exist"""
+    filepath = GAP_INFO_FILE.format(genome_version=genome_version)
+    if not os.path.exists(filepath):
+        LOGGER.info(f'no gap file {filepath}')
+        return None
+    gaps = pd.read_csv(filepath, usecols=['chromosome', 'start', 'end', 'type'], dtype={'chromosome': str})
+    # gap_info coordinates are 1-based with the end included
+    gaps['start'] -= 1
+    return gaps
+
+
+def _map_distinct(values: pd.Series, transform, na_value) -> np.ndarray:
+    """Apply `transform` to the distinct values of a column only (chromosomes, probe types...) and broadcast the result
+    to all the rows, NA values get `na_value`"""
+    codes, uniques = pd.factorize(values)
+    mapped = transform(pd.Series(np.asarray(uniques, dtype=object), dtype=object)).to_numpy()
+    return np.append(mapped, na_value)[codes]
+
+
+def validate_probe_infos(probe_infos: pd.DataFrame, seq_lengths: pd.Series | None = None,
+                         gaps: pd.DataFrame | None = None, position_index: PositionIndex | None = None) -> dict:
+    """Check the invariants of a probe_infos table :
+
+    - illumina IDs are unique
+    - probes have a chromosome, start and end (except control probes), on a chromosome of `seq_lengths`
+    - 0 <= start < end <= chromosome length, and end - start is 2 for CpG probes and 1 for the others
+    - type I probes have an address A, an address B and a channel (R or G), type II probes only an address A
+
+    and count the probes in the gaps of the genome.
+
+    :param probe_infos: probe infos indexed by illumina ID
+    :type probe_infos: pandas.DataFrame
+
+    :param seq_lengths: chromosome lengths, see `read_seq_lengths`. Default: None, chromosomes are not checked
+    :type seq_lengths: pandas.Series | None
+
+    :param gaps: gaps of the genome, see `read_gaps`. Default: None, probes in gaps are not counted
+    :type gaps: pandas.DataFrame | None
+
+    :param position_index: position index of probe_infos, to count the probes in gaps. Default: None, build it
+    :type position_index: PositionIndex | None
+
+    :return: number of rows, number of rows in gaps and, for each failed check, the number of rows and a few example
+        illumina IDs
+    :rtype: dict"""
+
+    starts = probe_infos['start'].astype('Int64').to_numpy(dtype='float64', na_value=np.nan)
+    ends = probe_infos['end'].astype('Int64').to_numpy(dtype='float64', na_value=np.nan)
+    has_position = probe_infos['chromosome'].notna().to_numpy() & ~np.isnan(starts) & ~np.isnan(ends)
+    is_placed = ~_map_distinct(probe_infos['probe_type'], lambda values: values.isin(UNPLACED_PROBE_TYPES), False)
+    expected_lengths = _map_distinct(probe_infos['probe_type'], lambda values: values.map(PROBE_LENGTHS).fillna(1), 1)
+    is_type_i = _map_distinct(probe_infos['type'], lambda values: values == 'I', False)
+    is_type_ii = _map_distinct(probe_infos['type'], lambda values: values == 'II', False)
+    has_address_a = probe_infos['address_a'].notna().to_numpy()
+    has_address_b = probe_infos['address_b'].notna().to_numpy()
+    has_channel = probe_infos['channel'].notna().to_numpy()
+    is_valid_channel = _map_distinct(probe_infos['channel'], lambda values: values.isin(['R', 'G']), False)
+
+    checks = {
+        'duplicated_illumina_id': probe_infos.index.duplicated(),
+        'missing_position': is_placed & ~has_position,
+        'invalid_range': has_position & ((starts < 0) | (starts >= ends)),
+        'unexpected_length': has_position & (ends - starts != expected_lengths),
+        'unknown_type': ~(is_type_i | is_type_ii),
+        'type_i_addresses': is_type_i & ~(has_address_a & has_address_b),
+        'type_i_channel': is_type_i & ~is_valid_channel,
+        'type_ii_addresses': is_type_ii & (~has_address_a | has_address_b),
+        'type_ii_channel': is_type_ii & has_channel,
+    }
+    if seq_lengths is not None:
+        lengths = _map_distinct(probe_infos['chromosome'], lambda values: values.map(seq_lengths).astype('float64'),
+                                np.nan)
+        checks['unknown_chromosome'] = has_position & np.isnan(lengths)
+        checks['beyond_chromosome_end'] = has_position & (ends > lengths)
+
+    report = {'rows': len(probe_infos), 'violations': {}}
+    for name, failed in checks.items():
+        failed_rows = np.flatnonzero(failed)
+        if len(failed_rows) > 0:
+            report['violations'][name] = {'count': len(failed_rows),
+                                          'examples': [int(i) for i in probe_infos.index[failed_rows[:MAX_EXAMPLES]]]}
+
+    if gaps is not None:
+        if position_index is None:
+            position_index = PositionIndex.from_probe_infos(probe_infos)
+        _, rows = position_index.regions(gaps['chromosome'], gaps['start'], gaps['end'])
+        report['rows_in_gaps'] = len(np.unique(rows))
+    return report
+
+
+def format_violations(report: dict) -> str:
+    """One line per failed check of a validation report"""
+    if len(report['violations']) == 0:
+        return f'{report["rows"]} rows, no violation'
+    return '\n'.join(f'{name:<24} {violation["count"]:>8} rows (e.g. {", ".join(map(str, violation["examples"]))})'
+                     for name, violation in report['violations'].items())